@@ -0,0 +1,266 @@
+"""
+Concurrent page crawler for the scrapers.
+
+Fetches many pages at once with asyncio instead of one blocking urlopen()
+after the other: at most PER_HOST requests per host are in flight, each over
+a kept-alive HTTP/1.1 connection reused for the following requests to the
+host. Failed requests are retried after a delay doubled on every attempt.
+Pages are handed to the caller in the order of their URLs as soon as they
+and the pages before them arrived, so results are written in a stable order.
+With a PageCache, cached pages are revalidated with conditional requests and
+only downloaded again when they changed.
+"""
+import ssl
+import asyncio
+import urllib.parse
+
+# Requests in flight per host
+PER_HOST = 8
+# Attempts per page before giving up
+MAX_RETRIES = 4
+# Seconds to wait before the first retry, doubled on every further retry
+RETRY_DELAY = 1
+# Seconds allowed per request
+TIMEOUT = 60
+MAX_REDIRECTS = 5
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class CrawlError(Exception):
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Crawler(object):
+    """
+    Fetches pages concurrently over per-host pools of kept-alive connections.
+    """
+    def __init__(self, per_host=PER_HOST, max_retries=MAX_RETRIES,
+                 retry_delay=RETRY_DELAY, timeout=TIMEOUT, cache=None):
+        """
+        :param per_host: (int) requests in flight per host
+        :param max_retries: (int) attempts per page
+        :param retry_delay: (float) seconds before the first retry
+        :param timeout: (float) seconds allowed per request
+        :param cache: (PageCache) cache of the pages, None to download every
+        page
+        """
+        self.per_host = per_host
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.cache = cache
+        # Pages served from the cache
+        self.cached = 0
+        # Semaphore and idle (reader, writer) connections per host, bound to
+        # the event loop of crawl()
+        self._limits = {}
+        self._idle = {}
+
+    def crawl(self, urls, handle):
+        """
+        Fetch pages and hand them over in the order of urls.
+        :param urls: (list[str]) URLs of the pages
+        :param handle: (function) called with (url, body, error) of every
+        page, body as bytes and error None, or body None and the exception
+        after the last attempt
+        :return count: (int) number of pages fetched
+        """
+        return asyncio.run(self._crawl(list(urls), handle))
+
+    async def _crawl(self, urls, handle):
+        self._limits = {}
+        self._idle = {}
+        done = {}
+        next_index = 0
+        count = 0
+
+        async def fetch(index, url):
+            try:
+                return index, await self.fetch(url), None
+            except Exception as el1:
+                return index, None, el1
+
+        try:
+            for task in asyncio.as_completed([fetch(i, url)
+                                              for i, url in enumerate(urls)]):
+                index, body, error = await task
+                done[index] = (body, error)
+                # Hand over the pages received without a gap
+                while next_index in done:
+                    body, error = done.pop(next_index)
+                    count += error is None
+                    handle(urls[next_index], body, error)
+                    next_index += 1
+        finally:
+            self._close()
+        return count
+
+    async def fetch(self, url):
+        """
+        Fetch a page, retrying failed requests. A cached page is only
+        downloaded again if it changed, and never in offline mode. Must run in
+        the event loop of crawl().
+        :param url: (str) URL of the page
+        :return body: (bytes) the page
+        """
+        cache = self.cache
+        cached, headers = None, {}
+        if cache is not None:
+            cached, headers = cache.validators(url)
+            if cache.offline:
+                if cached is None:
+                    raise CrawlError(
+                        'Offline and url={0} is not cached'.format(url))
+                self.cached += 1
+                return cached
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            try:
+                status, response_headers, body = await self._get(url, headers)
+                if status == 304:
+                    self.cached += 1
+                    return cached
+                if cache is not None:
+                    cache.put(url, body, response_headers.get('etag'),
+                              response_headers.get('last-modified'))
+                return body
+            except (CrawlError, OSError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError) as el1:
+                attempt += 1
+                status = getattr(el1, 'status', None)
+                # Client errors are not retried
+                if attempt >= self.max_retries or \
+                        (status is not None and 400 <= status < 500):
+                    raise
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def _get(self, url, headers):
+        """
+        Send a GET request, following redirects.
+        :param url: (str) URL of the page
+        :param headers: (dict) extra request headers
+        :return (status, headers, body): (int, dict, bytes) response, 200 or
+        304 if headers hold validators
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.hostname,
+                   parts.port or _DEFAULT_PORTS.get(parts.scheme, 80))
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            limit = self._limits.get(key)
+            if limit is None:
+                limit = self._limits[key] = asyncio.Semaphore(self.per_host)
+            async with limit:
+                status, response_headers, body = await asyncio.wait_for(
+                    self._request(key, parts.netloc, path, headers),
+                    self.timeout)
+            if status in _REDIRECTS and 'location' in response_headers:
+                url = urllib.parse.urljoin(url, response_headers['location'])
+                continue
+            if status != 200 and not (status == 304 and headers):
+                raise CrawlError('HTTP status={0} for url={1}'.format(
+                    status, url), status)
+            return status, response_headers, body
+        raise CrawlError('Too many redirects for url={0}'.format(url))
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        context = ssl.create_default_context() if scheme == 'https' else None
+        return await asyncio.open_connection(host, port, ssl=context)
+
+    async def _request(self, key, netloc, path, headers):
+        """
+        Send a GET request over an idle connection to the host, or a new one.
+        :param headers: (dict) extra request headers
+        :return (status, headers, body): (int, dict, bytes) response with
+        lowercase header names
+        """
+        idle = self._idle.setdefault(key, [])
+        reused = bool(idle)
+        reader, writer = idle.pop() if reused else await self._connect(key)
+        request = ('GET {0} HTTP/1.1\r\nHost: {1}\r\n'
+                   'Accept-Encoding: identity\r\n'
+                   'Connection: keep-alive\r\n{2}\r\n').format(
+            path, netloc, ''.join('{0}: {1}\r\n'.format(name, value)
+                                  for name, value in headers.items()))
+        try:
+            writer.write(request.encode('ascii'))
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line and reused:
+                # The server closed the idle connection, use a new one.
+                writer.close()
+                reader, writer = await self._connect(key)
+                writer.write(request.encode('ascii'))
+                await writer.drain()
+                status_line = await reader.readline()
+            version, status, headers, body, keep_alive = await _read_response(
+                reader, status_line)
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, headers, body
+
+    def _close(self):
+        for idle in self._idle.values():
+            for _, writer in idle:
+                writer.close()
+        self._idle = {}
+
+
+async def _read_response(reader, status_line):
+    """
+    Read an HTTP/1.x response after its status line.
+    :return (version, status, headers, body, keep_alive)
+    """
+    try:
+        version, status = status_line.decode('latin-1').split()[:2]
+        status = int(status)
+    except ValueError:
+        raise CrawlError('Invalid status line={0!r}'.format(status_line))
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    keep_alive = (version == 'HTTP/1.1' and
+                  headers.get('connection', '').lower() != 'close')
+    if status in (204, 304) or 100 <= status < 200:
+        # Responses without a body
+        body = b''
+    elif 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks = []
+        while True:
+            line = await reader.readline()
+            try:
+                size = int(line.split(b';')[0], 16)
+            except ValueError:
+                raise CrawlError('Invalid chunk size line={0!r}'.format(line))
+            if not size:
+                # Trailers up to the empty line
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        keep_alive = False
+    return version, status, headers, body, keep_alive
@@ -0,0 +1,140 @@
+"""
+On-disk cache of crawled pages.
+
+Stores the body of every page fetched by the crawler together with its ETag
+and Last-Modified headers, one file per URL named after the SHA-1 of the URL:
+a JSON line of metadata followed by the body. Cached pages are revalidated
+with a conditional request, If-None-Match / If-Modified-Since, so that pages
+that did not change, e.g. the pages of historical traces, come back as an
+empty 304 response instead of being downloaded again. In offline mode, pages
+are served from the cache without any request.
+
+The modification time of an entry is set on every hit, and the least
+recently used entries are removed once the cache grows over its size cap.
+The format is the one of scripts/page_cache.py, so both share a cache
+directory.
+"""
+import os
+import json
+import time
+import hashlib
+
+# Directory of the cache, relative to the current directory
+CACHE_DIR = 'pages'
+# Bytes kept in the cache
+MAX_SIZE = 1 << 30
+_EXTENSION = '.page'
+
+
+class PageCache(object):
+    """
+    Pages and their validators keyed by URL, evicted least recently used
+    first.
+    """
+    def __init__(self, cache_dir=None, max_size=MAX_SIZE, offline=False):
+        """
+        :param cache_dir: (str) directory of the cache, created if missing
+        (default: CACHE_DIR in the current directory)
+        :param max_size: (int) bytes kept in the cache
+        :param offline: (bool) serve pages from the cache only
+        """
+        if max_size < 0:
+            raise ValueError('Invalid max_size={0}'.format(max_size))
+        self.cache_dir = cache_dir or os.path.join(os.getcwd(), CACHE_DIR)
+        self.max_size = max_size
+        self.offline = offline
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Size and last use of every entry
+        self._entries = {}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(_EXTENSION):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                self._entries[name] = (stat.st_size, stat.st_mtime)
+        self.size = sum(size for size, _ in self._entries.values())
+        if self.size > self.max_size:
+            self._evict()
+
+    def _name(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest() + _EXTENSION
+
+    def get(self, url):
+        """
+        :param url: (str) URL of the page
+        :return (body, etag, last_modified): (bytes, str, str) cached page and
+        its validators, None if the page is not cached
+        """
+        name = self._name(url)
+        path = os.path.join(self.cache_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline().decode('utf-8'))
+                body = f.read()
+            # Mark the entry as recently used
+            os.utime(path, None)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url:
+            return None
+        if name in self._entries:
+            self._entries[name] = (self._entries[name][0], time.time())
+        return body, meta.get('etag'), meta.get('last_modified')
+
+    def validators(self, url):
+        """
+        :param url: (str) URL of the page
+        :return (body, headers): (bytes, dict) cached page and the headers of
+        a conditional request for it, (None, {}) if the page is not cached
+        """
+        entry = self.get(url)
+        if entry is None:
+            return None, {}
+        body, etag, last_modified = entry
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return body, headers
+
+    def put(self, url, body, etag=None, last_modified=None):
+        """
+        Cache a page, removing the least recently used pages over max_size.
+        :param url: (str) URL of the page
+        :param body: (bytes) the page
+        :param etag: (str) ETag header of the response
+        :param last_modified: (str) Last-Modified header of the response
+        """
+        name = self._name(url)
+        path = os.path.join(self.cache_dir, name)
+        tmp_file = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(json.dumps({'url': url, 'etag': etag,
+                                    'last_modified': last_modified})
+                        .encode('utf-8') + b'\n')
+                f.write(body)
+            os.replace(tmp_file, path)
+            stat = os.stat(path)
+        except OSError as el1:
+            print('Unable to cache url={0}. Error={1}'.format(url, el1))
+            return
+        old_size = self._entries.get(name, (0, 0))[0]
+        self._entries[name] = (stat.st_size, stat.st_mtime)
+        self.size += stat.st_size - old_size
+        if self.size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        max_size.
+        """
+        for name in sorted(self._entries,
+                           key=lambda name: self._entries[name][1]):
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            self.size -= self._entries.pop(name)[0]
@@ -0,0 +1,93 @@
+"""
+Selective HTML extractor for MAWI pages.
+
+The scrapers only need the links of a page, its last <pre> block, the stats
+table of trace pages, and the <b> label/value pairs of trace pages, e.g.
+'<b>StartTime:</b> Tue Oct  3 14:00:01 2006<br>'. PageParser picks these out
+of the stream of tags and text of html.parser and drops everything else,
+instead of building a full document tree. The last <pre> block is only known
+at the end of the page, so the whole page is scanned, but nothing outside the
+wanted elements is kept.
+"""
+from html.parser import HTMLParser
+
+
+def _normalize(text):
+    # Line breaks as read by the former tree parser
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+class PageParser(HTMLParser):
+    """
+    Collects the hrefs of <a> tags, the text of the last <pre> block and the
+    <b> labels followed by text.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        # href of every <a> tag with one, in page order
+        self.links = []
+        # Text of the last <pre> block, None if the page has none
+        self.pre = None
+        # (label, value) of every <b> tag directly followed by text, value
+        # being the text up to the next tag
+        self.labels = []
+        self._pre = None
+        self._label = None
+        self._value = None
+
+    def _end_value(self):
+        if self._value:
+            self.labels.append((self._label, ''.join(self._value)))
+        self._value = None
+        self._label = None
+
+    def handle_starttag(self, tag, attrs):
+        self._end_value()
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href is not None:
+                self.links.append(href)
+        elif tag == 'pre':
+            self._pre = []
+        elif tag == 'b':
+            self._label = []
+
+    def handle_endtag(self, tag):
+        if tag == 'b' and isinstance(self._label, list):
+            # The value is the text following </b>
+            self._label = ''.join(self._label)
+            self._value = []
+            return
+        self._end_value()
+        if tag == 'pre' and self._pre is not None:
+            self.pre = _normalize(''.join(self._pre))
+            self._pre = None
+
+    def handle_data(self, data):
+        if self._pre is not None:
+            self._pre.append(data)
+        if self._value is not None:
+            self._value.append(_normalize(data))
+        elif isinstance(self._label, list):
+            self._label.append(data)
+
+    def close(self):
+        HTMLParser.close(self)
+        self._end_value()
+        if self._pre is not None:
+            # Unclosed <pre> block
+            self.pre = _normalize(''.join(self._pre))
+            self._pre = None
+
+
+def parse_page(body):
+    """
+    :param body: (bytes|str) the page
+    :return page: (PageParser) links, last <pre> block and labels of the page
+    """
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    page = PageParser()
+    page.feed(body)
+    page.close()
+    return page
@@ -1,10 +1,10 @@
 import sys
-import gc
 import os
 import re
-from urllib.request import urlopen
 import threading
-from bs4 import BeautifulSoup
+from crawler import Crawler
+from page_parser import parse_page
+from page_cache import PageCache, CACHE_DIR
 
 
 # Setup folders
@@ -18,6 +18,8 @@ results_file_dir = os.path.join(os.getcwd(), 'results')
 if not os.path.exists(results_file_dir):
     os.makedirs(results_file_dir)
 
+page_cache_dir = os.path.join(os.getcwd(), CACHE_DIR)
+
 
 class MyThread(threading.Thread):
     def __init__(self, target, *args, **kwargs):
@@ -34,19 +36,116 @@ def find_dirname_from_level(dir_path=None, level=0):
     return '-'.join(dir_path.split('/')[-level - 1:])
 
 
+def _child_links(webpage, body):
+    """
+    :param webpage: (str) url of the page
+    :param body: (bytes) the page
+    :return links: (list[str]) urls of the pages linked from the page
+    """
+    return [os.path.join(webpage, link) for link in parse_page(body).links]
+
+
+def _crawl_child_pages(webpages, handle, crawler=None):
+    """
+    Fetch the pages linked from webpages concurrently and hand them over in
+    order, see Crawler.crawl().
+    :param webpages: (list[str]) urls of the pages containing the links
+    :param handle: (function) called with (webpage, child_link, body) of
+    every child page fetched
+    :param crawler: (Crawler) crawler to use
+    :return count: (int) number of child pages fetched
+    """
+    crawler = crawler or Crawler()
+    parents = {}
+    child_links = []
+
+    def add_links(webpage, body, error):
+        if error is not None:
+            print('Unable to get url={0}. Error={1}'.format(webpage, error))
+            return
+        print('Processing url={0}'.format(webpage))
+        for child_link in _child_links(webpage, body):
+            parents[child_link] = webpage
+            child_links.append(child_link)
+
+    def handle_child(child_link, body, error):
+        if error is not None:
+            print(error)
+            return
+        try:
+            handle(parents[child_link], child_link, body)
+        except Exception as el2:
+            print(el2)
+
+    crawler.crawl(webpages, add_links)
+    return crawler.crawl(child_links, handle_child)
+
+
+def _dump_rows(page):
+    """
+    Extract the link to the dump file and its packet counts from a trace page,
+    as scrap_links() of the analyzer does.
+    :param page: (PageParser) the parsed trace page
+    :return rows: (list[list[str]]) [file_link, total, ip, tcp, udp] of the
+    stats table, empty if the page has no link to a dump file or no table
+    """
+    file_link = None
+    for link in page.links:
+        if '.gz' in link:
+            file_link = link
+    if file_link is None or page.pre is None:
+        # We suppose that there is going to be only 1 link for
+        # downloadable dump file.
+        return []
+    a = page.pre
+    total = re.split(r'\s+', a[a.find('total'):])[1].split(' ')[0]
+    ip = re.split(r'\s+', a[a.find('ip'):])[1].split(' ')[0]
+    tcp = re.split(r'\s+', a[a.find('tcp'):])[1].split(' ')[0]
+    udp = re.split(r'\s+', a[a.find('udp'):])[1].split(' ')[0]
+    return [[file_link, total, ip, tcp, udp]]
+
+
+def _write_stats(page, results_file):
+    """
+    Write the protocol stats table, the last <pre> block, of a trace page to
+    a csv file.
+    :param page: (PageParser) the parsed trace page
+    :param results_file: (str) path to the csv file
+    """
+    if page.pre is None:
+        raise ValueError('No stats table for file={0}'.format(results_file))
+    fr = open(results_file, 'w')
+    ip6_flag = False
+    for line in page.pre.split('\n'):
+        if not line.startswith('-'):
+            values = [val.replace(' ', '')
+                      for val in re.split(r'\s+', line.lstrip())
+                      if not val.startswith(
+                    '(') and not val.endswith('%)')]
+            # put identifier for ip6 packets
+            if not ip6_flag:
+                if values[0] == 'tcp6':
+                    ip6_flag = True
+            else:
+                values[0] += '-6'
+            if len(values) > 1:
+                fr.write(','.join(values))
+            fr.write('\n')
+    fr.close()
+
+
 # Get links from page
-def get_stats_from_page(webpage, results_file_dir=None):
+def get_stats_from_page(webpage, results_file_dir=None, crawler=None):
     """
     Reads the webpage and goes to each child link, extracts the stats from
-    page and writes the to a csv file in results_dir
+    page and writes the to a csv file in results_dir. Child pages are
+    fetched concurrently.
     :param webpage: url for webpage containing child page's links
     :param results_dir: directory to store results.
+    :param crawler: (Crawler) crawler to fetch the pages with
     :return:
     """
     try:
-        print('Processing url={0}'.format(webpage))
-        soup = BeautifulSoup(urlopen(webpage), 'lxml')
-        count = 0
         if results_file_dir:
             results_dir=os.path.join(results_file_dir,
                                      find_dirname_from_level(webpage, level=2))
@@ -59,115 +158,172 @@ def get_stats_from_page(webpage, results_file_dir=None):
                 os.makedirs(results_dir)
         print('directory created at %s' % results_dir)
 
-        # results_file = os.path.join(results_dir, find_dirname_from_level(
-        #     webpage, level=2) + '.csv')
-        # fr = open(results_file, 'w')
-        for link in soup.findAll('a'):
-            try:
-                child_link = os.path.join(webpage, link.get('href'))
-                soup = BeautifulSoup(urlopen(child_link), 'lxml')
-                count += 1
-                # Open file to write the results
-                results_file = os.path.join(
-                    results_dir,
-                    os.path.basename(child_link).replace('.html', '.csv'))
-                fr = open(results_file, 'w')
-                for a in soup.findAll('pre')[-1]:
-                    b = str(a.encode('ascii').decode('ascii'))
-                    ip6_flag = False
-                    for line in b.split('\n'):
-                        if not line.startswith('-'):
-                            values = [val.replace(' ', '')
-                                      for val in re.split(r'\s+', line.lstrip())
-                                      if not val.startswith(
-                                    '(') and not val.endswith('%)')]
-                            # put identifier for ip6 packets
-                            if not ip6_flag:
-                                if values[0] == 'tcp6':
-                                    ip6_flag = True
-                            else:
-                                values[0] += '-6'
-                            if len(values) > 1:
-                                fr.write(','.join(values))
-                            fr.write('\n')
-                fr.close()
-                gc.collect()
-            except Exception as el2:
-                print(el2)
-                pass
+        def write_stats(webpage, child_link, body):
+            # Open file to write the results
+            results_file = os.path.join(
+                results_dir,
+                os.path.basename(child_link).replace('.html', '.csv'))
+            _write_stats(parse_page(body), results_file)
+
+        count = _crawl_child_pages([webpage], write_stats, crawler)
         print("{0} links extracted from {1}".format(count, webpage))
     except Exception as el1:
         print(el1)
 
+
+def _trace_info(page):
+    """
+    Extract the trace information, the values following the <b> labels, of
+    a trace page.
+    :param page: (PageParser) the parsed trace page
+    :return trace_values: (list[str]) the values in the order of the labels
+    """
+    trace_values = []
+    for label, val in page.labels:
+        val = val.strip()
+        extra_val = None
+        if 'CapLen' in val:
+            extra_val = val[val.find('CapLen'):]\
+                            .split(':')[1]\
+                            .strip()\
+                            .split(' ')[0]
+            val = val.split(' ')[0]
+        if 'stddev' in val:
+            extra_val = val[val.find('stddev'):]\
+                            .split(':')[1]\
+                            .strip()\
+                            .split(' ')[0]
+            # remove M from stddev
+            extra_val = extra_val[:-1]
+            val = val.split(' ')[0]
+        if 'StartTime' in label or 'EndTime' in label:
+            val = str(_convert_date_to_seconds(val))
+        if '(' in val:
+            val = val[:val.find('(')].strip()
+        if val.endswith('seconds'):
+            val = val.split(' ')[0]
+        if val.endswith('Mbps'):
+            val = val[:-4]
+        if val.endswith('MB'):
+            val = val[:-2]
+        if 'stdev' in val:
+            val = val[:val.find('stdev')]
+        trace_values.append(val.strip())
+        if extra_val:
+            trace_values.append(extra_val)
+    return trace_values
+
+
 # Get trace information from page
-def get_trace_info_from_page(webpage, results_file=None):
+def get_trace_info_from_page(webpage, results_file=None, crawler=None):
     """
     Reads the webpage and goes to each child link, extracts the stats from
     page and writes the to a csv file in results_dir
     :param webpage: url for webpage containing child page's links
     :param results_file: file to store stats
+    :param crawler: (Crawler) crawler to fetch the pages with
     :return:
     """
+    get_trace_info_from_pages([webpage], results_file, crawler)
+
+
+def get_trace_info_from_pages(webpages, results_file=None, crawler=None):
+    """
+    Like get_trace_info_from_page() for several webpages at once. The child
+    pages of all webpages are fetched concurrently and their rows appended
+    in the order of the webpages and links.
+    :param webpages: (list[str]) urls for webpages containing child page's
+    links
+    :param results_file: file to store stats
+    :param crawler: (Crawler) crawler to fetch the pages with
+    :return count: (int) number of child pages processed
+    """
     try:
-        print('Processing url={0}'.format(webpage))
-        soup = BeautifulSoup(urlopen(webpage), 'lxml')
-        count = 0
-        for link in soup.findAll('a'):
-            try:
-                child_link = os.path.join(webpage, link.get('href'))
-                soup = BeautifulSoup(urlopen(child_link), 'lxml')
-                count += 1
-                trace_values = []
-                for strong_tag in soup.find_all('b'):
-                    # print(strong_tag.text, strong_tag.next_sibling)
-                    val = strong_tag.next_sibling
-                    if val is not None:
-                        try:
-                            val = val.strip()
-                        except:
-                            # Skip <br/>
-                            continue
-                        extra_val = None
-                        if 'CapLen' in val:
-                            extra_val = val[val.find('CapLen'):]\
-                                            .split(':')[1]\
-                                            .strip()\
-                                            .split(' ')[0]
-                            val = val.split(' ')[0]
-                        if 'stddev' in val:
-                            extra_val = val[val.find('stddev'):]\
-                                            .split(':')[1]\
-                                            .strip()\
-                                            .split(' ')[0]
-                            # remove M from stddev
-                            extra_val = extra_val[:-1]
-                            val = val.split(' ')[0]
-                        if 'StartTime' in strong_tag.string\
-                                or 'EndTime' in strong_tag.string:
-                            val = str(_convert_date_to_seconds(val))
-                        if '(' in val:
-                            val = val[:val.find('(')].strip()
-                        if val.endswith('seconds'):
-                            val = val.split(' ')[0]
-                        if val.endswith('Mbps'):
-                            val = val[:-4]
-                        if val.endswith('MB'):
-                            val = val[:-2]
-                        if 'stdev' in val:
-                            val = val[:val.find('stdev')]
-                        trace_values.append(val.strip())
-                        if extra_val:
-                            trace_values.append(extra_val)
-                fr = open(results_file, 'a+')
-                fr.write(','.join(trace_values)+'\n')
-                fr.close()
-                gc.collect()
-            except Exception as el2:
-                print(el2)
-                pass
-        print("{0} links extracted from {1}".format(count, webpage))
+        counts = {}
+        with open(results_file, 'a+') as fr:
+            def write_trace_info(webpage, child_link, body):
+                fr.write(','.join(_trace_info(parse_page(body))) + '\n')
+                counts[webpage] = counts.get(webpage, 0) + 1
+
+            count = _crawl_child_pages(webpages, write_trace_info, crawler)
+        for webpage in webpages:
+            print("{0} links extracted from {1}".format(
+                counts.get(webpage, 0), webpage))
+        return count
+    except Exception as el1:
+        print(el1)
+        return 0
+
+
+def scrap_pages(webpages, results_file, results_file_dir=None,
+                url_directory=None, crawler=None):
+    """
+    Crawl the child pages of webpages once and extract everything from each
+    page with a single parse:
+    - the links to the dump files and their packet counts, written to a csv
+    file per webpage in url_directory, like scrap_links() of the analyzer
+    - the protocol stats table, written like get_stats_from_page()
+    - the trace information, appended to results_file like
+    get_trace_info_from_pages()
+    :param webpages: (list[str]) urls for webpages containing child page's
+    links
+    :param results_file: file to store the trace information
+    :param results_file_dir: directory to store the stats of the child pages
+    (default: the current directory)
+    :param url_directory: directory to store the links to dump files
+    (default: the current directory)
+    :param crawler: (Crawler) crawler to fetch the pages with
+    :return count: (int) number of child pages processed
+    """
+    results_file_dir = results_file_dir or os.getcwd()
+    url_directory = url_directory or os.getcwd()
+    links_files = {}
+    try:
+        results_dirs = {}
+        for webpage in webpages:
+            dirname = find_dirname_from_level(webpage, level=2)
+            results_dirs[webpage] = os.path.join(results_file_dir, dirname)
+            if not os.path.exists(results_dirs[webpage]):
+                os.makedirs(results_dirs[webpage])
+            links_files[webpage] = open(
+                os.path.join(url_directory, dirname + '.csv'), 'w')
+            # Write headers
+            links_files[webpage].write('url,total,ip,tcp,udp\n')
+        counts = {}
+        with open(results_file, 'a+') as fr:
+            def write_links(webpage, child_link, page):
+                for row in _dump_rows(page):
+                    links_files[webpage].write(','.join(row) + '\n')
+
+            def write_stats(webpage, child_link, page):
+                _write_stats(page, os.path.join(
+                    results_dirs[webpage],
+                    os.path.basename(child_link).replace('.html', '.csv')))
+
+            def write_trace_info(webpage, child_link, page):
+                fr.write(','.join(_trace_info(page)) + '\n')
+
+            def scrap_page(webpage, child_link, body):
+                page = parse_page(body)
+                # A page missing the parts of one output still gets the others
+                for write in (write_links, write_stats, write_trace_info):
+                    try:
+                        write(webpage, child_link, page)
+                    except Exception as el2:
+                        print(el2)
+                counts[webpage] = counts.get(webpage, 0) + 1
+
+            count = _crawl_child_pages(webpages, scrap_page, crawler)
+        for webpage in webpages:
+            print("{0} links extracted from {1}".format(
+                counts.get(webpage, 0), webpage))
+        return count
     except Exception as el1:
         print(el1)
+        return 0
+    finally:
+        for f in links_files.values():
+            f.close()
 
 
 def _convert_date_to_seconds(input_date):
@@ -189,13 +345,18 @@ def _convert_date_to_seconds(input_date):
 
 
 # Get all URLs
-def get_all_stats(url_list, results_file_dir=None):
+def get_all_stats(url_list, results_file_dir=None, url_directory=None,
+                  cache_dir=page_cache_dir, offline=False):
     """
     This function reads url_list and for each url, it finds all child links
     to stats and writes them to a files in url_file_dir directory
     :param url_list: text file containing list of URLs for parents pages of
     traces.
     :param results_file_dir: directory for storing text files containing links.
+    :param url_directory: directory for storing the links to dump files
+    :param cache_dir: directory of the page cache, None to download every
+    page
+    :param offline: only use the pages in the cache
     """
     try:
         results_file = os.path.join(os.getcwd(), 'trace_results-2.csv')
@@ -206,18 +367,26 @@ def get_all_stats(url_list, results_file_dir=None):
                 'Mbps),avg_rate_stddev(M),# of flows,# of ipv4 packets,'
                 '# of ipv6 packets,\n')
         f.close()
-        count = 0
         with open(url_list, 'r') as f:
-            lines = f.readlines()
-            for l in lines:
-                if not l.startswith('#'):           # shows comments
-                    # get_stats_from_page(webpage=l.rstrip(),
-                    #                     results_file_dir=results_file_dir)
-                    get_trace_info_from_page(webpage=l.rstrip(),
-                                             results_file=results_file)
-                    count += 1
-            print('Links retrieved successfully from {0} '
-                  'webpages'.format(count))
+            webpages = [l.rstrip() for l in f.readlines()
+                        if not l.startswith('#')]     # shows comments
+        # for webpage in webpages:
+        #     get_stats_from_page(webpage=webpage,
+        #                         results_file_dir=results_file_dir)
+        # Crawl the child pages of all webpages at once, extracting the links
+        # to dump files, the stats and the trace information in one pass
+        cache = None
+        if cache_dir is not None:
+            cache = PageCache(cache_dir, offline=offline)
+        crawler = Crawler(cache=cache)
+        scrap_pages(webpages, results_file=results_file,
+                    results_file_dir=results_file_dir,
+                    url_directory=url_directory, crawler=crawler)
+        print('Links retrieved successfully from {0} '
+              'webpages'.format(len(webpages)))
+        if cache is not None:
+            print('{0} pages served from cache at {1}'.format(
+                crawler.cached, cache_dir))
     except ValueError as el1:
         print('Unable to get trace from url_list file. Error={0}'.format(el1))
 
@@ -226,5 +395,6 @@ if __name__ == '__main__':
     #     url='http://mawi.wide.ad.jp/mawi/samplepoint-F/2006/200610031400.html',
     #     fp='200610031400-1.txt'
     # )
-    get_all_stats(url_list='url_list.txt', results_file_dir=results_file_dir)
+    get_all_stats(url_list='url_list.txt', results_file_dir=results_file_dir,
+                  url_directory=url_file_dir)
 
@@ -3,12 +3,27 @@ Analyze the log file.
 """
 import os
 import re
-import socket
+import shutil
 import binascii
 import urllib2
 import logging
-from BeautifulSoup import BeautifulSoup
+import multiprocessing
 from progressbar import *
+from pcap_mmap import *
+from pcap_stream import GunzipReader, StreamPcapReader
+from sinks import CsvSink
+from compression import CODECS, codec_extension
+from summary import SummarySink, SummaryCsvSink
+from labels import load_labels
+from timeseries import Timeseries
+from heavy_hitters import HeavyHitters, EPSILON, DELTA
+from distinct import DistinctCounts, PRECISION, MIN_PRECISION, MAX_PRECISION
+from flows import FlowTable, FLOW_TABLE_SIZE, IDLE_TIMEOUT, ACTIVE_TIMEOUT
+from downloader import get_downloader, scraped_size
+from crawler import Crawler
+from page_parser import parse_page
+from pcap_index import load_index, open_index
+from pcap_filter import compile_filter
 
 logging.basicConfig(level=logging.INFO)
 
@@ -20,6 +35,14 @@ except ImportError as e:
     logging.error(e)
     print('dpkt installation required.')
 
+try:
+    import pcap_batch
+    from columnar import ColumnarSink
+except ImportError:
+    # numpy is only required by the batch engine and columnar output
+    pcap_batch = None
+    ColumnarSink = None
+
 
 def extract_mac_addr(address):
     """
@@ -41,118 +64,873 @@ def extract_dscp(tos):
     return tos >> 2
 
 
-def analyze(filename=None, output_dir=None, trace_count=0):
+def _analyze_dpkt(source, sink, pbar, trace_count, packet_filter=None,
+                  fragment_table=FRAGMENT_TABLE_SIZE):
+    """
+    Analyze a pcap file by decoding every packet with dpkt.
+    :param source: (str|file) path to the pcap file or readable file object
+    :param sink: (CsvSink|ColumnarSink) output for the per-packet rows
+    :param pbar: (ProgressBar) progress bar to update
+    :param trace_count: (int) number of packets in the trace
+    :param packet_filter: (PacketFilter) only decode matching packets
+    :param fragment_table: (int) size of the FragmentTable
+    :return counters: (dict) packet counters
+    """
+    pcap_file = (open(source, 'rb') if isinstance(source, basestring)
+                 else source)
+    captures = dpkt.pcap.Reader(pcap_file)
+    fragments = FragmentTable(fragment_table)
+    percent = 0.0
+
+    # Counters
+    total_packets = 0
+    ip_packets = 0
+    non_ip4_packets = 0
+    tcp_packets = 0
+    udp_packets = 0
+    unprocessed_packets = 0
+    filtered_packets = 0
+    # Process each packet.
+    for ts, buff in captures:
+        if packet_filter is not None and \
+                not packet_filter.match(buff, 0, len(buff), ts):
+            total_packets += 1
+            filtered_packets += 1
+            continue
+        try:
+            total_packets += 1
+            # Get source and destination mac addresses
+            eth = dpkt.ethernet.Ethernet(buff)
+            if eth.type != dpkt.ethernet.ETH_TYPE_IP:
+                # Skip if packet is not IP
+                non_ip4_packets += 1
+                continue
+
+            # Get source and destination IP addresses
+            ip = eth.data
+            ip_packets += 1
+            if not isinstance(ip, dpkt.ip.IP):
+                # No data in IP header
+                unprocessed_packets += 1
+            elif ip.p == dpkt.ip.IP_PROTO_TCP or \
+                    ip.p == dpkt.ip.IP_PROTO_UDP:
+                if ip.p == dpkt.ip.IP_PROTO_TCP:
+                    tcp_packets += 1
+                else:
+                    udp_packets += 1
+                # Get port numbers. dpkt leaves the payload of non-first
+                # fragments and truncated headers undecoded.
+                if isinstance(ip.data, (dpkt.tcp.TCP, dpkt.udp.UDP)):
+                    sport, dport = ip.data.sport, ip.data.dport
+                else:
+                    sport = dport = None
+                if ip.mf or ip.offset:
+                    key = (ip.src, ip.dst, ip.id, ip.p)
+                    if ip.offset:
+                        ports = fragments.get(key, ts, not ip.mf)
+                        if ports is not None:
+                            sport, dport = ports
+                    elif sport is not None:
+                        fragments.add(key, sport, dport, ts)
+                if sport is None:
+                    unprocessed_packets += 1
+                    sink.write(ts, ip.src, 0, ip.dst, 0, ip.tos)
+                else:
+                    sink.write(ts, ip.src, sport, ip.dst, dport, ip.tos)
+            else:
+                # Skip un-required packets
+                pass
+            # Update progress bar
+            percent += 100.0/trace_count
+            pbar.update(percent)
+        except Exception as el2:
+            logging.error("error=%s while processing ts=%s" % (el2, ts))
+            pass
+    pcap_file.close()
+    counters = {
+        "total": total_packets,
+        "ip": ip_packets,
+        "non_ip4": non_ip4_packets,
+        "tcp": tcp_packets,
+        "udp": udp_packets,
+        "unprocessed": unprocessed_packets,
+        "fragments": fragments.resolved
+    }
+    if packet_filter is not None:
+        counters["matched"] = total_packets - filtered_packets
+    return counters
+
+
+def _analyze_packets(packets, sink, pbar, trace_count, packet_filter=None,
+                     ipv6=False):
+    """
+    Count and write packets decoded by decode_packet(). Produces the same rows
+    and counters as _analyze_dpkt().
+    :param packets: (generator) (ts, length, kind, proto, src, sport, dst,
+    dport, tos, flags) tuples, see MmapPcapReader.packets()
+    :param sink: (CsvSink|ColumnarSink|SummarySink) output for the
+    per-packet rows, or the summary to add the packets to
+    :param pbar: (ProgressBar) progress bar to update
+    :param trace_count: (int) number of packets in the trace
+    :param packet_filter: (PacketFilter) filter applied by the reader, adds
+    the matched counter
+    :param ipv6: (bool) packets were decoded by decode_frame(), adds the ip6
+    counter
+    :return counters: (dict) packet counters
+    """
+    if isinstance(sink, SummarySink):
+        return _summarize_packets(packets, sink, pbar, trace_count,
+                                  packet_filter, ipv6)
+    step = 100.0 / int(trace_count) if trace_count else 0.0
+    write = sink.write
+
+    # Counters
+    total_packets = 0
+    ip_packets = 0
+    non_ip4_packets = 0
+    tcp_packets = 0
+    udp_packets = 0
+    unprocessed_packets = 0
+    filtered_packets = 0
+    ip6_packets = 0
+    for ts, _, kind, proto, src, sport, dst, dport, tos, _ in packets:
+        total_packets += 1
+        if kind == PKT_TCP:
+            ip_packets += 1
+            tcp_packets += 1
+        elif kind == PKT_UDP:
+            ip_packets += 1
+            udp_packets += 1
+        elif kind == PKT_NON_IP4:
+            non_ip4_packets += 1
+            continue
+        elif kind == PKT_IP:
+            ip_packets += 1
+            continue
+        elif kind == PKT_FILTERED:
+            filtered_packets += 1
+            continue
+        elif kind == PKT_TCP_NO_PORTS:
+            # Fragmented or truncated, written without ports
+            ip_packets += 1
+            tcp_packets += 1
+            unprocessed_packets += 1
+        elif kind == PKT_UDP_NO_PORTS:
+            ip_packets += 1
+            udp_packets += 1
+            unprocessed_packets += 1
+        elif kind == PKT_IP_INVALID:
+            # No data in IP header
+            ip_packets += 1
+            unprocessed_packets += 1
+            continue
+        elif kind == PKT_TCP6:
+            ip6_packets += 1
+            tcp_packets += 1
+        elif kind == PKT_UDP6:
+            ip6_packets += 1
+            udp_packets += 1
+        elif kind == PKT_IP6:
+            ip6_packets += 1
+            continue
+        elif kind == PKT_TCP6_NO_PORTS:
+            ip6_packets += 1
+            tcp_packets += 1
+            unprocessed_packets += 1
+        elif kind == PKT_UDP6_NO_PORTS:
+            ip6_packets += 1
+            udp_packets += 1
+            unprocessed_packets += 1
+        elif kind == PKT_IP6_INVALID:
+            ip6_packets += 1
+            unprocessed_packets += 1
+            continue
+        else:
+            logging.error("error=truncated ethernet frame while "
+                          "processing ts=%s" % ts)
+            continue
+        write(ts, src, sport, dst, dport, tos)
+        # Update progress bar every 65536 packets
+        if step and not total_packets & 0xffff:
+            pbar.update(min(100.0, total_packets * step))
+    counters = {
+        "total": total_packets,
+        "ip": ip_packets,
+        "non_ip4": non_ip4_packets,
+        "tcp": tcp_packets,
+        "udp": udp_packets,
+        "unprocessed": unprocessed_packets
+    }
+    if packet_filter is not None:
+        counters["matched"] = total_packets - filtered_packets
+    if ipv6:
+        counters["ip6"] = ip6_packets
+    return counters
+
+
+def _summarize_packets(packets, sink, pbar, trace_count, packet_filter=None,
+                       ipv6=False):
+    """
+    Add packets decoded by decode_packet() to a summary instead of writing
+    them. Produces the same counters as _analyze_packets().
+    :param packets: (generator) (ts, length, kind, proto, src, sport, dst,
+    dport, tos, flags) tuples, see MmapPcapReader.packets()
+    :param sink: (SummarySink) summary to add the packets to
+    :param pbar: (ProgressBar) progress bar to update
+    :param trace_count: (int) number of packets in the trace
+    :param packet_filter: (PacketFilter) filter applied by the reader, adds
+    the matched counter
+    :param ipv6: (bool) packets were decoded by decode_frame(), adds the ip6
+    counter
+    :return counters: (dict) packet counters
+    """
+    step = 100.0 / int(trace_count) if trace_count else 0.0
+    progress = None
+    if step:
+        progress = lambda total: pbar.update(min(100.0, total * step))
+    counts = sink.add_packets(packets, progress)
+    if counts[PKT_INVALID]:
+        logging.error("error=truncated ethernet frames=%s" %
+                      counts[PKT_INVALID])
+    return _counters(counts, packet_filter, ipv6)
+
+
+def _counters(counts, packet_filter=None, ipv6=False):
+    """
+    :param counts: (list[int]) number of packets of each PKT_* kind
+    :param packet_filter: (PacketFilter) filter applied, adds the matched
+    counter
+    :param ipv6: (bool) IPv6 was decoded, adds the ip6 counter
+    :return counters: (dict) packet counters, see _analyze_packets()
+    """
+    counts = counts + [0] * (PKT_UDP6_NO_PORTS + 1 - len(counts))
+    counters = {
+        "total": sum(counts),
+        "ip": sum(counts[PKT_IP_INVALID:PKT_FILTERED]),
+        "non_ip4": counts[PKT_NON_IP4],
+        "tcp": (counts[PKT_TCP] + counts[PKT_TCP_NO_PORTS] +
+                counts[PKT_TCP6] + counts[PKT_TCP6_NO_PORTS]),
+        "udp": (counts[PKT_UDP] + counts[PKT_UDP_NO_PORTS] +
+                counts[PKT_UDP6] + counts[PKT_UDP6_NO_PORTS]),
+        "unprocessed": (counts[PKT_IP_INVALID] + counts[PKT_TCP_NO_PORTS] +
+                        counts[PKT_UDP_NO_PORTS] + counts[PKT_IP6_INVALID] +
+                        counts[PKT_TCP6_NO_PORTS] +
+                        counts[PKT_UDP6_NO_PORTS])
+    }
+    if packet_filter is not None:
+        counters["matched"] = sum(counts) - counts[PKT_FILTERED]
+    if ipv6:
+        counters["ip6"] = sum(counts[PKT_IP6_INVALID:PKT_UDP6_NO_PORTS + 1])
+    return counters
+
+
+def _analyze_mmap(source, sink, pbar, trace_count,
+                  start=PCAP_GLOBAL_HDR_LEN, end=None, packet_filter=None,
+                  ipv6=False, fragment_table=FRAGMENT_TABLE_SIZE,
+                  trackers=()):
+    """
+    Analyze a pcap file by reading header fields straight from a memory map
+    of the file. Produces the same rows and counters as _analyze_dpkt().
+    :param source: (str) path to the pcap file
+    :param sink: (CsvSink|ColumnarSink|SummarySink) output for the
+    per-packet rows, or the summary to add the packets to
+    :param pbar: (ProgressBar) progress bar to update
+    :param trace_count: (int) number of packets in the trace
+    :param start: (int) offset of the first record header to analyze
+    :param end: (int) offset to stop at (default: end of file)
+    :param packet_filter: (PacketFilter) only decode matching packets
+    :param ipv6: (bool) decode IPv6 and VLAN-tagged frames as well
+    :param fragment_table: (int) size of the FragmentTable
+    :param trackers: (list) TRACKERS to also give the packets to
+    :return counters: (dict) packet counters
+    """
+    match = packet_filter.match if packet_filter is not None else None
+    fragments = FragmentTable(fragment_table)
+    with MmapPcapReader(source) as reader:
+        packets = reader.packets(start, end, match, ipv6, fragments)
+        for tracker in trackers:
+            packets = tracker.add_packets(packets)
+        counters = _analyze_packets(packets, sink, pbar, trace_count,
+                                    packet_filter, ipv6)
+    counters["fragments"] = fragments.resolved
+    return counters
+
+
+def _analyze_stream(source, sink, pbar, trace_count, packet_filter=None,
+                    ipv6=False, fragment_table=FRAGMENT_TABLE_SIZE,
+                    trackers=()):
+    """
+    Analyze a pcap stream by reading header fields from a bounded buffer.
+    Produces the same rows and counters as _analyze_dpkt().
+    :param source: (str|file) path to the pcap file or readable file object,
+    e.g. a GunzipReader over an HTTP response
+    :param sink: (CsvSink|ColumnarSink|SummarySink) output for the
+    per-packet rows, or the summary to add the packets to
+    :param pbar: (ProgressBar) progress bar to update
+    :param trace_count: (int) number of packets in the trace
+    :param packet_filter: (PacketFilter) only decode matching packets
+    :param ipv6: (bool) decode IPv6 and VLAN-tagged frames as well
+    :param fragment_table: (int) size of the FragmentTable
+    :param trackers: (list) TRACKERS to also give the packets to
+    :return counters: (dict) packet counters
+    """
+    pcap_file = (open(source, 'rb') if isinstance(source, basestring)
+                 else source)
+    reader = StreamPcapReader(pcap_file)
+    match = packet_filter.match if packet_filter is not None else None
+    fragments = FragmentTable(fragment_table)
+    packets = reader.packets(match, ipv6, fragments)
+    for tracker in trackers:
+        packets = tracker.add_packets(packets)
+    counters = _analyze_packets(packets, sink, pbar, trace_count,
+                                packet_filter, ipv6)
+    counters["fragments"] = fragments.resolved
+    return counters
+
+
+def _analyze_numpy(source, sink, pbar, trace_count,
+                   start=PCAP_GLOBAL_HDR_LEN, end=None, packet_filter=None,
+                   fragment_table=FRAGMENT_TABLE_SIZE, trackers=()):
+    """
+    Analyze a pcap file by decoding the headers of a block of packets at a
+    time into NumPy arrays. Produces the same rows and counters as
+    _analyze_dpkt().
+    :param source: (str) path to the pcap file
+    :param sink: (CsvSink|ColumnarSink|SummarySink) output for the
+    per-packet rows, or the summary to add the packets to
+    :param pbar: (ProgressBar) progress bar to update
+    :param trace_count: (int) number of packets in the trace
+    :param start: (int) offset of the first record header to analyze
+    :param end: (int) offset to stop at (default: end of file)
+    :param packet_filter: (PacketFilter) only write matching packets. The
+    filter is applied to each decoded batch as a whole.
+    :param fragment_table: (int) size of the FragmentTable
+    :param trackers: (list) TRACKERS to also give the packets to
+    :return counters: (dict) packet counters
+    """
+    step = 100.0 / int(trace_count) if trace_count else 0.0
+    counts = [0] * (PKT_FILTERED + 1)
+    fragments = FragmentTable(fragment_table)
+    with MmapPcapReader(source) as reader:
+        scale = float(reader.divisor)
+        for packets in pcap_batch.read_batches(reader, start=start, end=end):
+            kinds = packets['kind']
+            if packet_filter is not None:
+                seconds = packets['ts_sec'] + packets['ts_frac'] / scale
+                kinds[~packet_filter.mask(packets, seconds)] = PKT_FILTERED
+            pcap_batch.resolve_fragments(packets, reader.divisor, fragments)
+            for kind, count in enumerate(
+                    pcap_batch.np.bincount(kinds,
+                                           minlength=len(counts)).tolist()):
+                counts[kind] += count
+            for ts in pcap_batch.timestamps(packets[kinds == PKT_INVALID],
+                                            reader.divisor):
+                logging.error("error=truncated ethernet frame while "
+                              "processing ts=%s" % ts)
+            for tracker in trackers:
+                tracker.add_batch(packets)
+            if isinstance(sink, SummarySink):
+                sink.add_batch(packets)
+            else:
+                # TCP and UDP packets, with or without ports
+                packets = packets[(kinds >= PKT_TCP) &
+                                  (kinds <= PKT_UDP_NO_PORTS)]
+                sink.write_batch(packets, pcap_batch.timestamps(
+                    packets, reader.divisor))
+            if step:
+                pbar.update(min(100.0, sum(counts) * step))
+    counters = _counters(counts, packet_filter)
+    counters["fragments"] = fragments.resolved
+    return counters
+
+
+# Engines available to analyze()
+ENGINES = {
+    'dpkt': _analyze_dpkt,
+    'mmap': _analyze_mmap,
+    'stream': _analyze_stream
+}
+# Engines that can read from a file object
+STREAMING_ENGINES = ('dpkt', 'stream')
+# Engines that can analyze a range of records, see analyze(n_processes)
+RANGE_ENGINES = ('mmap', 'numpy')
+# Engines that can decode IPv6 and VLAN-tagged frames, see analyze(ipv6)
+IPV6_ENGINES = ('mmap', 'stream')
+if pcap_batch is not None:
+    ENGINES['numpy'] = _analyze_numpy
+
+# Output formats available to analyze()
+OUTPUT_FORMATS = {
+    'csv': CsvSink,
+    'summary': SummarySink,
+    'summary_csv': SummaryCsvSink
+}
+if ColumnarSink is not None:
+    OUTPUT_FORMATS['columnar'] = ColumnarSink
+# Output formats that can be compressed, see analyze(compression)
+COMPRESSED_FORMATS = ('csv',)
+# Output formats that only write a summary of the trace
+SUMMARY_FORMATS = ('summary', 'summary_csv')
+# Engines that can write a summary, see analyze(output_format)
+SUMMARY_ENGINES = ('mmap', 'stream', 'numpy')
+# Statistics written next to the output, see analyze(timeseries),
+# analyze(heavy_hitters), analyze(distinct) and analyze(flows). Engines give
+# them the decoded packets.
+TRACKERS = {
+    'timeseries': Timeseries,
+    'heavy_hitters': HeavyHitters,
+    'distinct': DistinctCounts,
+    'flows': FlowTable
+}
+# Engines that can give packets to TRACKERS
+TRACKER_ENGINES = ('mmap', 'stream', 'numpy')
+
+
+def _close_sink(sink, counters):
+    """
+    Close a sink, summaries include the packet counters.
+    :param sink: (CsvSink|ColumnarSink|SummarySink) sink to close
+    :param counters: (dict) packet counters of the analyzed packets
+    """
+    if isinstance(sink, SummarySink):
+        sink.counters = counters
+    sink.close()
+
+
+def _abort_outputs(sink, trackers):
+    """
+    Close a sink and its trackers after their analysis failed, releasing
+    their files and writer threads and removing incomplete output.
+    :param sink: (CsvSink|ColumnarSink|SummarySink) sink to close
+    :param trackers: (list) TRACKERS opened for the analysis
+    """
+    # Summaries are only written by close()
+    if not isinstance(sink, SummarySink):
+        sink.abort()
+    for tracker in trackers:
+        tracker.abort()
+
+
+def _remove_output(path):
+    """
+    Remove an output file or columnar output directory, if it exists.
+    :param path: (str) path to the output
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _analyze_chunk(task):
+    """
+    Analyze a range of records of a pcap file into its own output. Runs in a
+    worker process of _analyze_parallel().
+    :param task: (tuple) (filename, start, end, engine, output_format,
+    output_file, packet_filter, ipv6, fragment_table, trackers,
+    sink_options) where packet_filter is a filter expression or None,
+    trackers a list of (name, output_file, options) of TRACKERS and
+    sink_options further arguments of the sink. Compiled filters are not
+    picklable.
+    :return counters: (dict) packet counters of the range
+    """
+    (filename, start, end, engine, output_format, output_file,
+     packet_filter, ipv6, fragment_table, trackers, sink_options) = task
+    if packet_filter is not None:
+        packet_filter = compile_filter(packet_filter)
+    options = {'ipv6': True} if ipv6 else {}
+    sink_options = dict(sink_options, **options)
+    if output_format in SUMMARY_FORMATS:
+        # Keep every port so that the summaries can be merged
+        sink_options['top_ports'] = None
+    sink = OUTPUT_FORMATS[output_format](output_file, **sink_options)
+    if trackers:
+        options['trackers'] = trackers = _open_trackers(trackers)
+    try:
+        counters = ENGINES[engine](filename, sink, None, 0, start, end,
+                                   packet_filter=packet_filter,
+                                   fragment_table=fragment_table, **options)
+    except Exception:
+        _abort_outputs(sink, trackers)
+        raise
+    _close_sink(sink, counters)
+    for tracker in trackers:
+        tracker.close()
+    return counters
+
+
+def _open_trackers(trackers):
+    """
+    :param trackers: (list[tuple]) (name, output_file, options) of TRACKERS
+    :return trackers: (list) the trackers
+    """
+    return [TRACKERS[name](output_file, **options)
+            for name, output_file, options in trackers]
+
+
+def _analyze_parallel(filename, output_file, pbar, engine, output_format,
+                      n_processes, start=PCAP_GLOBAL_HDR_LEN, end=None,
+                      packet_filter=None, ipv6=False,
+                      fragment_table=FRAGMENT_TABLE_SIZE, trackers=(),
+                      sink_options=None):
+    """
+    Split a pcap file into contiguous ranges of records, analyze each range
+    in its own process and merge the outputs. Ranges are merged in file
+    order, so the output is identical to the one of a single process, except
+    for fragments whose first fragment falls into the previous range: each
+    range tracks fragments in its own FragmentTable.
+    :param filename: (str) path to the pcap file
+    :param output_file: (str) path to the merged output
+    :param pbar: (ProgressBar) progress bar, updated as ranges complete
+    :param engine: (str) one of RANGE_ENGINES
+    :param output_format: (str) one of OUTPUT_FORMATS
+    :param n_processes: (int) number of ranges and worker processes
+    :param start: (int) offset of the first record header to analyze
+    :param end: (int) offset to stop at (default: end of file)
+    :param packet_filter: (str) filter expression, None for all packets
+    :param ipv6: (bool) decode IPv6 and VLAN-tagged frames as well
+    :param fragment_table: (int) size of the FragmentTable of each range
+    :param trackers: (list[tuple]) (name, output_file, options) of TRACKERS
+    to count in each range and merge
+    :param sink_options: (dict) further arguments of the sink of each range.
+    Compressed csv ranges are compressed in their own process and
+    concatenated.
+    :return counters: (dict) packet counters
+    """
+    # Split at indexed records if the file has a sidecar index.
+    index = load_index(filename)
+    if index is not None:
+        ranges = index.split(n_processes, start, end)
+    else:
+        with MmapPcapReader(filename) as reader:
+            ranges = reader.split(n_processes, start, end)
+    sink_options = sink_options or {}
+    tasks = [(filename, start, end, engine, output_format,
+              '%s.%03d' % (output_file, i), packet_filter, ipv6,
+              fragment_table,
+              [(name, '%s.%03d' % (tracker_file, i), options)
+               for name, tracker_file, options in trackers],
+              # Compressed ranges are concatenated with the header of the
+              # first one only
+              dict(sink_options, header=not i)
+              if 'compression' in sink_options else sink_options)
+             for i, (start, end) in enumerate(ranges)]
+    logging.info('Analyzing file=%s in chunks=%s' % (filename, len(tasks)))
+    if output_format in SUMMARY_FORMATS:
+        # Loaded once, the forked workers share the tables
+        load_labels()
+    counters = {}
+    pool = multiprocessing.Pool(min(n_processes, len(tasks)))
+    failed = True
+    try:
+        for i, chunk_counters in enumerate(pool.imap(_analyze_chunk, tasks)):
+            for key, count in chunk_counters.items():
+                counters[key] = counters.get(key, 0) + count
+            pbar.update(100.0 * (i + 1) / len(tasks))
+        failed = False
+    finally:
+        pool.close()
+        pool.join()
+        if failed:
+            # Failed ranges removed their incomplete output, remove the
+            # output of the ranges that completed
+            for task in tasks:
+                _remove_output(task[5])
+                for _, tracker_file, _ in task[9]:
+                    _remove_output(tracker_file)
+    OUTPUT_FORMATS[output_format].merge(output_file,
+                                        [task[5] for task in tasks])
+    for j, (name, tracker_file, _) in enumerate(trackers):
+        TRACKERS[name].merge(tracker_file, [task[9][j][1] for task in tasks])
+    return counters
+
+
+def analyze(filename=None, output_dir=None, trace_count=0, engine='dpkt',
+            output_format='csv', fileobj=None, n_processes=1,
+            time_window=None, packet_filter=None, ipv6=False,
+            fragment_table=FRAGMENT_TABLE_SIZE, timeseries=None,
+            trace_time=None, heavy_hitters=None,
+            sketch_error=(EPSILON, DELTA), distinct=None, flows=None,
+            flow_timeouts=(IDLE_TIMEOUT, ACTIVE_TIMEOUT), compression=None,
+            compression_level=None, columnar_compress=True):
+    """
+    Analyze a pcap file and write a row per TCP/UDP packet, or a summary.
+    :param filename: (str) path to the pcap file
+    :param output_dir: (str) directory for the results file
+    :param trace_count: (int) number of packets in the trace (progress bar)
+    :param engine: (str) packet decoding engine, one of ENGINES. 'dpkt'
+    decodes full packet objects, 'mmap' reads header fields straight from a
+    memory map of the file, 'stream' reads them from a bounded buffer,
+    'numpy' decodes blocks of packets into NumPy arrays (requires numpy). All
+    engines produce identical results.
+    :param output_format: (str) one of OUTPUT_FORMATS. 'csv' writes a text
+    row per packet, 'columnar' writes chunks of typed columns (requires
+    numpy), see columnar.py. 'summary' and 'summary_csv' write no
+    rows, only per-protocol packet and byte counts, TOS/DSCP, port and size
+    histograms and the counters of the trace as JSON or section,key,value
+    rows, see summary.py. They require one of SUMMARY_ENGINES.
+    :param fileobj: (file) read the pcap data from this file object instead
+    of filename, e.g. open_stream(url). filename then only names the output.
+    Requires one of STREAMING_ENGINES.
+    :param n_processes: (int) split the file into this many ranges of records
+    and analyze them in parallel processes. Requires one of RANGE_ENGINES.
+    Runs in a single process inside daemonic processes, e.g. the workers of
+    a process Pipeline, since those can not start processes.
+    :param time_window: (tuple) (start, end) timestamps. Only analyze the
+    records captured from start until before end, located with the sidecar
+    index of the file (built if missing), see pcap_index.clock_window().
+    Requires one of RANGE_ENGINES.
+    :param packet_filter: (str) filter expression, e.g. 'udp and port 53',
+    see pcap_filter.py. Packets it rejects are not decoded or written and
+    only count towards the total. Adds the matched counter.
+    :param ipv6: (bool) also decode IPv6, including extension headers, and
+    IPv4/IPv6 behind VLAN tags. Adds the ip6 counter and an address family
+    column to the output. non_ip4 then counts frames that are neither IPv4
+    nor IPv6. Requires one of IPV6_ENGINES, can not be combined with
+    packet_filter, which only reads untagged IPv4 frames.
+    :param fragment_table: (int) number of fragmented IPv4 datagrams tracked
+    at once so that non-first fragments are written with the ports of their
+    first fragment, 0 to write them without ports. Fragments given ports are
+    not counted as unprocessed, the fragments counter counts them. With a
+    packet_filter, only first fragments that pass it are tracked.
+    :param timeseries: (int) also count packets, bytes, TCP and UDP packets
+    and DSCP classes per interval of this many seconds, e.g. 1, 10 or 60,
+    into a csv file next to the output, see timeseries.py. Requires one of
+    TRACKER_ENGINES. Adds the timeseries result.
+    :param trace_time: (tuple) (start, end) timestamps of the trace, e.g.
+    the StartTime and EndTime scraped by get_trace_info_from_page(). Sizes
+    the timeseries, which otherwise starts at the first packet and grows as
+    needed.
+    :param heavy_hitters: (int) also track the most frequent source and
+    destination addresses, destination ports and flows in fixed-size
+    sketches and write this many of each with the sketches to a JSON file
+    next to the output, see heavy_hitters.py. Requires one of
+    TRACKER_ENGINES. Adds the heavy_hitters result.
+    :param sketch_error: (tuple) (epsilon, delta) of the heavy hitter
+    sketches. Counts are at most epsilon times the number of packets too
+    high, Count-Min estimates with probability 1 - delta.
+    :param distinct: (int|bool) also estimate the number of distinct source
+    and destination addresses, destination ports and flows with
+    HyperLogLogs of 2**distinct registers each, True for PRECISION (4 KB,
+    about 1.6% error), and write them to a JSON file next to the output, see
+    distinct.py. Requires one of TRACKER_ENGINES. Adds the distinct result.
+    :param flows: (int|bool) also aggregate the IP packets into flows in a
+    table of this many flows, True for FLOW_TABLE_SIZE, and write a
+    NetFlow-like csv row per flow next to the output, see flows.py. When the
+    table is full the flow closest to timing out is exported early. Requires
+    one of TRACKER_ENGINES. Adds the flows result.
+    :param flow_timeouts: (tuple) (idle, active) timeouts of the flows in
+    seconds of capture time
+    :param compression: (str) compress the output while it is written, with
+    one of CODECS: 'gzip', 'bz2' or 'lzma' (requires Python 3 or
+    backports.lzma), see compression.py. Rows are compressed in a
+    background thread, overlapping with the decoding of the packets, and
+    written out once, e.g. to <name>.csv.gz. The compression ratio and the
+    time spent waiting for the compression are logged. Requires one of
+    COMPRESSED_FORMATS.
+    :param compression_level: (int) compression level of the codec, None for
+    its default
+    :param columnar_compress: (bool) write the 'columnar' chunks as
+    compressed .npz archives, or False as a plain .npy file per column that
+    downstream jobs can memory-map, see columnar.read_chunks()
+    :return results: (dict) output file and packet counters
+    """
     # Check if its a dump file
     # if filename is None or filename[-5:].lower() != '.dump':
     #     print('Invalid file. Expecting .dump')
     #     return
+    if engine not in ENGINES:
+        logging.error('Unknown engine=%s. Expecting one of %s' %
+                      (engine, ', '.join(sorted(ENGINES))))
+        return None
+    if fileobj is not None and engine not in STREAMING_ENGINES:
+        logging.error('engine=%s can not read from a file object. Expecting '
+                      'one of %s' % (engine, ', '.join(STREAMING_ENGINES)))
+        return None
+    if output_format not in OUTPUT_FORMATS:
+        logging.error('Unknown output_format=%s. Expecting one of %s' %
+                      (output_format, ', '.join(sorted(OUTPUT_FORMATS))))
+        return None
+    if output_format in SUMMARY_FORMATS and engine not in SUMMARY_ENGINES:
+        logging.error('output_format=%s requires one of %s' %
+                      (output_format, ', '.join(SUMMARY_ENGINES)))
+        return None
+    if n_processes > 1 and (fileobj is not None or
+                            engine not in RANGE_ENGINES):
+        logging.error('n_processes=%s requires a file and one of %s' %
+                      (n_processes, ', '.join(RANGE_ENGINES)))
+        return None
+    if time_window is not None and (fileobj is not None or
+                                    engine not in RANGE_ENGINES):
+        logging.error('time_window requires a file and one of %s' %
+                      ', '.join(RANGE_ENGINES))
+        return None
+    if ipv6 and (engine not in IPV6_ENGINES or packet_filter is not None):
+        logging.error('ipv6 requires one of %s and no packet_filter' %
+                      ', '.join(IPV6_ENGINES))
+        return None
+    if fragment_table < 0:
+        logging.error('Invalid fragment_table=%s' % fragment_table)
+        return None
+    if distinct is True:
+        distinct = PRECISION
+    if flows is True:
+        flows = FLOW_TABLE_SIZE
+    if (timeseries is not None or heavy_hitters is not None or
+            distinct or flows) and engine not in TRACKER_ENGINES:
+        logging.error('timeseries, heavy_hitters, distinct and flows require '
+                      'one of %s' % ', '.join(TRACKER_ENGINES))
+        return None
+    if timeseries is not None and (int(timeseries) != timeseries or
+                                   timeseries < 1):
+        logging.error('Invalid timeseries=%s. Expecting a whole number of '
+                      'seconds' % timeseries)
+        return None
+    if heavy_hitters is not None and (heavy_hitters < 1 or not
+                                      all(0 < bound < 1
+                                          for bound in sketch_error)):
+        logging.error('Invalid heavy_hitters=%s sketch_error=%s' %
+                      (heavy_hitters, sketch_error))
+        return None
+    if distinct and not MIN_PRECISION <= distinct <= MAX_PRECISION:
+        logging.error('Invalid distinct=%s. Expecting %s-%s' %
+                      (distinct, MIN_PRECISION, MAX_PRECISION))
+        return None
+    if flows and (flows < 1 or not all(timeout > 0
+                                       for timeout in flow_timeouts)):
+        logging.error('Invalid flows=%s flow_timeouts=%s' %
+                      (flows, flow_timeouts))
+        return None
+    if compression is not None and (compression not in CODECS or
+                                    output_format not in COMPRESSED_FORMATS):
+        logging.error('compression=%s requires one of %s and one of %s' %
+                      (compression, ', '.join(sorted(CODECS)),
+                       ', '.join(COMPRESSED_FORMATS)))
+        return None
+    if compression_level is not None and (
+            compression is None or
+            compression_level not in CODECS[compression][3]):
+        logging.error('Invalid compression_level=%s for compression=%s' %
+                      (compression_level, compression))
+        return None
+    compiled_filter = None
+    if packet_filter is not None:
+        try:
+            compiled_filter = compile_filter(packet_filter)
+        except ValueError as el1:
+            logging.error('Unable to compile packet_filter=%s. Error=%s' %
+                          (packet_filter, el1))
+            return None
+    if n_processes > 1 and multiprocessing.current_process().daemon:
+        logging.info('Analyzing file=%s in a single process inside a '
+                     'daemonic process' % filename)
+        n_processes = 1
+    sink_class = OUTPUT_FORMATS[output_format]
+    extension = sink_class.extension + codec_extension(compression)
     if output_dir is not None:
         output_file = os.path.join(output_dir,
                                    os.path.basename(filename).split('.')[0]+
-                                   '.csv')
+                                   extension)
     else:
-        output_file = os.path.basename(filename).split('.')[0] + '.csv'
+        output_file = (os.path.basename(filename).split('.')[0] +
+                       extension)
+    output_name = output_file[:-len(extension)]
     try:
-        # Open file
-        pcap_file = open(filename, 'rb')
-        captures = dpkt.pcap.Reader(pcap_file)
-
-        results = open(output_file, 'w')
-        # Write headers
-        results.write('timestamp,source_ip,source_port,destination_ip,'
-                      'destination_port,dscp,tos\n')
-
         # Initialize progress bar
-        bar = "["
-        percent = 0.0
         widgets = ['Progress: ', Percentage(), ' ',
                    Bar(marker=RotatingMarker()), ' ', ETA(), ' ',
                    FileTransferSpeed()]
         pbar = ProgressBar(widgets=widgets, maxval=100).start()
 
-        # Counters
-        total_packets = 0
-        ip_packets = 0
-        non_ip4_packets = 0
-        tcp_packets = 0
-        udp_packets = 0
-        unprocessed_packets = 0
-        # Process each packet.
-        for ts, buff in captures:
+        # Byte range of the records to analyze, all if empty
+        records = ()
+        if time_window is not None:
+            index = open_index(filename)
+            with MmapPcapReader(filename) as reader:
+                records = index.time_range(reader, *time_window)
+            logging.info('Analyzing bytes=%s-%s of file=%s' %
+                         (records + (filename,)))
+        # (name, output_file, options) of TRACKERS
+        trackers = []
+        if timeseries is not None:
+            series_start, series_end = time_window or trace_time or (None,
+                                                                    None)
+            if series_start is None and fileobj is None:
+                # Start at the first record, so that ranges analyzed in
+                # parallel share their buckets.
+                with MmapPcapReader(filename) as reader:
+                    for ts, _, _, _ in reader.records(*records):
+                        series_start = int(ts)
+                        break
+            trackers.append(('timeseries',
+                             output_name + Timeseries.extension,
+                             {'interval': timeseries, 'start': series_start,
+                              'end': series_end}))
+        if heavy_hitters is not None:
+            trackers.append(('heavy_hitters',
+                             output_name + HeavyHitters.extension,
+                             {'k': heavy_hitters,
+                              'epsilon': sketch_error[0],
+                              'delta': sketch_error[1]}))
+        if distinct:
+            trackers.append(('distinct',
+                             output_name + DistinctCounts.extension,
+                             {'precision': distinct}))
+        if flows:
+            divisor = 1E6
+            if fileobj is None:
+                # Timestamps of the batches of the numpy engine
+                with MmapPcapReader(filename) as reader:
+                    divisor = float(reader.divisor)
+            trackers.append(('flows', output_name + FlowTable.extension,
+                             {'size': flows,
+                              'idle_timeout': flow_timeouts[0],
+                              'active_timeout': flow_timeouts[1],
+                              'divisor': divisor}))
+        sink_options = {}
+        if compression is not None:
+            sink_options = {'compression': compression,
+                            'level': compression_level}
+        if output_format == 'columnar' and not columnar_compress:
+            sink_options = {'compress': False}
+        if n_processes > 1:
+            counters = _analyze_parallel(filename, output_file, pbar, engine,
+                                         output_format, n_processes,
+                                         *records,
+                                         packet_filter=packet_filter,
+                                         ipv6=ipv6,
+                                         fragment_table=fragment_table,
+                                         trackers=trackers,
+                                         sink_options=sink_options)
+        else:
+            # Only pass ipv6 to the engines and sinks that support it
+            options = {'ipv6': True} if ipv6 else {}
+            sink = sink_class(output_file, **dict(sink_options, **options))
+            engine_options = dict(options)
+            if trackers:
+                engine_options['trackers'] = _open_trackers(trackers)
             try:
-                total_packets += 1
-                # Get source and destination mac addresses
-                eth = dpkt.ethernet.Ethernet(buff)
-                if eth.type != dpkt.ethernet.ETH_TYPE_IP:
-                    # Skip if packet is not IP
-                    non_ip4_packets += 1
-                    continue
-
-                # Get source and destination IP addresses
-                ip = eth.data
-                ip_packets += 1
-                # Get port numbers
-                if ip.p == dpkt.ip.IP_PROTO_TCP:
-                    # TCP packet
-                    tcp_packets += 1
-                    results.write(','.join([str(i)
-                                            for i in [ts,
-                                                      socket.inet_ntoa(ip.src),
-                                                      ip.data.sport,
-                                                      socket.inet_ntoa(ip.dst),
-                                                      ip.data.dport,
-                                                      extract_dscp(ip.tos),
-                                                      ip.tos]]) + '\n')
-                elif ip.p == dpkt.ip.IP_PROTO_UDP:
-                    # UDP packet
-                    udp_packets += 1
-                    results.write(','.join([str(i)
-                                            for i in [ts,
-                                                      socket.inet_ntoa(ip.src),
-                                                      ip.data.sport,
-                                                      socket.inet_ntoa(ip.dst),
-                                                      ip.data.dport,
-                                                      extract_dscp(ip.tos),
-                                                      ip.tos]]) + '\n')
-                else:
-                    # Skip un-required packets
-                    pass
-                # Update progress bar
-                percent += 100.0/trace_count
-                pbar.update(percent)
-            except AttributeError:
-                # In case UDP datagram is empty. Case in fragmented packets.
-                unprocessed_packets += 1
-                try:
-                    results.write(','.join([str(i)
-                                            for i in [ts,
-                                                      socket.inet_ntoa(ip.src),
-                                                      0,
-                                                      socket.inet_ntoa(ip.dst),
-                                                      0,
-                                                      extract_dscp(ip.tos),
-                                                      ip.tos]]) + '\n')
-                except AttributeError:
-                    # No data in IP header
-                    pass
-                percent += 100.0/trace_count
-                pbar.update(percent)
-            except Exception as el2:
-                logging.error("error=%s while processing ts=%s" % (el2, ts))
-                pass
+                counters = ENGINES[engine](
+                    filename if fileobj is None else fileobj, sink, pbar,
+                    trace_count, *records, packet_filter=compiled_filter,
+                    fragment_table=fragment_table, **engine_options)
+            except Exception:
+                # Stop the writer thread of compressed output and remove
+                # the incomplete files
+                _abort_outputs(sink, engine_options.get('trackers', ()))
+                raise
+            _close_sink(sink, counters)
+            for tracker in engine_options.get('trackers', ()):
+                tracker.close()
+        for name, tracker_file, _ in trackers:
+            counters[name] = tracker_file
         pbar.finish()
-        results.close()
         logging.info('file=%s analysis completed' % filename)
-        return {
+        counters.update({
             "file": filename,
-            "output": output_file,
-            "total": total_packets,
-            "ip": ip_packets,
-            "non_ip4": non_ip4_packets,
-            "tcp": tcp_packets,
-            "udp": udp_packets,
-            "unprocessed": unprocessed_packets
-        }
+            "output": output_file
+        })
+        return counters
     except ImportError as el1:
         logging.error('Unable to analyze file=%s. Error=%s' % (filename, el1))
         return None
@@ -162,21 +940,47 @@ def find_dirname_from_level(dir_path=None, level=0):
     return '-'.join(dir_path.split('/')[-level-1:])
 
 
-def scrap_links(webpage, url_directory=None):
+def _scrap_dump_rows(body):
+    """
+    Extract the link to the dump file and its packet counts from a trace page.
+    :param body: (str) the trace page
+    :return rows: (list[list[str]]) [file_link, total, ip, tcp, udp] of the
+    stats table, empty if the page has no link to a dump file or no table
+    """
+    page = parse_page(body)
+    file_link = None
+    for link in page.links:
+        if '.gz' in link:
+            file_link = link
+    if file_link is None or page.pre is None:
+        # We suppose that there is going to be only 1 link for
+        # downloadable dump file.
+        return []
+    a = page.pre
+    total = re.split(r'\s+', a[a.find('total'):])[1].split(' ')[0]
+    ip = re.split(r'\s+', a[a.find('ip'):])[1].split(' ')[0]
+    tcp = re.split(r'\s+', a[a.find('tcp'):])[1].split(' ')[0]
+    udp = re.split(r'\s+', a[a.find('udp'):])[1].split(' ')[0]
+    return [[file_link, total, ip, tcp, udp]]
+
+
+def scrap_links(webpage, url_directory=None, crawler=None):
     """
     This function scraps links to all dump files from the current and child web
-    pages.
+    pages. Child pages are fetched concurrently and written in the order of
+    their links.
     :param webpage: (str) URL for scrapping links from
     :param url_directory: (str) path to directory where the files containing
     the urls must be stored.
+    :param crawler: (Crawler) crawler to fetch the pages with
     :return urls: (list[str]) List of links scrapped from URL
     """
+    f = None
     try:
         logging.info('Processing webpage=%s. Extracting links to dump files' %
                      webpage)
-        page = urllib2.urlopen(webpage)
-        soup = BeautifulSoup(page)
-        count = 0
+        crawler = crawler or Crawler()
+        links = parse_page(crawler.fetch(webpage)).links
         url_directory = url_directory or os.getcwd()
         scrapped_links_fp = os.path.join(url_directory,
                                          find_dirname_from_level(webpage,
@@ -185,49 +989,53 @@ def scrap_links(webpage, url_directory=None):
         f = open(scrapped_links_fp, 'w')
         # Write headers
         f.write('url,total,ip,tcp,udp\n')
-        for link in soup.findAll('a'):
+        child_links = [os.path.join(webpage, link) for link in links]
+        rows = []
+
+        def write_rows(child_link, body, error):
             try:
-                child_link = os.path.join(webpage, link.get('href'))
-                soup = BeautifulSoup(urllib2.urlopen(child_link))
-                file_link = None
-                for l in soup.findAll('a'):
-                    if '.gz' in l.get('href'):
-                        file_link = l.get('href')
-                if file_link is None:
-                    # We suppose that there is going to be only 1 link for
-                    # downloadable dump file.
-                    continue
-                for a in soup.findAll('pre')[-1]:
-                    total = re.split(r'\s+',
-                                     a[a.find('total'):])[1].split(' ')[0]
-                    ip = re.split(r'\s+', a[a.find('ip'):])[1].split(' ')[0]
-                    tcp = re.split(r'\s+', a[a.find('tcp'):])[1].split(' ')[0]
-                    udp = re.split(r'\s+', a[a.find('udp'):])[1].split(' ')[0]
-                    f.write(','.join([i for i in [file_link, total, ip, tcp,
-                                                  udp]])+'\n')
-                count += 1
+                if error is not None:
+                    raise error
+                for row in _scrap_dump_rows(body):
+                    f.write(','.join(row) + '\n')
+                    rows.append(row)
             except Exception as el2:
-                logging.info('Error=%s while processing link=%s.' % (el2, link))
-                pass
-        logging.info('%s links extracted from %s' % (count, webpage))
+                logging.info('Error=%s while processing link=%s.' %
+                             (el2, child_link))
+
+        crawler.crawl(child_links, write_rows)
+        logging.info('%s links extracted from %s' % (len(rows), webpage))
         f.close()
         return scrapped_links_fp
     except Exception as el1:
         logging.info('Unable to get links from webpage=%s. Error=%s' %
                      (webpage, el1))
-        f.close()
+        if f is not None:
+            f.close()
         return None
 
 
-def download_file(file_link, download_dir=None):
+def download_file(file_link, download_dir=None, filesize=None):
+    """
+    Download a file with the shared downloader of the process. Connections
+    are reused, partial downloads resumed and large files fetched in parallel
+    segments.
+    :param file_link: (str) URL of the file
+    :param download_dir: (str) directory to download to (default: cwd)
+    :param filesize: (str|float) FileSize in MB scraped from the trace page.
+    The downloaded size is checked against it if given.
+    :return downloaded_fp: (str) path to the downloaded file, None on error
+    """
     try:
         # if download_dir not specified.
         download_dir = download_dir or os.getcwd()
         logging.info('Downloading file=%s' % file_link)
         downloaded_fp = os.path.join(download_dir, os.path.basename(file_link))
-        f = open(downloaded_fp, 'wb')
-        f.write(urllib2.urlopen(file_link).read())
-        f.close()
+        expected_size, tolerance = (scraped_size(filesize)
+                                    if filesize is not None else (None, 0))
+        get_downloader().fetch(file_link, downloaded_fp,
+                               expected_size=expected_size,
+                               tolerance=tolerance)
         logging.info('Successfully downloaded file=%s' % file_link)
         return downloaded_fp
     except Exception as el1:
@@ -235,6 +1043,17 @@ def download_file(file_link, download_dir=None):
         return None
 
 
+def open_stream(file_link):
+    """
+    Open a .gz dump file for streaming. Data is downloaded and decompressed
+    as it is read, nothing is written to disk.
+    :param file_link: (str) URL of the .gz dump file
+    :return stream: (GunzipReader) file object with the decompressed data
+    """
+    logging.info('Streaming file=%s' % file_link)
+    return GunzipReader(urllib2.urlopen(file_link))
+
+
 def extract_file(file_path, extracted_dir=None):
     try:
         import gzip
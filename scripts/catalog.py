@@ -0,0 +1,309 @@
+"""
+Local catalog of MAWI traces.
+
+Loads what the scrapers write into a SQLite database:
+- the trace information of get_all_stats() (trace_results csv)
+- the per-protocol tables of the trace pages (results/<page>/<id>.csv)
+- the links to the dump files with their packet counts (urls/*.csv)
+
+The fields used to select work are indexed, so that e.g. all traces of 2007
+over 5 GB with more than 1% of IPv6 packets are one query away:
+
+    TraceCatalog('catalog.db').select(year=2007, min_filesize=5000,
+                                      min_ipv6_share=0.01)
+
+links() returns such a selection as the (url, trace_count) tuples taken by
+scrap_links.process_links().
+"""
+import os
+import csv
+import time
+import sqlite3
+import logging
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS traces (
+    id TEXT PRIMARY KEY,
+    dumpfile TEXT,
+    filesize REAL,
+    starttime INTEGER,
+    endtime INTEGER,
+    year INTEGER,
+    total_time REAL,
+    cap_size REAL,
+    cap_length INTEGER,
+    packets INTEGER,
+    avg_rate REAL,
+    avg_rate_stddev REAL,
+    flows INTEGER,
+    ipv4_packets INTEGER,
+    ipv6_packets INTEGER,
+    ipv6_share REAL
+);
+CREATE INDEX IF NOT EXISTS traces_year ON traces (year, filesize);
+CREATE INDEX IF NOT EXISTS traces_starttime ON traces (starttime);
+CREATE INDEX IF NOT EXISTS traces_filesize ON traces (filesize);
+CREATE INDEX IF NOT EXISTS traces_dumpfile ON traces (dumpfile);
+CREATE TABLE IF NOT EXISTS protocols (
+    trace_id TEXT NOT NULL,
+    protocol TEXT NOT NULL,
+    packets INTEGER,
+    bytes INTEGER,
+    bytes_per_packet REAL,
+    PRIMARY KEY (trace_id, protocol)
+);
+CREATE INDEX IF NOT EXISTS protocols_protocol ON protocols (protocol);
+CREATE TABLE IF NOT EXISTS dumps (
+    dumpfile TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    total INTEGER,
+    ip INTEGER,
+    tcp INTEGER,
+    udp INTEGER
+);
+'''
+# Columns of the trace_results csv in the order of get_all_stats(), and their
+# types. Values missing from a row are NULL.
+_TRACE_COLUMNS = (('dumpfile', str), ('filesize', float), ('id', str),
+                  ('starttime', int), ('endtime', int),
+                  ('total_time', float), ('cap_size', float),
+                  ('cap_length', int), ('packets', int), ('avg_rate', float),
+                  ('avg_rate_stddev', float), ('flows', int),
+                  ('ipv4_packets', int), ('ipv6_packets', int))
+_PROTOCOL_TYPES = (int, int, float)
+_DUMP_TYPES = (int, int, int, int)
+# IPv6 share from the trace information, or from the protocol table
+_IPV6_SHARE = '''
+UPDATE traces SET ipv6_share = COALESCE(
+    CAST(ipv6_packets AS REAL) / NULLIF(packets, 0),
+    (SELECT CAST(ip6.packets AS REAL) / NULLIF(total.packets, 0)
+     FROM protocols AS ip6, protocols AS total
+     WHERE ip6.trace_id = traces.id AND ip6.protocol = 'ip6' AND
+           total.trace_id = traces.id AND total.protocol = 'total'))
+'''
+# Filters of select(): criterion to (SQL condition, parameter conversion)
+_CRITERIA = {
+    'year': ('t.year = ?', int),
+    'start': ('t.starttime >= ?', int),
+    'end': ('t.starttime < ?', int),
+    'min_filesize': ('t.filesize >= ?', float),
+    'max_filesize': ('t.filesize <= ?', float),
+    'min_packets': ('t.packets >= ?', int),
+    'max_packets': ('t.packets <= ?', int),
+    'min_ipv6_share': ('t.ipv6_share >= ?', float),
+    'max_ipv6_share': ('t.ipv6_share <= ?', float),
+}
+_SELECT = ('SELECT t.*, d.url, d.total, d.ip, d.tcp, d.udp FROM traces AS t '
+           'LEFT JOIN dumps AS d ON d.dumpfile = t.dumpfile')
+
+
+def _convert(text, kind):
+    """
+    :return value: text converted to kind, None if empty or invalid
+    """
+    text = text.strip()
+    if not text or kind is str:
+        return text or None
+    try:
+        return kind(text)
+    except ValueError:
+        pass
+    try:
+        # e.g. '5538813.0'
+        return kind(float(text))
+    except ValueError:
+        return None
+
+
+class TraceCatalog(object):
+    """
+    SQLite backed catalog of traces keyed by trace id.
+    """
+    def __init__(self, path):
+        """
+        :param path: (str) path to the SQLite database, created if missing
+        """
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.executescript(_SCHEMA)
+
+    def load_trace_results(self, results_file):
+        """
+        Add or replace the traces of a trace_results csv of get_all_stats().
+        :param results_file: (str) path to the csv file
+        :return count: (int) number of traces loaded
+        """
+        rows = []
+        with open(results_file, 'rb') as f:
+            reader = csv.reader(f)
+            next(reader, None)     # Skip headers
+            for values in reader:
+                trace = dict((name, None) for name, _ in _TRACE_COLUMNS)
+                for (name, kind), value in zip(_TRACE_COLUMNS, values):
+                    trace[name] = _convert(value, kind)
+                if trace['id'] is None:
+                    continue
+                if trace['starttime'] is not None:
+                    # Start times are the wall clock time of the page
+                    trace['year'] = time.gmtime(trace['starttime']).tm_year
+                else:
+                    trace['year'] = None
+                rows.append(trace)
+        if rows:
+            names = sorted(rows[0])
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO traces (%s) VALUES (%s)' %
+                    (', '.join(names), ', '.join('?' * len(names))),
+                    [[row[name] for name in names] for row in rows])
+        logging.info('%s traces loaded from file=%s' %
+                     (len(rows), results_file))
+        return len(rows)
+
+    def load_protocols(self, results_dir):
+        """
+        Add or replace the per-protocol tables written by get_stats_from_page()
+        or scrap_pages(), one <trace id>.csv file per trace in the
+        subdirectories of results_dir.
+        :param results_dir: (str) directory of the tables
+        :return count: (int) number of tables loaded
+        """
+        rows = []
+        count = 0
+        for dirpath, _, filenames in os.walk(results_dir):
+            for filename in sorted(filenames):
+                if not filename.endswith('.csv'):
+                    continue
+                trace_id = filename[:-len('.csv')]
+                with open(os.path.join(dirpath, filename), 'rb') as f:
+                    for values in csv.reader(f):
+                        if len(values) < 4:
+                            continue
+                        numbers = [_convert(value, kind) for value, kind in
+                                   zip(values[1:4], _PROTOCOL_TYPES)]
+                        # Skip headers
+                        if numbers[0] is None:
+                            continue
+                        rows.append([trace_id, values[0]] + numbers)
+                count += 1
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO protocols (trace_id, protocol, '
+                'packets, bytes, bytes_per_packet) VALUES (?, ?, ?, ?, ?)',
+                rows)
+        logging.info('%s protocol tables loaded from dir=%s' %
+                     (count, results_dir))
+        return count
+
+    def load_links(self, url_directory):
+        """
+        Add or replace the links to dump files of scrap_links() or
+        scrap_pages(), the csv files in url_directory.
+        :param url_directory: (str) directory of the csv files
+        :return count: (int) number of links loaded
+        """
+        rows = []
+        for filename in sorted(os.listdir(url_directory)):
+            if not filename.endswith('.csv'):
+                continue
+            with open(os.path.join(url_directory, filename), 'rb') as f:
+                reader = csv.reader(f)
+                next(reader, None)     # Skip headers
+                for values in reader:
+                    if len(values) < 5 or not values[0]:
+                        continue
+                    rows.append([os.path.basename(values[0]), values[0]] +
+                                [_convert(value, kind) for value, kind in
+                                 zip(values[1:5], _DUMP_TYPES)])
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO dumps (dumpfile, url, total, ip, tcp, '
+                'udp) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        logging.info('%s links loaded from dir=%s' % (len(rows), url_directory))
+        return len(rows)
+
+    def update_shares(self):
+        """
+        Compute the IPv6 share of every trace, after loading traces or
+        protocol tables.
+        """
+        with self._db:
+            self._db.execute(_IPV6_SHARE)
+
+    def select(self, order='starttime', limit=None, **criteria):
+        """
+        Select traces.
+        :param order: (str) column to sort by, '-' prefixed for descending
+        order
+        :param limit: (int) maximum number of traces
+        :param criteria: filters, any of year, start and end (starttime in
+        seconds, end excluded), min_filesize and max_filesize (MB),
+        min_packets and max_packets, min_ipv6_share and max_ipv6_share
+        (fraction of the packets)
+        :return traces: (list[dict]) columns of the traces, with the url and
+        packet counts of their dump file if known
+        """
+        conditions = []
+        params = []
+        for name, value in sorted(criteria.items()):
+            if name not in _CRITERIA:
+                raise ValueError('Invalid criterion=%s' % name)
+            if value is None:
+                continue
+            condition, kind = _CRITERIA[name]
+            conditions.append(condition)
+            params.append(kind(value))
+        column = order.lstrip('-')
+        if column not in [name for name, _ in _TRACE_COLUMNS] + ['year']:
+            raise ValueError('Invalid order=%s' % order)
+        query = _SELECT
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY t.%s %s, t.id' % (
+            column, 'DESC' if order.startswith('-') else 'ASC')
+        if limit is not None:
+            query += ' LIMIT %d' % int(limit)
+        return [dict(row) for row in self._db.execute(query, params)]
+
+    def links(self, **criteria):
+        """
+        Select traces with a known dump file, see select().
+        :param criteria: select() arguments
+        :return links: (list[tuple]) (url, trace_count) of every dump file,
+        the input of scrap_links.process_links()
+        """
+        links = []
+        for trace in self.select(**criteria):
+            if trace['url'] is None:
+                continue
+            count = trace['total'] if trace['total'] is not None else \
+                trace['packets']
+            links.append((trace['url'], count))
+        return links
+
+    def close(self):
+        self._db.close()
+
+
+def build_catalog(path, results_file=None, results_dir=None,
+                  url_directory=None):
+    """
+    Load the outputs of the scrapers into a catalog. Loading them again
+    replaces the rows of the same traces.
+    :param path: (str) path to the SQLite database
+    :param results_file: (str) trace_results csv of get_all_stats()
+    :param results_dir: (str) directory of the per-protocol tables
+    :param url_directory: (str) directory of the links to dump files
+    :return catalog: (TraceCatalog) the catalog
+    """
+    catalog = TraceCatalog(path)
+    if results_file is not None:
+        catalog.load_trace_results(results_file)
+    if results_dir is not None:
+        catalog.load_protocols(results_dir)
+    if url_directory is not None:
+        catalog.load_links(url_directory)
+    catalog.update_shares()
+    return catalog
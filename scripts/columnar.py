@@ -0,0 +1,273 @@
+"""
+Columnar binary output for analyze().
+
+Rows are stored as typed columns in a directory of chunks plus a manifest:
+
+    <name>.cols/manifest.json
+    <name>.cols/chunk-000000.npz           (compress=True)
+    <name>.cols/chunk-000000.<column>.npy  (compress=False)
+
+Compressed chunks are zlib-compressed .npz archives. Uncompressed chunks are
+plain .npy files that downstream jobs can memory-map with read_chunks().
+"""
+import os
+import json
+import array
+import struct
+
+import numpy as np
+
+# Rows per chunk
+CHUNK_SIZE = 1 << 20
+
+# Column name, numpy dtype and array typecode used while buffering rows.
+COLUMNS = (
+    ('ts', 'f8', 'd'),
+    ('src', 'u4', 'I'),
+    ('sport', 'u2', 'H'),
+    ('dst', 'u4', 'I'),
+    ('dport', 'u2', 'H'),
+    ('tos', 'u1', 'B')
+)
+# Columns with the address family, see ColumnarSink(ipv6=True). Addresses
+# are 16 bytes, IPv4 addresses are stored IPv4-mapped (::ffff:a.b.c.d).
+COLUMNS_AF = (
+    ('ts', 'f8', 'd'),
+    ('af', 'u1', 'B'),
+    ('src', 'V16', 'B'),
+    ('sport', 'u2', 'H'),
+    ('dst', 'V16', 'B'),
+    ('dport', 'u2', 'H'),
+    ('tos', 'u1', 'B')
+)
+MANIFEST = 'manifest.json'
+
+_unpack_ip = struct.Struct('!I').unpack
+_IP4_MAPPED = b'\x00' * 10 + b'\xff\xff'
+
+
+class ColumnarSink(object):
+    """
+    Buffers rows into typed columns and writes them out a chunk at a time.
+    """
+    extension = '.cols'
+
+    def __init__(self, output_dir, chunk_size=CHUNK_SIZE, compress=True,
+                 ipv6=False):
+        """
+        :param output_dir: (str) directory to write the chunks to
+        :param chunk_size: (int) number of rows per chunk
+        :param compress: (bool) compress chunks. Uncompressed chunks can be
+        memory-mapped by readers.
+        :param ipv6: (bool) accept 16-byte IPv6 addresses as well, writes
+        COLUMNS_AF instead of COLUMNS
+        """
+        self.output = output_dir
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.columns = COLUMNS_AF if ipv6 else COLUMNS
+        if ipv6:
+            self.write = self._write_af
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self._chunks = []
+        self._reset()
+
+    def _reset(self):
+        self._buffers = [array.array(typecode)
+                         for _, _, typecode in self.columns]
+        if self.columns is COLUMNS_AF:
+            (self._ts, self._af, self._src, self._sport, self._dst,
+             self._dport, self._tos) = [
+                b.fromstring if dtype == 'V16' else b.append
+                for (_, dtype, _), b in zip(self.columns, self._buffers)]
+        else:
+            (self._ts, self._src, self._sport, self._dst, self._dport,
+             self._tos) = [b.append for b in self._buffers]
+        self._pending = 0
+
+    def write(self, ts, src, sport, dst, dport, tos):
+        """
+        Write one packet.
+        :param ts: (float) packet timestamp
+        :param src: (str) source IP address in packed form
+        :param sport: (int) source port
+        :param dst: (str) destination IP address in packed form
+        :param dport: (int) destination port
+        :param tos: (int) TOS byte from IP header
+        """
+        self._ts(float(ts))
+        self._src(_unpack_ip(src)[0])
+        self._sport(sport)
+        self._dst(_unpack_ip(dst)[0])
+        self._dport(dport)
+        self._tos(tos)
+        self._pending += 1
+        if self._pending >= self.chunk_size:
+            self._flush()
+
+    def _write_af(self, ts, src, sport, dst, dport, tos):
+        if len(src) == 4:
+            self._af(4)
+            self._src(_IP4_MAPPED + src)
+            self._dst(_IP4_MAPPED + dst)
+        else:
+            self._af(6)
+            self._src(src)
+            self._dst(dst)
+        self._ts(float(ts))
+        self._sport(sport)
+        self._dport(dport)
+        self._tos(tos)
+        self._pending += 1
+        if self._pending >= self.chunk_size:
+            self._flush()
+
+    def write_batch(self, packets, ts):
+        """
+        Write a batch of packets decoded by pcap_batch.
+        :param packets: (numpy.ndarray) array of pcap_batch.PACKET_DTYPE
+        :param ts: (list) packet timestamps, see pcap_batch.timestamps()
+        """
+        self._flush()
+        ts = np.array(ts, dtype=np.float64)
+        for i in range(0, len(packets), self.chunk_size):
+            rows = packets[i:i + self.chunk_size]
+            columns = {'ts': ts[i:i + self.chunk_size]}
+            for name, dtype, _ in COLUMNS[1:]:
+                columns[name] = rows[name].astype(dtype)
+            self._write_chunk(columns)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        self._write_chunk(dict(
+            (name, np.frombuffer(buff, dtype=dtype))
+            for (name, dtype, _), buff in zip(self.columns, self._buffers)))
+        self._reset()
+
+    def _write_chunk(self, columns):
+        name = 'chunk-%06d' % len(self._chunks)
+        if self.compress:
+            np.savez_compressed(os.path.join(self.output, name + '.npz'),
+                                **columns)
+        else:
+            for column, values in columns.items():
+                np.save(os.path.join(self.output,
+                                     '%s.%s.npy' % (name, column)), values)
+        self._chunks.append({"name": name, "rows": len(columns['ts'])})
+
+    def close(self):
+        self._flush()
+        _write_manifest(self.output, [[name, dtype]
+                                      for name, dtype, _ in self.columns],
+                        self._chunks, self.compress)
+
+    def abort(self):
+        """
+        Remove the chunks written so far and the manifest of an earlier
+        output in the directory after a failed analysis.
+        """
+        self._reset()
+        names = set(chunk["name"] for chunk in self._chunks)
+        for fname in os.listdir(self.output):
+            if fname.split('.', 1)[0] in names or fname == MANIFEST:
+                os.remove(os.path.join(self.output, fname))
+        del self._chunks[:]
+        try:
+            os.rmdir(self.output)
+        except OSError:
+            # Other files in the directory
+            pass
+
+    @classmethod
+    def merge(cls, output_dir, parts):
+        """
+        Move the chunks of directories written by ColumnarSink into one
+        directory and remove them. Chunks are renumbered, not rewritten.
+        :param output_dir: (str) directory for the merged output
+        :param parts: (list[str]) directories written by ColumnarSink, in
+        order. All must have the same columns and compression.
+        """
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        chunks = []
+        columns = [[name, dtype] for name, dtype, _ in COLUMNS]
+        compress = True
+        for part in parts:
+            manifest = read_manifest(part)
+            columns = manifest["columns"]
+            compress = manifest["compressed"]
+            for chunk in manifest["chunks"]:
+                name = 'chunk-%06d' % len(chunks)
+                for fname in os.listdir(part):
+                    if fname.startswith(chunk["name"] + '.'):
+                        os.rename(os.path.join(part, fname),
+                                  os.path.join(output_dir, name +
+                                               fname[len(chunk["name"]):]))
+                chunks.append({"name": name, "rows": chunk["rows"]})
+            os.remove(os.path.join(part, MANIFEST))
+            os.rmdir(part)
+        _write_manifest(output_dir, columns, chunks, compress)
+
+
+def _write_manifest(output_dir, columns, chunks, compress):
+    manifest = {
+        "columns": columns,
+        "compressed": compress,
+        "rows": sum(chunk["rows"] for chunk in chunks),
+        "chunks": chunks
+    }
+    # Write the manifest last so a complete one marks finished output.
+    tmp_file = os.path.join(output_dir, MANIFEST + '.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(tmp_file, os.path.join(output_dir, MANIFEST))
+
+
+def read_manifest(output_dir):
+    """
+    :param output_dir: (str) directory written by ColumnarSink
+    :return manifest: (dict) columns, chunks and row count of the output
+    """
+    with open(os.path.join(output_dir, MANIFEST), 'r') as f:
+        return json.load(f)
+
+
+def read_chunks(output_dir, columns=None, mmap=True):
+    """
+    Read columnar output chunk by chunk.
+    :param output_dir: (str) directory written by ColumnarSink
+    :param columns: (list[str]) columns to read (default: all)
+    :param mmap: (bool) memory-map uncompressed chunks instead of reading them
+    :return: generator of dicts mapping column names to numpy arrays
+    """
+    manifest = read_manifest(output_dir)
+    columns = columns or [name for name, _ in manifest["columns"]]
+    for chunk in manifest["chunks"]:
+        path = os.path.join(output_dir, chunk["name"])
+        if manifest["compressed"]:
+            archive = np.load(path + '.npz')
+            values = dict((name, archive[name]) for name in columns)
+            archive.close()
+            yield values
+        else:
+            yield dict((name, np.load('%s.%s.npy' % (path, name),
+                                      mmap_mode='r' if mmap else None))
+                       for name in columns)
+
+
+def read_columns(output_dir, columns=None):
+    """
+    Read columnar output into one array per column.
+    :param output_dir: (str) directory written by ColumnarSink
+    :param columns: (list[str]) columns to read (default: all)
+    :return columns: (dict) column name to numpy array
+    """
+    manifest = read_manifest(output_dir)
+    columns = columns or [name for name, _ in manifest["columns"]]
+    dtypes = dict(manifest["columns"])
+    chunks = list(read_chunks(output_dir, columns, mmap=False))
+    return dict((name, np.concatenate([c[name] for c in chunks])
+                 if chunks else np.zeros(0, dtype=dtypes[name]))
+                for name in columns)
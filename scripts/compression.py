@@ -0,0 +1,234 @@
+"""
+Compressed output files for analyze().
+
+CompressedWriter is a file object that compresses the rows of a sink on the
+fly. Rows are buffered into blocks of BLOCK_SIZE bytes and handed to a
+background thread through a bounded queue; the thread compresses the blocks
+and writes them out. zlib, bz2 and lzma release the GIL while compressing, so
+encoding overlaps with packet parsing, and the rows are written to disk only
+once, compressed. When the queue is full the sink waits for the thread, which
+bounds the memory used.
+
+Codecs, their file extension and compression levels:
+
+    gzip  .gz   0-9, default 6
+    bz2   .bz2  1-9, default 9
+    lzma  .xz   0-9, default 6  (Python 3 lzma or backports.lzma)
+
+Files are written under a .part name and renamed when closed, so that they
+only appear under their final name once complete. Concatenated files of the
+same codec are valid multi-stream files, see CsvSink.merge().
+"""
+import os
+import bz2
+import time
+import zlib
+import logging
+import threading
+from Queue import Queue
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # lzma is not part of the Python 2 standard library
+        lzma = None
+
+# Bytes of rows handed to the writer thread at once
+BLOCK_SIZE = 1 << 20
+# Blocks waiting to be compressed. Bounds the memory used to about
+# (QUEUE_SIZE + 2) * BLOCK_SIZE.
+QUEUE_SIZE = 8
+
+
+def _gzip(level):
+    # gzip header and trailer around a deflate stream
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _lzma(level):
+    return lzma.LZMACompressor(preset=level)
+
+
+# Codecs available to CompressedWriter: name to (extension, compressor
+# factory taking a level, default level, valid levels)
+CODECS = {
+    'gzip': ('.gz', _gzip, 6, range(10)),
+    'bz2': ('.bz2', bz2.BZ2Compressor, 9, range(1, 10))
+}
+if lzma is not None:
+    CODECS['lzma'] = ('.xz', _lzma, 6, range(10))
+
+
+def codec_extension(codec):
+    """
+    :param codec: (str) one of CODECS, None for no compression
+    :return extension: (str) file extension of the codec, '' for None
+    """
+    if codec is None:
+        return ''
+    return CODECS[codec][0]
+
+
+def file_codec(path):
+    """
+    :param path: (str) path to a file
+    :return codec: (str) codec of CODECS matching the extension of the file,
+    None if it matches none
+    """
+    for codec, (extension, _, _, _) in CODECS.items():
+        if path.endswith(extension):
+            return codec
+    return None
+
+
+class CompressedWriter(object):
+    """
+    Write-only file object compressing in a background thread.
+    """
+    def __init__(self, output_file, codec='gzip', level=None,
+                 block_size=BLOCK_SIZE, queue_size=QUEUE_SIZE):
+        """
+        :param output_file: (str) path to the compressed file
+        :param codec: (str) one of CODECS
+        :param level: (int) compression level of the codec, None for its
+        default level
+        :param block_size: (int) bytes of rows compressed at once
+        :param queue_size: (int) blocks waiting to be compressed
+        """
+        if codec not in CODECS:
+            raise ValueError('Unknown codec=%s. Expecting one of %s' %
+                             (codec, ', '.join(sorted(CODECS))))
+        _, compressor, default_level, levels = CODECS[codec]
+        if level is None:
+            level = default_level
+        if level not in levels:
+            raise ValueError('Invalid level=%s for codec=%s' % (level, codec))
+        self.output = output_file
+        self.codec = codec
+        self.level = level
+        self.block_size = block_size
+        # Bytes written to the writer and written to disk
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Seconds the sink waited for a free slot in the queue, i.e. for the
+        # thread to catch up, and seconds the thread spent writing to disk
+        self.blocked = 0.0
+        self.io_time = 0.0
+        self._part = output_file + '.part'
+        self._file = open(self._part, 'wb')
+        self._compressor = compressor(level)
+        self._buffer = []
+        self._size = 0
+        self._error = None
+        self._queue = Queue(queue_size)
+        self._thread = threading.Thread(target=self._run)
+        # Do not keep the interpreter alive if the writer is never closed
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def ratio(self):
+        """
+        :return ratio: (float) bytes written to the writer per byte written to
+        disk, 0 before close()
+        """
+        return self.bytes_in / float(self.bytes_out) if self.bytes_out else 0.0
+
+    def write(self, data):
+        """
+        :param data: (str) rows to write
+        """
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self.block_size:
+            self._put()
+
+    def writelines(self, lines):
+        """
+        :param lines: (iterable[str]) rows to write
+        """
+        self.write(''.join(lines))
+
+    def _put(self):
+        """
+        Hand the buffered rows to the writer thread, waiting for a free slot
+        in the queue.
+        """
+        if self._error is not None:
+            raise self._error
+        block = ''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        self.bytes_in += len(block)
+        t0 = time.time()
+        self._queue.put(block)
+        self.blocked += time.time() - t0
+
+    def _run(self):
+        """
+        Compress and write the blocks of the queue until None.
+        """
+        compressor = self._compressor
+        write = self._file.write
+        block = ''
+        try:
+            while block is not None:
+                block = self._queue.get()
+                if block is None:
+                    data = compressor.flush()
+                else:
+                    data = compressor.compress(block)
+                if data:
+                    t0 = time.time()
+                    write(data)
+                    self.io_time += time.time() - t0
+                    self.bytes_out += len(data)
+        except Exception as el1:
+            self._error = el1
+            # Drain the queue so that the sink never waits for a free slot
+            while block is not None:
+                block = self._queue.get()
+
+    def abort(self):
+        """
+        Stop the writer thread without writing the remaining rows and remove
+        the incomplete file, e.g. when the analysis failed.
+        """
+        if self._thread is None:
+            return
+        self._buffer = []
+        self._size = 0
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        try:
+            os.remove(self._part)
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Write the remaining rows, wait for the writer thread and rename the
+        file to its final name.
+        """
+        if self._thread is None:
+            return
+        if self._buffer and self._error is None:
+            self._put()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        if self._error is not None:
+            os.remove(self._part)
+            raise self._error
+        os.rename(self._part, self.output)
+        logging.info('Compressed file=%s codec=%s level=%s bytes=%s to '
+                     'bytes=%s ratio=%.2f blocked_seconds=%.3f '
+                     'io_seconds=%.3f' %
+                     (self.output, self.codec, self.level, self.bytes_in,
+                      self.bytes_out, self.ratio, self.blocked, self.io_time))
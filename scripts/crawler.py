@@ -0,0 +1,148 @@
+"""
+Concurrent page crawler for scrap_links().
+
+Fetches pages from a pool of threads over the kept-alive connections of
+downloader.ConnectionPool instead of one blocking urlopen() after the other.
+At most PER_HOST requests per host are in flight, failed requests are retried
+after a delay doubled on every attempt, and pages are handed to the caller in
+the order of their URLs as soon as they and the pages before them arrived.
+With a PageCache, cached pages are revalidated with conditional requests and
+only downloaded again when they changed.
+"""
+import time
+import socket
+import httplib
+import logging
+import threading
+import multiprocessing.dummy
+
+from downloader import get_downloader
+
+# Requests in flight per host
+PER_HOST = 8
+# Attempts per page before giving up
+MAX_RETRIES = 4
+# Seconds to wait before the first retry, doubled on every further retry
+RETRY_DELAY = 1
+
+
+class CrawlError(Exception):
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Crawler(object):
+    """
+    Fetches pages concurrently over a shared pool of kept-alive connections.
+    """
+    def __init__(self, pool=None, per_host=PER_HOST, max_retries=MAX_RETRIES,
+                 retry_delay=RETRY_DELAY, cache=None):
+        """
+        :param pool: (ConnectionPool) connections to reuse (default: the pool
+        of the downloader of the process)
+        :param per_host: (int) requests in flight per host
+        :param max_retries: (int) attempts per page
+        :param retry_delay: (float) seconds before the first retry
+        :param cache: (PageCache) cache of the pages, None to download every
+        page
+        """
+        self.pool = pool or get_downloader().pool
+        self.per_host = per_host
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.cache = cache
+        # Pages served from the cache
+        self.cached = 0
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, url):
+        host = url.split('/')[2] if '://' in url else ''
+        with self._lock:
+            limit = self._limits.get(host)
+            if limit is None:
+                limit = self._limits[host] = threading.Semaphore(
+                    self.per_host)
+        return limit
+
+    def _hit(self):
+        with self._lock:
+            self.cached += 1
+
+    def fetch(self, url):
+        """
+        Fetch a page, retrying failed requests. A cached page is only
+        downloaded again if it changed, and never in offline mode.
+        :param url: (str) URL of the page
+        :return body: (str) the page
+        """
+        cache = self.cache
+        cached, headers = None, {}
+        if cache is not None:
+            cached, headers = cache.validators(url)
+            if cache.offline:
+                if cached is None:
+                    raise CrawlError('Offline and url=%s is not cached' % url)
+                self._hit()
+                return cached
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            try:
+                with self._limit(url):
+                    response, release = self.pool.request('GET', url, headers)
+                    body = response.read()
+                    release()
+                if response.status == 304 and cached is not None:
+                    self._hit()
+                    return cached
+                if response.status != 200:
+                    raise CrawlError('HTTP status=%s for url=%s' %
+                                     (response.status, url), response.status)
+                if cache is not None:
+                    cache.put(url, body, response.getheader('etag'),
+                              response.getheader('last-modified'))
+                return body
+            except (CrawlError, httplib.HTTPException, socket.error) as el1:
+                attempt += 1
+                status = getattr(el1, 'status', None)
+                # Client errors are not retried
+                if attempt >= self.max_retries or \
+                        (status is not None and 400 <= status < 500):
+                    raise
+                logging.info('Retrying url=%s in seconds=%s. Error=%s' %
+                             (url, delay, el1))
+                time.sleep(delay)
+                delay *= 2
+
+    def _fetch(self, url):
+        try:
+            return url, self.fetch(url), None
+        except Exception as el1:
+            return url, None, el1
+
+    def crawl(self, urls, handle):
+        """
+        Fetch pages and hand them over in the order of urls.
+        :param urls: (list[str]) URLs of the pages
+        :param handle: (function) called with (url, body, error) of every
+        page, error None, or body None and the exception after the last
+        attempt
+        :return count: (int) number of pages fetched
+        """
+        urls = list(urls)
+        if not urls:
+            return 0
+        hosts = len(set(url.split('/')[2] for url in urls if '://' in url))
+        threads = multiprocessing.dummy.Pool(
+            min(len(urls), self.per_host * max(1, hosts)))
+        count = 0
+        try:
+            for url, body, error in threads.imap(self._fetch, urls):
+                count += error is None
+                handle(url, body, error)
+        finally:
+            threads.close()
+            threads.join()
+        return count
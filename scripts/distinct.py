@@ -0,0 +1,307 @@
+"""
+Distinct counts for analyze().
+
+Estimates the number of distinct source addresses, destination addresses,
+destination ports and flows (proto,src,sport,dst,dport) of a trace with a
+HyperLogLog of 2**precision one-byte registers per dimension, 4 KB and a
+standard error of about 1.6% at the default precision of 12.
+
+Keys are hashed with the same 64-bit mix whether they were decoded by
+decode_packet() or by pcap_batch, so HyperLogLogs of any engine, of the
+ranges of a trace analyzed in parallel and of any number of traces can be
+combined, see DistinctCounts.merge().
+"""
+import os
+import math
+import json
+import base64
+import struct
+
+from pcap_mmap import *
+
+try:
+    import numpy as np
+except ImportError:
+    # Only required for DistinctCounts.add_batch()
+    np = None
+
+PRECISION = 12
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+# Packets whose keys are collected before they are hashed
+FLUSH_SIZE = 1 << 16
+DIMENSIONS = ('src', 'dst', 'dport', 'flow')
+
+_MASK = (1 << 64) - 1
+_unpack_ip4 = struct.Struct('!I').unpack
+_unpack_ip6 = struct.Struct('!QQ').unpack
+
+
+def _mix(z):
+    """
+    SplitMix64 finalizer of a 64-bit integer.
+    """
+    z = (z + 0x9E3779B97F4A7C15) & _MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+    return z ^ (z >> 31)
+
+
+def _hash_address(address):
+    if len(address) == 4:
+        return _mix(_unpack_ip4(address)[0])
+    high, low = _unpack_ip6(address)
+    return _mix(_mix(high) ^ low)
+
+
+def _hash_flow(flow):
+    proto, src, sport, dst, dport = flow
+    h = _mix(_hash_address(src) ^ ((proto << 32) | (sport << 16) | dport))
+    return _mix(h ^ _hash_address(dst))
+
+
+# Hashes of the keys of packets decoded by decode_packet()
+_HASHES = {'src': _hash_address, 'dst': _hash_address, 'dport': _mix,
+           'flow': _hash_flow}
+
+
+def _mix_array(z):
+    """
+    _mix() of a numpy.uint64 array.
+    """
+    u = np.uint64
+    z = z + u(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> u(30))) * u(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> u(27))) * u(0x94D049BB133111EB)
+    return z ^ (z >> u(31))
+
+
+def _bit_length_array(w):
+    """
+    int.bit_length() of a numpy.uint64 array.
+    """
+    # The exponents of floats are exact for 32-bit halves.
+    high = np.frexp((w >> np.uint64(32)).astype(np.float64))[1]
+    low = np.frexp((w & np.uint64(0xffffffff)).astype(np.float64))[1]
+    return np.where(high > 0, high + 32, low)
+
+
+class HyperLogLog(object):
+    """
+    Distinct count estimate of the 64-bit hashes added.
+    """
+    def __init__(self, precision=PRECISION, registers=None):
+        """
+        :param precision: (int) log2 of the number of registers, the standard
+        error is 1.04 / sqrt(2**precision)
+        :param registers: (bytearray) registers to start from
+        """
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError('Invalid precision=%s. Expecting %s-%s' %
+                             (precision, MIN_PRECISION, MAX_PRECISION))
+        self.precision = precision
+        size = 1 << precision
+        self.registers = (registers if registers is not None
+                          else bytearray(size))
+
+    def add_hashes(self, hashes):
+        """
+        :param hashes: (iterable) 64-bit hashes of keys
+        """
+        registers = self.registers
+        precision = self.precision
+        index_mask = (1 << precision) - 1
+        # Rank of the first 1-bit of the remaining 64 - precision bits
+        rank_base = 64 - precision + 1
+        for h in hashes:
+            index = h & index_mask
+            rank = rank_base - (h >> precision).bit_length()
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def add_hash_array(self, hashes):
+        """
+        :param hashes: (numpy.ndarray) numpy.uint64 hashes of keys
+        """
+        if not len(hashes):
+            return
+        precision = self.precision
+        index = (hashes & np.uint64((1 << precision) - 1)).astype(np.intp)
+        rank = (64 - precision + 1 -
+                _bit_length_array(hashes >> np.uint64(precision)))
+        registers = np.frombuffer(self.registers, dtype=np.uint8)
+        np.maximum.at(registers, index, rank.astype(np.uint8))
+
+    def count(self):
+        """
+        :return count: (int) estimated number of distinct hashes added
+        """
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -register
+                                             for register in self.registers)
+        zeros = self.registers.count(b'\x00')
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting for small cardinalities
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+    def combine(self, other):
+        """
+        Add the hashes of another HyperLogLog of the same precision.
+        :param other: (HyperLogLog) distinct counts of other packets
+        """
+        if other.precision != self.precision:
+            raise ValueError('can not combine precision=%s and precision=%s'
+                             % (self.precision, other.precision))
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+
+class DistinctCounts(object):
+    """
+    Distinct counts of a trace, written as JSON with the registers that
+    produced them.
+    """
+    extension = '.distinct.json'
+
+    def __init__(self, output_file, precision=PRECISION):
+        """
+        :param output_file: (str) path to the JSON file
+        :param precision: (int) HyperLogLog precision, 4-16
+        """
+        self.output = output_file
+        self.counters = dict((name, HyperLogLog(precision))
+                             for name in DIMENSIONS)
+        self._buffers = dict((name, set()) for name in DIMENSIONS)
+
+    def add_packets(self, packets):
+        """
+        Collect the keys of decoded packets while passing them on.
+        :param packets: (generator) (ts, length, kind, proto, src, sport, dst,
+        dport, tos, flags) tuples, see MmapPcapReader.packets()
+        :return: generator of the same tuples
+        """
+        has_ip = KIND_HAS_IP
+        has_ports = KIND_HAS_PORTS
+        # Cleared in place by _flush()
+        buffers = self._buffers
+        add_src = buffers['src'].add
+        add_dst = buffers['dst'].add
+        add_port = buffers['dport'].add
+        add_flow = buffers['flow'].add
+        pending = 0
+        try:
+            for packet in packets:
+                kind = packet[2]
+                if has_ip[kind]:
+                    add_src(packet[4])
+                    add_dst(packet[6])
+                    if has_ports[kind]:
+                        add_port(packet[7])
+                        add_flow(packet[3:8])
+                    pending += 1
+                    if pending >= FLUSH_SIZE:
+                        self._flush()
+                        pending = 0
+                yield packet
+        finally:
+            self._flush()
+
+    def _flush(self):
+        for name in DIMENSIONS:
+            keys = self._buffers[name]
+            if keys:
+                self.counters[name].add_hashes(map(_HASHES[name], keys))
+                keys.clear()
+
+    def add_batch(self, packets):
+        """
+        Add a batch of packets decoded by pcap_batch.
+        :param packets: (numpy.ndarray) array of pcap_batch.PACKET_DTYPE
+        """
+        kinds = packets['kind']
+        ip = packets[has_ip4(kinds)]
+        flows = packets[(kinds == PKT_TCP) | (kinds == PKT_UDP)]
+        src = _mix_array(ip['src'].astype(np.uint64))
+        dst = _mix_array(ip['dst'].astype(np.uint64))
+        ports = ((flows['proto'].astype(np.uint64) << np.uint64(32)) |
+                 (flows['sport'].astype(np.uint64) << np.uint64(16)) |
+                 flows['dport'].astype(np.uint64))
+        flow = _mix_array(_mix_array(
+            _mix_array(flows['src'].astype(np.uint64)) ^ ports) ^
+            _mix_array(flows['dst'].astype(np.uint64)))
+        for name, hashes in (
+                ('src', src), ('dst', dst),
+                ('dport', _mix_array(flows['dport'].astype(np.uint64))),
+                ('flow', flow)):
+            self.counters[name].add_hash_array(hashes)
+
+    def count(self, name):
+        """
+        :param name: (str) one of DIMENSIONS
+        :return count: (int) estimated number of distinct keys
+        """
+        return self.counters[name].count()
+
+    def combine(self, other):
+        """
+        Add the keys of other packets.
+        :param other: (DistinctCounts) distinct counts of the same precision
+        """
+        for name in DIMENSIONS:
+            self.counters[name].combine(other.counters[name])
+
+    def close(self):
+        self._flush()
+        state = {
+            "precision": self.counters['src'].precision,
+            "counts": dict((name, self.count(name)) for name in DIMENSIONS),
+            "registers": dict(
+                (name, base64.b64encode(bytes(self.counters[name].registers)))
+                for name in DIMENSIONS)
+        }
+        tmp_file = self.output + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.rename(tmp_file, self.output)
+
+    def abort(self):
+        """
+        Drop the registers after a failed analysis. Nothing is written before
+        close().
+        """
+
+    @classmethod
+    def read(cls, output_file):
+        """
+        :param output_file: (str) path to a file written by this class
+        :return distinct: (DistinctCounts) distinct counts with the registers
+        of the file
+        """
+        with open(output_file, 'r') as f:
+            state = json.load(f)
+        distinct = cls(output_file, state['precision'])
+        for name in DIMENSIONS:
+            distinct.counters[name] = HyperLogLog(
+                state['precision'],
+                bytearray(base64.b64decode(state['registers'][name])))
+        return distinct
+
+    @classmethod
+    def merge(cls, output_file, parts, remove=True):
+        """
+        Combine files written by DistinctCounts into one, e.g. the ranges of
+        a trace or a year of traces.
+        :param output_file: (str) path to the merged file
+        :param parts: (list[str]) paths to the files, all with the same
+        precision
+        :param remove: (bool) remove the parts
+        """
+        merged = cls.read(parts[0])
+        for part in parts[1:]:
+            merged.combine(cls.read(part))
+        if remove:
+            for part in parts:
+                os.remove(part)
+        merged.output = output_file
+        merged.close()
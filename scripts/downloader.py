@@ -0,0 +1,387 @@
+"""
+HTTP download engine for dump files.
+
+Keeps persistent connections per archive host, resumes partial downloads with
+Range requests and fetches large files as several byte ranges in parallel.
+Data is written to <file>.part and only renamed to its final name once its
+size has been verified. The progress of segmented downloads is kept in
+<file>.part.json so that they resume where each segment stopped.
+"""
+import os
+import json
+import time
+import socket
+import httplib
+import logging
+import urlparse
+import threading
+
+# Bytes read from a response at a time
+CHUNK_SIZE = 1 << 20
+# Number of parallel byte ranges for large files
+SEGMENTS = 4
+# Files smaller than this are fetched as a single stream
+SEGMENT_MIN_SIZE = 64 << 20
+# Attempts per stream or segment before giving up
+MAX_RETRIES = 5
+# Seconds to wait before the first retry, doubled on every further retry
+RETRY_DELAY = 1
+# Socket timeout in seconds
+TIMEOUT = 60
+MAX_REDIRECTS = 5
+# Bytes of progress between saves of the segment state, and bytes a segment
+# writes between syncs of the part file
+STATE_INTERVAL = 16 << 20
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class DownloadError(Exception):
+    pass
+
+
+def scraped_size(filesize):
+    """
+    Expected size of a dump file from the FileSize scraped from its trace page
+    (megabytes with two decimals). Pages do not say whether a megabyte is 10^6
+    or 2^20 bytes, so the tolerance covers both readings.
+    :param filesize: (str|float) scraped file size in MB
+    :return (expected_size, tolerance): (int, int) in bytes
+    """
+    mb = float(filesize)
+    low = (mb - 0.005) * 10 ** 6
+    high = (mb + 0.005) * 2 ** 20
+    return int((low + high) / 2), int((high - low) / 2) + 1
+
+
+def _sync(f):
+    """
+    Write the buffered data of a file to disk.
+    :param f: (file) file open for writing
+    """
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class ConnectionPool(object):
+    """
+    Idle HTTP connections kept open per host for reuse.
+    """
+    def __init__(self, timeout=TIMEOUT):
+        """
+        :param timeout: (int) socket timeout in seconds
+        """
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, key):
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _get(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _put(self, key, conn, response):
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def request(self, method, url, headers=None):
+        """
+        Send a request, following redirects.
+        :param method: (str) HTTP method
+        :param url: (str) URL to request
+        :param headers: (dict) request headers
+        :return (response, release): (httplib.HTTPResponse, function) response
+        and a function returning its connection to the pool. Call release()
+        after reading the whole body, or close the response instead.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            conn, reused = self._get(key)
+            try:
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                # The server closed the idle connection, use a new one.
+                conn = self._connect(key)
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+            if response.status in _REDIRECTS:
+                location = response.getheader('location')
+                response.read()
+                self._put(key, conn, response)
+                url = urlparse.urljoin(url, location)
+                continue
+            return response, (lambda k=key, c=conn, r=response:
+                              self._put(k, c, r))
+        raise DownloadError('Too many redirects for url=%s' % url)
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+
+class Downloader(object):
+    """
+    Resumable, segmented downloads over a shared connection pool.
+    """
+    def __init__(self, pool=None, segments=SEGMENTS,
+                 segment_min_size=SEGMENT_MIN_SIZE, chunk_size=CHUNK_SIZE,
+                 max_retries=MAX_RETRIES):
+        """
+        :param pool: (ConnectionPool) connections to reuse
+        :param segments: (int) number of parallel byte ranges for large files
+        :param segment_min_size: (int) minimum file size for segmenting
+        :param chunk_size: (int) bytes read from a response at a time
+        :param max_retries: (int) attempts per stream or segment
+        """
+        self.pool = pool or ConnectionPool()
+        self.segments = segments
+        self.segment_min_size = segment_min_size
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+
+    def probe(self, url):
+        """
+        :param url: (str) URL of the file
+        :return (size, ranges): (int, bool) size of the file, None if unknown,
+        and whether the server accepts Range requests
+        """
+        response, release = self.pool.request('HEAD', url)
+        response.read()
+        release()
+        if response.status != 200:
+            raise DownloadError('HTTP status=%s for url=%s' %
+                                (response.status, url))
+        size = response.getheader('content-length')
+        ranges = response.getheader('accept-ranges', '').lower() == 'bytes'
+        return (int(size) if size is not None else None), ranges
+
+    def _fetch_range(self, url, part, start, end=None, progress=None):
+        """
+        Write bytes start to end (inclusive) of url at the same offsets in
+        part. Without end, reads to the end of the file. Bytes are only
+        reported to progress once synced to disk, so that a saved segment
+        state never counts data lost in a crash.
+        :return written: (int) number of bytes written
+        """
+        headers = {}
+        if start or end is not None:
+            headers['Range'] = 'bytes=%s-%s' % (start, '' if end is None
+                                                else end)
+        response, release = self.pool.request('GET', url, headers)
+        if response.status not in (200, 206) or \
+                (start and response.status != 206):
+            response.close()
+            raise DownloadError('HTTP status=%s for url=%s range=%s' %
+                                (response.status, url, headers.get('Range')))
+        remaining = None if end is None else end - start + 1
+        written = 0
+        pending = 0
+        with open(part, 'r+b') as f:
+            f.seek(start)
+            while remaining is None or remaining > 0:
+                size = self.chunk_size if remaining is None \
+                    else min(self.chunk_size, remaining)
+                data = response.read(size)
+                if not data:
+                    break
+                f.write(data)
+                written += len(data)
+                pending += len(data)
+                if remaining is not None:
+                    remaining -= len(data)
+                if progress is not None and pending >= STATE_INTERVAL:
+                    _sync(f)
+                    progress(pending)
+                    pending = 0
+            if progress is not None and pending:
+                _sync(f)
+                progress(pending)
+        if remaining:
+            response.close()
+            raise DownloadError('Connection dropped with bytes=%s left' %
+                                remaining)
+        release()
+        return written
+
+    def _retry(self, func, position, description):
+        """
+        Call func until it succeeds, waiting longer after every failure. The
+        retries start over whenever an attempt made progress.
+        :param func: (function) attempt to make
+        :param position: (function) returns the number of bytes done so far
+        :param description: (str) what is retried, for the log
+        """
+        delay = RETRY_DELAY
+        attempt = 0
+        done = position()
+        while True:
+            try:
+                return func()
+            except (DownloadError, httplib.HTTPException, socket.error,
+                    IOError) as el1:
+                if position() > done:
+                    done = position()
+                    attempt, delay = 0, RETRY_DELAY
+                attempt += 1
+                if attempt >= self.max_retries:
+                    raise
+                logging.info('Retrying %s in seconds=%s. Error=%s' %
+                             (description, delay, el1))
+                time.sleep(delay)
+                delay *= 2
+
+    def _fetch_stream(self, url, part, size, ranges):
+        """
+        Download as a single stream, resuming a partial file if possible.
+        """
+        def position():
+            return os.path.getsize(part) if os.path.exists(part) else 0
+
+        def attempt():
+            done = position()
+            if not ranges or (size is not None and done > size):
+                done = 0
+            if size is not None and done == size:
+                return
+            if done:
+                logging.info('Resuming url=%s at byte=%s' % (url, done))
+            with open(part, 'r+b' if done else 'wb') as f:
+                f.truncate(done)
+            self._fetch_range(url, part, done)
+            if size is not None and os.path.getsize(part) != size:
+                raise DownloadError('Incomplete download of url=%s' % url)
+        self._retry(attempt, position, 'url=%s' % url)
+
+    def _fetch_segments(self, url, part, size):
+        """
+        Download as parallel byte ranges, resuming the ranges recorded in the
+        segment state file.
+        """
+        state_file = part + '.json'
+        state = None
+        if os.path.exists(part) and os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+            if state['size'] != size:
+                state = None
+        if state is None:
+            step = -(-size // self.segments)
+            state = {
+                "size": size,
+                "segments": [[start, min(start + step, size) - 1, 0]
+                             for start in range(0, size, step)]
+            }
+            with open(part, 'wb') as f:
+                f.truncate(size)
+        else:
+            logging.info('Resuming segmented download of url=%s' % url)
+        lock = threading.Lock()
+        saved = [0]
+
+        def save(force=False):
+            with lock:
+                progress = sum(s[2] for s in state["segments"])
+                if not force and progress - saved[0] < STATE_INTERVAL:
+                    return
+                saved[0] = progress
+                with open(state_file + '.tmp', 'w') as f:
+                    json.dump(state, f)
+                os.rename(state_file + '.tmp', state_file)
+
+        def fetch(segment):
+            def progress(count):
+                segment[2] += count
+                save()
+
+            def attempt():
+                start, end, done = segment
+                if start + done <= end:
+                    self._fetch_range(url, part, start + done, end, progress)
+            self._retry(attempt, lambda: segment[2], 'url=%s range=%s-%s' %
+                        (url, segment[0], segment[1]))
+
+        errors = []
+
+        def run(segment):
+            try:
+                fetch(segment)
+            except Exception as el1:
+                errors.append(el1)
+
+        threads = [threading.Thread(target=run, args=(segment,))
+                   for segment in state["segments"]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        save(force=True)
+        if errors:
+            raise errors[0]
+        if any(start + done <= end for start, end, done in state["segments"]):
+            raise DownloadError('Incomplete download of url=%s' % url)
+        os.remove(state_file)
+
+    def fetch(self, url, path, expected_size=None, tolerance=0):
+        """
+        Download url to path.
+        :param url: (str) URL of the file
+        :param path: (str) destination path
+        :param expected_size: (int) expected size in bytes, e.g. from
+        scraped_size(). Not checked if None.
+        :param tolerance: (int) allowed difference to expected_size in bytes
+        :return path: (str) destination path
+        """
+        part = path + '.part'
+        size, ranges = self.probe(url)
+        if size is not None and ranges and self.segments > 1 and \
+                size >= self.segment_min_size:
+            self._fetch_segments(url, part, size)
+        else:
+            self._fetch_stream(url, part, size, ranges)
+        actual = os.path.getsize(part)
+        if size is not None and actual != size:
+            raise DownloadError('Downloaded bytes=%s of %s for url=%s' %
+                                (actual, size, url))
+        if expected_size is not None and \
+                abs(actual - expected_size) > tolerance:
+            raise DownloadError('Downloaded bytes=%s, expected %s for url=%s'
+                                % (actual, expected_size, url))
+        os.rename(part, path)
+        return path
+
+
+# Downloader of the current process, reused for all downloads
+_downloader = None
+
+
+def get_downloader():
+    """
+    :return downloader: (Downloader) shared downloader of the process
+    """
+    global _downloader
+    if _downloader is None or _downloader.pid != os.getpid():
+        _downloader = Downloader()
+        _downloader.pid = os.getpid()
+    return _downloader
@@ -0,0 +1,265 @@
+"""
+Flow records for analyze().
+
+Aggregates the IP packets of a trace into unidirectional flows keyed on
+(proto, src, sport, dst, dport) and writes a NetFlow-like csv row per flow:
+
+    start,end,protocol,source_ip,source_port,destination_ip,destination_port,
+    packets,bytes,tcp_flags,dscp,tos,end_reason
+
+where tcp_flags is the union of the TCP flags of the flow, dscp and tos are
+those of its first packet and end_reason is why the flow was exported:
+
+    idle        no packet for idle_timeout seconds
+    active      the flow started active_timeout seconds ago, later packets
+                start a new record
+    evicted     the table was full when a new flow started
+    end         the trace (or the range of records) ended
+
+Flows live in slots of preallocated typed arrays, one per field, so that the
+table takes the same memory whether it holds one flow or size flows. A dict
+maps the key of a flow to its slot and a heap holds one timer per flow, due
+when the flow may have timed out. Timers are only checked when they are due,
+a flow that is still active then gets a new timer, so a packet costs a dict
+lookup and a few array updates. When the table is full, the flow with the
+earliest timer is exported to make room, which bounds the memory taken by a
+surge of new flows, e.g. a scan.
+"""
+import os
+import socket
+import struct
+import logging
+from array import array
+from heapq import heappush, heappop
+from itertools import izip
+
+from pcap_mmap import *
+
+HEADER = ('start,end,protocol,source_ip,source_port,destination_ip,'
+          'destination_port,packets,bytes,tcp_flags,dscp,tos,end_reason\n')
+# Flows tracked at once
+FLOW_TABLE_SIZE = 1 << 18
+# Seconds of capture time, the idle timeout of NetFlow and IPFIX exporters.
+# MAWI traces are 15 minutes long, so the active timeout splits long flows
+# into a few records.
+IDLE_TIMEOUT = 15
+ACTIVE_TIMEOUT = 120
+# Rows written at once
+WRITE_SIZE = 1 << 12
+
+_INFINITY = float('inf')
+_pack_ip4 = struct.Struct('!I').pack
+
+
+def _format_address(address):
+    if len(address) == 4:
+        return socket.inet_ntoa(address)
+    return socket.inet_ntop(socket.AF_INET6, address)
+
+
+class FlowTable(object):
+    """
+    Aggregates packets into flows and writes them as csv rows when they
+    time out.
+    """
+    extension = '.flows.csv'
+
+    def __init__(self, output_file, size=FLOW_TABLE_SIZE,
+                 idle_timeout=IDLE_TIMEOUT, active_timeout=ACTIVE_TIMEOUT,
+                 divisor=1E6):
+        """
+        :param output_file: (str) path to the csv file
+        :param size: (int) maximum number of flows tracked at once
+        :param idle_timeout: (float) seconds of capture time without a packet
+        after which a flow is exported
+        :param active_timeout: (float) seconds of capture time after its first
+        packet after which a flow is exported
+        :param divisor: (float) divisor of the fractional part of the
+        timestamps given to add_batch(), see MmapPcapReader.divisor
+        """
+        if size < 1 or idle_timeout <= 0 or active_timeout <= 0:
+            raise ValueError('Invalid size=%s idle_timeout=%s '
+                             'active_timeout=%s' %
+                             (size, idle_timeout, active_timeout))
+        self.output = output_file
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.divisor = float(divisor)
+        # Flow key to slot, and the fields of the flow in each slot
+        self._slots = {}
+        self._keys = [None] * size
+        self._first = array('d', [0.0]) * size
+        self._last = array('d', [0.0]) * size
+        self._packets = array('L', [0]) * size
+        self._bytes = array('L', [0]) * size
+        self._flags = array('B', [0]) * size
+        self._tos = array('B', [0]) * size
+        # Slots not in use, the lowest first
+        self._free = range(size - 1, -1, -1)
+        # (deadline, slot) of every flow in the table
+        self._timers = []
+        self._rows = []
+        # Flows exported, and exported to make room for a new flow
+        self.exported = 0
+        self.evicted = 0
+        self._file = open(output_file + '.tmp', 'w')
+        self._file.write(HEADER)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def add_packets(self, packets):
+        """
+        Add decoded packets to their flows while passing them on.
+        :param packets: (generator) (ts, length, kind, proto, src, sport, dst,
+        dport, tos, flags) tuples, see MmapPcapReader.packets()
+        :return: generator of the same tuples
+        """
+        has_ip = KIND_HAS_IP
+        slots = self._slots
+        get_slot = slots.get
+        keys = self._keys
+        first = self._first
+        last = self._last
+        packet_counts = self._packets
+        byte_counts = self._bytes
+        tcp_flags = self._flags
+        tos = self._tos
+        free = self._free
+        timers = self._timers
+        idle_timeout = self.idle_timeout
+        active_timeout = self.active_timeout
+        due = timers[0][0] if timers else _INFINITY
+        for packet in packets:
+            if has_ip[packet[2]]:
+                ts = packet[0]
+                if ts >= due:
+                    self._expire(ts)
+                    due = timers[0][0] if timers else _INFINITY
+                key = packet[3:8]
+                slot = get_slot(key)
+                if slot is None:
+                    if not free:
+                        self._evict()
+                    slot = free.pop()
+                    slots[key] = slot
+                    keys[slot] = key
+                    first[slot] = last[slot] = ts
+                    packet_counts[slot] = 1
+                    byte_counts[slot] = packet[1]
+                    tos[slot] = packet[8]
+                    tcp_flags[slot] = packet[9]
+                    deadline = first[slot] + min(idle_timeout, active_timeout)
+                    heappush(timers, (deadline, slot))
+                    if deadline < due:
+                        due = deadline
+                else:
+                    last[slot] = ts
+                    packet_counts[slot] += 1
+                    byte_counts[slot] += packet[1]
+                    tcp_flags[slot] |= packet[9]
+            yield packet
+
+    def add_batch(self, packets):
+        """
+        Add a batch of packets decoded by pcap_batch.
+        :param packets: (numpy.ndarray) array of pcap_batch.PACKET_DTYPE
+        """
+        kinds = packets['kind']
+        packets = packets[has_ip4(kinds)]
+        if not len(packets):
+            return
+        ts = (packets['ts_sec'] + packets['ts_frac'] / self.divisor).tolist()
+        src = [_pack_ip4(address) for address in packets['src'].tolist()]
+        dst = [_pack_ip4(address) for address in packets['dst'].tolist()]
+        rows = izip(ts, packets['length'].tolist(), packets['kind'].tolist(),
+                    packets['proto'].tolist(), src, packets['sport'].tolist(),
+                    dst, packets['dport'].tolist(), packets['tos'].tolist(),
+                    packets['flags'].tolist())
+        for _ in self.add_packets(rows):
+            pass
+
+    def _expire(self, now):
+        """
+        Export the flows timed out at now and set new timers for the flows
+        whose timers are due but are still active.
+        """
+        timers = self._timers
+        first = self._first
+        last = self._last
+        idle_timeout = self.idle_timeout
+        active_timeout = self.active_timeout
+        now = float(now)
+        while timers and timers[0][0] <= now:
+            _, slot = heappop(timers)
+            idle_deadline = last[slot] + idle_timeout
+            active_deadline = first[slot] + active_timeout
+            if idle_deadline <= now:
+                self._export(slot, 'idle')
+            elif active_deadline <= now:
+                self._export(slot, 'active')
+            else:
+                heappush(timers, (min(idle_deadline, active_deadline), slot))
+
+    def _evict(self):
+        _, slot = heappop(self._timers)
+        self._export(slot, 'evicted')
+        self.evicted += 1
+
+    def _export(self, slot, reason):
+        proto, src, sport, dst, dport = self._keys[slot]
+        tos = self._tos[slot]
+        self._rows.append('%.6f,%.6f,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n' % (
+            self._first[slot], self._last[slot], proto, _format_address(src),
+            sport, _format_address(dst), dport, self._packets[slot],
+            self._bytes[slot], self._flags[slot], tos >> 2, tos, reason))
+        if len(self._rows) >= WRITE_SIZE:
+            self._file.writelines(self._rows)
+            del self._rows[:]
+        del self._slots[self._keys[slot]]
+        self._keys[slot] = None
+        self._free.append(slot)
+        self.exported += 1
+
+    def close(self):
+        # Export the remaining flows in the order they started
+        for slot in sorted(self._slots.itervalues(),
+                           key=self._first.__getitem__):
+            self._export(slot, 'end')
+        del self._timers[:]
+        self._file.writelines(self._rows)
+        del self._rows[:]
+        self._file.close()
+        os.rename(self.output + '.tmp', self.output)
+        if self.evicted:
+            logging.info('flows=%s evicted from a full flow table of size=%s '
+                         'for file=%s' % (self.evicted, self.size,
+                                          self.output))
+
+    def abort(self):
+        """
+        Remove the incomplete csv file after a failed analysis.
+        """
+        self._file.close()
+        os.remove(self.output + '.tmp')
+
+    @classmethod
+    def merge(cls, output_file, parts):
+        """
+        Concatenate csv files written by FlowTable into one and remove them.
+        Flows active across the end of a part are split into two records,
+        like flows hitting the active timeout.
+        :param output_file: (str) path to the merged csv file
+        :param parts: (list[str]) paths to the csv files, in capture order
+        """
+        tmp_file = output_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(HEADER)
+            for part in parts:
+                with open(part, 'r') as rows:
+                    rows.readline()
+                    for block in iter(lambda: rows.read(1 << 20), ''):
+                        f.write(block)
+                os.remove(part)
+        os.rename(tmp_file, output_file)
@@ -0,0 +1,420 @@
+"""
+Heavy hitters for analyze().
+
+Tracks the most frequent source addresses, destination addresses,
+destination ports and flows (proto,src,sport,dst,dport) of a trace in fixed
+memory:
+
+    SpaceSaving     the keys with the highest counts, each count at most
+                    epsilon * total too high
+    CountMinSketch  an estimate of the count of any key, at most
+                    epsilon * total too high with probability 1 - delta
+
+Packets are counted exactly in a small buffer that is added to the sketches
+every FLUSH_SIZE packets. Sketches with the same epsilon and delta can be
+combined, e.g. those of the ranges of a trace analyzed in parallel or of a
+set of traces, see HeavyHitters.merge().
+"""
+import os
+import math
+import json
+import zlib
+import array
+import base64
+import socket
+import heapq
+
+from pcap_mmap import *
+
+try:
+    import numpy as np
+except ImportError:
+    # Only required for HeavyHitters.add_batch()
+    np = None
+
+# Keys reported per dimension
+TOP_K = 20
+EPSILON = 1E-4
+DELTA = 0.01
+# Packets counted in the exact buffer before it is added to the sketches
+FLUSH_SIZE = 1 << 16
+DIMENSIONS = ('src', 'dst', 'dport', 'flow')
+
+
+class SpaceSaving(object):
+    """
+    Counts of at most capacity keys. A key's count exceeds its true count by
+    at most its error, and floor bounds the count of any key not kept.
+    """
+    def __init__(self, capacity):
+        """
+        :param capacity: (int) number of keys kept, 1/epsilon for counts at
+        most epsilon * total too high
+        """
+        self.capacity = capacity
+        self.total = 0
+        self.floor = 0
+        self.counts = {}
+        self.errors = {}
+
+    def update(self, counts):
+        """
+        :param counts: (dict) exact counts of keys to add
+        """
+        self._add(counts, {}, 0, sum(counts.itervalues()))
+
+    def combine(self, other):
+        """
+        Add the counts of another SpaceSaving.
+        :param other: (SpaceSaving) summary of other packets
+        """
+        self._add(other.counts, other.errors, other.floor, other.total)
+
+    def _add(self, counts, errors, floor, total):
+        own_counts = self.counts
+        own_errors = self.errors
+        own_floor = self.floor
+        for key, count in counts.iteritems():
+            current = own_counts.get(key)
+            if current is None:
+                # Not kept, its count may have been up to floor
+                own_counts[key] = own_floor + count
+                error = own_floor + errors.get(key, 0)
+            else:
+                own_counts[key] = current + count
+                error = own_errors.get(key, 0) + errors.get(key, 0)
+            if error:
+                own_errors[key] = error
+        if floor:
+            for key in own_counts:
+                if key not in counts:
+                    own_counts[key] += floor
+                    own_errors[key] = own_errors.get(key, 0) + floor
+        self.total += total
+        self.floor = own_floor + floor
+        if len(own_counts) > self.capacity:
+            self._prune()
+
+    def _prune(self):
+        # Keep the capacity largest counts, of equal counts the largest keys
+        floor = sorted(self.counts.itervalues(),
+                       reverse=True)[self.capacity - 1]
+        kept = dict(item for item in self.counts.iteritems()
+                    if item[1] > floor)
+        for key in heapq.nlargest(self.capacity - len(kept),
+                                  (key for key, count in
+                                   self.counts.iteritems()
+                                   if count == floor)):
+            kept[key] = floor
+        self.counts = kept
+        self.errors = dict((key, error)
+                           for key, error in self.errors.iteritems()
+                           if key in kept)
+        self.floor = floor
+
+    def top(self, k):
+        """
+        :param k: (int) number of keys
+        :return top: (list[tuple]) (key, count, error) of the k keys with the
+        highest counts
+        """
+        return [(key, count, self.errors.get(key, 0))
+                for key, count in heapq.nlargest(
+                    k, self.counts.iteritems(),
+                    key=lambda item: (item[1], item[0]))]
+
+
+class CountMinSketch(object):
+    """
+    Count estimates of any key in depth rows of width counters.
+    """
+    def __init__(self, width, depth):
+        """
+        :param width: (int) counters per row, e/epsilon for estimates at most
+        epsilon * total too high
+        :param depth: (int) rows, ln(1/delta) for estimates within the bound
+        with probability 1 - delta
+        """
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def _columns(self, key):
+        # Double hashing, see Kirsch and Mitzenmacher
+        h1 = zlib.crc32(key) & 0xffffffff
+        h2 = zlib.adler32(key) & 0xffffffff
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def update(self, counts):
+        """
+        :param counts: (dict) exact counts of keys to add
+        """
+        rows = list(enumerate(self.rows))
+        width = self.width
+        crc32 = zlib.crc32
+        adler32 = zlib.adler32
+        for key, count in counts.iteritems():
+            h1 = crc32(key) & 0xffffffff
+            h2 = adler32(key) & 0xffffffff
+            for i, row in rows:
+                row[(h1 + i * h2) % width] += count
+
+    def estimate(self, key):
+        """
+        :param key: (str) key
+        :return count: (int) estimated count, never below the true count
+        """
+        return min(row[column]
+                   for row, column in zip(self.rows, self._columns(key)))
+
+    def combine(self, other):
+        """
+        Add the counts of another sketch of the same width and depth.
+        :param other: (CountMinSketch) sketch of other packets
+        """
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('can not combine sketches of width=%s depth=%s '
+                             'and width=%s depth=%s' %
+                             (self.width, self.depth, other.width,
+                              other.depth))
+        for row, other_row in zip(self.rows, other.rows):
+            for column, count in enumerate(other_row):
+                if count:
+                    row[column] += count
+
+
+class HeavyHitters(object):
+    """
+    Heavy hitters of a trace, written as JSON with the sketches that produced
+    them.
+    """
+    extension = '.heavy.json'
+
+    def __init__(self, output_file, k=TOP_K, epsilon=EPSILON, delta=DELTA):
+        """
+        :param output_file: (str) path to the JSON file
+        :param k: (int) keys reported per dimension
+        :param epsilon: (float) error bound relative to the number of packets
+        counted
+        :param delta: (float) probability of a Count-Min estimate beyond the
+        error bound
+        """
+        if not 0 < epsilon < 1 or not 0 < delta < 1:
+            raise ValueError('Invalid heavy hitter epsilon=%s delta=%s' %
+                             (epsilon, delta))
+        self.output = output_file
+        self.k = k
+        self.epsilon = epsilon
+        self.delta = delta
+        capacity = max(k, int(math.ceil(1 / epsilon)))
+        width = int(math.ceil(math.e / epsilon))
+        depth = int(math.ceil(math.log(1 / delta)))
+        self.summaries = dict((name, SpaceSaving(capacity))
+                              for name in DIMENSIONS)
+        self.sketches = dict((name, CountMinSketch(width, depth))
+                             for name in DIMENSIONS)
+        self._buffers = dict((name, {}) for name in DIMENSIONS)
+
+    def add_packets(self, packets):
+        """
+        Count decoded packets while passing them on.
+        :param packets: (generator) (ts, length, kind, proto, src, sport, dst,
+        dport, tos, flags) tuples, see MmapPcapReader.packets()
+        :return: generator of the same tuples
+        """
+        has_ip = KIND_HAS_IP
+        has_ports = KIND_HAS_PORTS
+        # Cleared in place by _flush()
+        buffers = self._buffers
+        srcs = buffers['src']
+        dsts = buffers['dst']
+        ports = buffers['dport']
+        flows = buffers['flow']
+        pending = 0
+        try:
+            for packet in packets:
+                kind = packet[2]
+                if has_ip[kind]:
+                    src = packet[4]
+                    dst = packet[6]
+                    srcs[src] = srcs.get(src, 0) + 1
+                    dsts[dst] = dsts.get(dst, 0) + 1
+                    if has_ports[kind]:
+                        port = packet[7]
+                        ports[port] = ports.get(port, 0) + 1
+                        flow = packet[3:8]
+                        flows[flow] = flows.get(flow, 0) + 1
+                    pending += 1
+                    if pending >= FLUSH_SIZE:
+                        self._flush(_PACKED_KEYS)
+                        pending = 0
+                yield packet
+        finally:
+            self._flush(_PACKED_KEYS)
+
+    def add_batch(self, packets):
+        """
+        Count a batch of packets decoded by pcap_batch.
+        :param packets: (numpy.ndarray) array of pcap_batch.PACKET_DTYPE
+        """
+        kinds = packets['kind']
+        ip = packets[has_ip4(kinds)]
+        flows = packets[(kinds == PKT_TCP) | (kinds == PKT_UDP)]
+        buffers = self._buffers
+        for name, values in (('src', ip['src']), ('dst', ip['dst']),
+                             ('dport', flows['dport']),
+                             ('flow', flows[['proto', 'src', 'sport', 'dst',
+                                             'dport']])):
+            keys, counts = np.unique(values, return_counts=True)
+            buffers[name].update(zip(keys.tolist(), counts.tolist()))
+        self._flush(_INT_KEYS)
+
+    def _flush(self, formats):
+        """
+        Add the buffered counts to the sketches.
+        :param formats: (dict) dimension name to function formatting the
+        buffered keys as text, _PACKED_KEYS or _INT_KEYS
+        """
+        for name in DIMENSIONS:
+            buff = self._buffers[name]
+            if buff:
+                # Distinct keys are formatted to distinct text
+                counts = dict(zip(map(formats[name], buff.iterkeys()),
+                                  buff.itervalues()))
+                self.summaries[name].update(counts)
+                self.sketches[name].update(counts)
+                buff.clear()
+
+    def top(self, name, k=None):
+        """
+        :param name: (str) one of DIMENSIONS
+        :param k: (int) number of keys (default: k of the constructor)
+        :return top: (list[tuple]) (key, count, min_count) of the most
+        frequent keys, where the true count lies between min_count and count
+        """
+        sketch = self.sketches[name]
+        return [(key, min(count, sketch.estimate(key)), count - error)
+                for key, count, error in self.summaries[name].top(k or
+                                                                  self.k)]
+
+    def combine(self, other):
+        """
+        Add the sketches of other packets.
+        :param other: (HeavyHitters) heavy hitters with the same epsilon and
+        delta
+        """
+        for name in DIMENSIONS:
+            self.summaries[name].combine(other.summaries[name])
+            self.sketches[name].combine(other.sketches[name])
+
+    def close(self):
+        self._flush(_PACKED_KEYS)
+        state = {
+            "k": self.k,
+            "epsilon": self.epsilon,
+            "delta": self.delta,
+            "top": dict((name, self.top(name)) for name in DIMENSIONS),
+            "sketches": dict((name, {
+                "total": self.summaries[name].total,
+                "floor": self.summaries[name].floor,
+                "counts": self.summaries[name].counts,
+                "errors": self.summaries[name].errors,
+                "rows": _pack_rows(self.sketches[name].rows)
+            }) for name in DIMENSIONS)
+        }
+        tmp_file = self.output + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        os.rename(tmp_file, self.output)
+
+    def abort(self):
+        """
+        Drop the sketches after a failed analysis. Nothing is written before
+        close().
+        """
+
+    @classmethod
+    def read(cls, output_file):
+        """
+        :param output_file: (str) path to a file written by this class
+        :return heavy_hitters: (HeavyHitters) heavy hitters with the sketches
+        of the file
+        """
+        with open(output_file, 'r') as f:
+            state = json.load(f)
+        heavy_hitters = cls(output_file, state['k'], state['epsilon'],
+                            state['delta'])
+        for name in DIMENSIONS:
+            sketch = state['sketches'][name]
+            summary = heavy_hitters.summaries[name]
+            summary.total = sketch['total']
+            summary.floor = sketch['floor']
+            summary.counts = dict((str(key), count) for key, count in
+                                  sketch['counts'].iteritems())
+            summary.errors = dict((str(key), count) for key, count in
+                                  sketch['errors'].iteritems())
+            heavy_hitters.sketches[name].rows = _unpack_rows(
+                sketch['rows'], heavy_hitters.sketches[name].width)
+        return heavy_hitters
+
+    @classmethod
+    def merge(cls, output_file, parts, remove=True):
+        """
+        Combine files written by HeavyHitters into one.
+        :param output_file: (str) path to the merged file
+        :param parts: (list[str]) paths to the files, all with the same
+        epsilon and delta
+        :param remove: (bool) remove the parts, e.g. keep them when merging
+        the heavy hitters of several traces
+        """
+        merged = cls.read(parts[0])
+        for part in parts[1:]:
+            merged.combine(cls.read(part))
+        if remove:
+            for part in parts:
+                os.remove(part)
+        merged.output = output_file
+        merged.close()
+
+
+def _pack_rows(rows):
+    # Doubles are exact up to 2**53 on every platform
+    values = array.array('d')
+    for row in rows:
+        values.extend(row)
+    return base64.b64encode(zlib.compress(values.tostring()))
+
+
+def _unpack_rows(text, width):
+    values = array.array('d')
+    values.fromstring(zlib.decompress(base64.b64decode(text)))
+    return [[int(value) for value in values[i:i + width]]
+            for i in range(0, len(values), width)]
+
+
+def _address(address):
+    if len(address) == 4:
+        return socket.inet_ntoa(address)
+    return socket.inet_ntop(socket.AF_INET6, address)
+
+
+def _flow(key):
+    proto, src, sport, dst, dport = key
+    return '%d,%s,%d,%s,%d' % (proto, _address(src), sport, _address(dst),
+                               dport)
+
+
+def _ip(address):
+    return '%d.%d.%d.%d' % (address >> 24, (address >> 16) & 0xff,
+                            (address >> 8) & 0xff, address & 0xff)
+
+
+def _int_flow(key):
+    proto, src, sport, dst, dport = key
+    return '%d,%s,%d,%s,%d' % (proto, _ip(src), sport, _ip(dst), dport)
+
+
+# Formats of the keys of packets decoded by decode_packet() and pcap_batch
+_PACKED_KEYS = {'src': _address, 'dst': _address, 'dport': str,
+                'flow': _flow}
+_INT_KEYS = {'src': _ip, 'dst': _ip, 'dport': str, 'flow': _int_flow}
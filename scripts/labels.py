@@ -0,0 +1,234 @@
+"""
+Protocol and service names for analyze() outputs.
+
+Compiles ETHTYPE.json, ip_protocols.json and TCP_IP_PORTS from the root of
+the repository into dense tables indexed by number: a 65536-entry table per
+transport giving the service of a TCP or UDP port, a 256-entry table of IP
+protocol keywords and a 65536-entry table of ethertype abbreviations.
+Entries are indexes into one list of names, 0 for unknown numbers.
+
+The tables are cached in a binary file next to the JSON files, rebuilt when
+the JSON files change, and load in milliseconds. They are arrays rather than
+dicts, so processes forked after load_labels() share their pages: analyze()
+and process_links() load them before starting the worker processes of
+summary outputs.
+"""
+import os
+import sys
+import json
+import struct
+import logging
+from array import array
+
+# Directory of the JSON files
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir)
+ETHTYPES_FILE = 'ETHTYPE.json'
+PROTOCOLS_FILE = 'ip_protocols.json'
+PORTS_FILE = 'TCP_IP_PORTS'
+CACHE_FILE = 'labels.cache'
+# Label of numbers without a name
+UNKNOWN = 'unknown'
+
+_MAGIC = b'PLBL'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHBI')
+# Tables in the order they are cached, and their sizes
+_TABLES = (('tcp', 1 << 16), ('udp', 1 << 16), ('protocols', 256),
+           ('ethertypes', 1 << 16))
+
+# Labels loaded by load_labels(), per data directory
+_loaded = {}
+
+
+class Labels(object):
+    """
+    Names of IP protocols, TCP/UDP ports and ethertypes.
+    """
+    def __init__(self, names, tcp, udp, protocols, ethertypes):
+        """
+        :param names: (list[str]) names, the first one empty
+        :param tcp: (array) index into names per TCP port
+        :param udp: (array) index into names per UDP port
+        :param protocols: (array) index into names per IP protocol number
+        :param ethertypes: (array) index into names per ethertype
+        """
+        self.names = names
+        self.tcp = tcp
+        self.udp = udp
+        self.protocols = protocols
+        self.ethertypes = ethertypes
+
+    def service(self, proto, port):
+        """
+        :param proto: (int) IP protocol number, 6 (TCP) or 17 (UDP)
+        :param port: (int) TCP or UDP port
+        :return name: (str) service name, e.g. 'http', '' if unknown
+        """
+        table = self.tcp if proto == 6 else self.udp
+        return self.names[table[port]]
+
+    def protocol(self, proto):
+        """
+        :param proto: (int) IP protocol number
+        :return name: (str) protocol keyword, e.g. 'UDP', '' if unknown
+        """
+        return self.names[self.protocols[proto]]
+
+    def ethertype(self, eth_type):
+        """
+        :param eth_type: (int) Ethernet type
+        :return name: (str) protocol abbreviation, e.g. 'ARP', '' if unknown
+        """
+        return self.names[self.ethertypes[eth_type]]
+
+    def label_counts(self, table, counts):
+        """
+        Sum counts per number into counts per name.
+        :param table: (array) one of tcp, udp, protocols and ethertypes
+        :param counts: (dict) count per number, e.g. a summary section
+        :return counts: (dict) count per name, UNKNOWN for numbers without
+        a name
+        """
+        names = self.names
+        labelled = {}
+        for number, count in counts.items():
+            name = names[table[int(number)]] or UNKNOWN
+            labelled[name] = labelled.get(name, 0) + count
+        return labelled
+
+
+def _read_json(data_dir, filename):
+    with open(os.path.join(data_dir, filename), 'r') as f:
+        return json.load(f)
+
+
+def _name(text):
+    return text.strip().encode('utf-8')
+
+
+def _compile(data_dir):
+    """
+    Build the tables from the JSON files.
+    :param data_dir: (str) directory of the JSON files
+    :return labels: (Labels) the tables
+    """
+    names = ['']
+    index = {'': 0}
+
+    def intern(name):
+        if name not in index:
+            index[name] = len(names)
+            names.append(name)
+        return index[name]
+
+    tables = dict((table, array('H', [0]) * size)
+                  for table, size in _TABLES)
+    for number, entry in _read_json(data_dir, PROTOCOLS_FILE).items():
+        # Some keys are ranges of unassigned numbers or broken rows
+        if number.isdigit() and int(number) < 256:
+            tables['protocols'][int(number)] = intern(_name(entry['keyword']))
+    for number, entry in _read_json(data_dir, ETHTYPES_FILE).items():
+        tables['ethertypes'][int(number, 16)] = intern(
+            _name(entry['protocol_abbrv']))
+    for port, entries in _read_json(data_dir, PORTS_FILE).items():
+        if not isinstance(entries, list):
+            entries = [entries]
+        entries = [entry for entry in entries if _name(entry['abbrv'])]
+        for transport in ('tcp', 'udp'):
+            # Entries of the transport, or of no transport in particular,
+            # official ones first
+            candidates = ([entry for entry in entries if entry[transport]] or
+                          [entry for entry in entries
+                           if not entry['tcp'] and not entry['udp']])
+            candidates.sort(key=lambda entry:
+                            not entry['status'].startswith('Official'))
+            if candidates:
+                tables[transport][int(port)] = intern(
+                    _name(candidates[0]['abbrv']))
+    return Labels(names, **tables)
+
+
+def _signature(data_dir):
+    """
+    :return signature: (str) sizes and modification times of the JSON files
+    """
+    stats = [os.stat(os.path.join(data_dir, filename))
+             for filename in (ETHTYPES_FILE, PROTOCOLS_FILE, PORTS_FILE)]
+    return json.dumps([(stat.st_size, int(stat.st_mtime)) for stat in stats])
+
+
+def _write_cache(cache_file, signature, labels):
+    names = b'\n'.join(labels.names)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, sys.byteorder == 'little',
+                             len(signature)))
+        f.write(signature)
+        f.write(struct.pack('<I', len(names)))
+        f.write(names)
+        for table, _ in _TABLES:
+            getattr(labels, table).tofile(f)
+    os.rename(tmp_file, cache_file)
+
+
+def _read_cache(cache_file, signature):
+    """
+    :return labels: (Labels) the cached tables, None if the cache is missing
+    or stale
+    """
+    try:
+        f = open(cache_file, 'rb')
+    except IOError:
+        return None
+    with f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return None
+        magic, version, little, length = _HEADER.unpack(header)
+        if (magic != _MAGIC or version != _VERSION or
+                little != (sys.byteorder == 'little') or
+                f.read(length) != signature):
+            return None
+        length = struct.unpack('<I', f.read(4))[0]
+        names = f.read(length).split(b'\n')
+        tables = {}
+        try:
+            for table, size in _TABLES:
+                tables[table] = array('H')
+                tables[table].fromfile(f, size)
+        except EOFError:
+            return None
+    return Labels(names, **tables)
+
+
+def load_labels(data_dir=DATA_DIR, cache_file=None):
+    """
+    Load the tables, from the cache if it is up to date. Loaded once per
+    process.
+    :param data_dir: (str) directory of the JSON files
+    :param cache_file: (str) path to the binary cache (default: CACHE_FILE
+    in data_dir)
+    :return labels: (Labels) the tables, None if the JSON files are missing
+    """
+    labels = _loaded.get(data_dir)
+    if labels is not None:
+        return labels
+    if cache_file is None:
+        cache_file = os.path.join(data_dir, CACHE_FILE)
+    try:
+        signature = _signature(data_dir)
+    except OSError as el1:
+        logging.error('Unable to load labels from dir=%s. Error=%s' %
+                      (data_dir, el1))
+        return None
+    labels = _read_cache(cache_file, signature)
+    if labels is None:
+        labels = _compile(data_dir)
+        try:
+            _write_cache(cache_file, signature, labels)
+        except (IOError, OSError) as el1:
+            logging.info('Unable to cache labels to file=%s. Error=%s' %
+                         (cache_file, el1))
+    _loaded[data_dir] = labels
+    return labels
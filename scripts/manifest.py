@@ -0,0 +1,177 @@
+"""
+Persistent job manifest.
+
+Records the state of every dump file in a SQLite database so that an
+interrupted run can skip finished traces and retry failed ones. Each state
+change is committed in its own transaction. Worker processes open their own
+connection.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+# Job states in processing order
+STATE_PENDING = 'pending'
+STATE_DOWNLOADED = 'downloaded'
+STATE_EXTRACTED = 'extracted'
+STATE_ANALYZED = 'analyzed'
+STATE_COMPRESSED = 'compressed'
+STATE_FAILED = 'failed'
+# Final state, the output of the job is complete
+STATE_DONE = STATE_COMPRESSED
+
+# Attempts before a failing job is given up
+MAX_ATTEMPTS = 3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    url TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    path TEXT,
+    output TEXT,
+    counters TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL
+)
+'''
+_COLUMNS = ('url', 'state', 'path', 'output', 'counters', 'error',
+            'attempts', 'updated')
+
+# Connections by manifest path, process and thread
+_connections = {}
+
+
+class JobManifest(object):
+    """
+    SQLite backed table of jobs keyed by URL.
+    """
+    def __init__(self, path):
+        """
+        :param path: (str) path to the SQLite database, created if missing
+        """
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60)
+        with self._db:
+            self._db.execute(_SCHEMA)
+
+    def add(self, urls):
+        """
+        Add jobs that are not in the manifest yet.
+        :param urls: (list[str]) URLs of dump files
+        """
+        with self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO jobs (url, state, updated) '
+                'VALUES (?, ?, ?)',
+                [(url, STATE_PENDING, time.time()) for url in urls])
+
+    def get(self, url):
+        """
+        :param url: (str) URL of the dump file
+        :return job: (dict) job columns, counters decoded, None if unknown
+        """
+        row = self._db.execute('SELECT %s FROM jobs WHERE url = ?' %
+                               ', '.join(_COLUMNS), (url,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(_COLUMNS, row))
+        job['counters'] = json.loads(job['counters'] or 'null')
+        return job
+
+    def update(self, url, state, **fields):
+        """
+        Change the state of a job.
+        :param url: (str) URL of the dump file
+        :param state: (str) new state, one of the STATE_* constants
+        :param fields: path, output, counters or error to store as well
+        """
+        if 'counters' in fields:
+            fields['counters'] = json.dumps(fields['counters'])
+        names = ['state', 'updated'] + sorted(fields)
+        values = [state, time.time()] + [fields[k] for k in sorted(fields)]
+        with self._db:
+            self._db.execute('UPDATE jobs SET %s WHERE url = ?' %
+                             ', '.join('%s = ?' % n for n in names),
+                             values + [url])
+
+    def start(self, url):
+        """
+        Count an attempt to process a job.
+        :param url: (str) URL of the dump file
+        """
+        with self._db:
+            self._db.execute('UPDATE jobs SET attempts = attempts + 1, '
+                             'error = NULL, updated = ? WHERE url = ?',
+                             (time.time(), url))
+
+    def is_done(self, url):
+        """
+        :param url: (str) URL of the dump file
+        :return done: (bool) True if the job finished and its output exists
+        """
+        job = self.get(url)
+        return (job is not None and job['state'] == STATE_DONE and
+                job['output'] is not None and os.path.exists(job['output']))
+
+    def todo(self, links, max_attempts=MAX_ATTEMPTS):
+        """
+        Add links to the manifest and select the ones still to process.
+        :param links: (list[tuple]) (url, trace_count) of every dump file
+        :param max_attempts: (int) skip jobs that failed this many times
+        :return links: (list[tuple]) links that are not done
+        """
+        self.add([url for url, _ in links])
+        todo = []
+        for link in links:
+            job = self.get(link[0])
+            if self.is_done(link[0]):
+                continue
+            if job['state'] == STATE_FAILED and \
+                    job['attempts'] >= max_attempts:
+                logging.info('Skipping url=%s after attempts=%s. Error=%s' %
+                             (link[0], job['attempts'], job['error']))
+                continue
+            todo.append(link)
+        logging.info('%s of %s links left to process' %
+                     (len(todo), len(links)))
+        return todo
+
+    def counts(self):
+        """
+        :return counts: (dict) number of jobs in each state
+        """
+        return dict(self._db.execute(
+            'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def close(self):
+        self._db.close()
+
+
+def open_manifest(path):
+    """
+    Manifest connection of the current process and thread. SQLite connections
+    are not shared with forked worker processes or other threads.
+    :param path: (str) path to the SQLite database
+    :return manifest: (JobManifest) open manifest
+    """
+    key = (path, os.getpid(), threading.current_thread().ident)
+    if key not in _connections:
+        _connections[key] = JobManifest(path)
+    return _connections[key]
+
+
+def record(manifest, url, state, **fields):
+    """
+    Change the state of a job if a manifest is in use.
+    :param manifest: (str) path to the SQLite database, None for no manifest
+    :param url: (str) URL of the dump file
+    :param state: (str) new state, one of the STATE_* constants
+    :param fields: path, output, counters or error to store as well
+    """
+    if manifest is None or url is None:
+        return
+    open_manifest(manifest).update(url, state, **fields)
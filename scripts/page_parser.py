@@ -0,0 +1,71 @@
+"""
+Selective HTML extractor for MAWI pages.
+
+scrap_links() only needs the links of a page and its last <pre> block, the
+stats table of trace pages. PageParser picks these out of the stream of tags
+and text of HTMLParser and drops everything else, instead of building a full
+document tree. The last <pre> block is only known at the end of the page, so
+the whole page is scanned, but nothing outside the wanted elements is kept.
+"""
+from HTMLParser import HTMLParser
+
+
+def _normalize(text):
+    # Line breaks as read by the former tree parser
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+class PageParser(HTMLParser):
+    """
+    Collects the hrefs of <a> tags and the text of the last <pre> block.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        # href of every <a> tag with one, in page order
+        self.links = []
+        # Text of the last <pre> block, None if the page has none
+        self.pre = None
+        self._pre = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href is not None:
+                self.links.append(href)
+        elif tag == 'pre':
+            self._pre = []
+
+    def handle_endtag(self, tag):
+        if tag == 'pre' and self._pre is not None:
+            self.pre = _normalize(''.join(self._pre))
+            self._pre = None
+
+    def handle_data(self, data):
+        if self._pre is not None:
+            self._pre.append(data)
+
+    def handle_entityref(self, name):
+        if self._pre is not None:
+            self._pre.append(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        if self._pre is not None:
+            self._pre.append(self.unescape('&#%s;' % name))
+
+    def close(self):
+        HTMLParser.close(self)
+        if self._pre is not None:
+            # Unclosed <pre> block
+            self.pre = _normalize(''.join(self._pre))
+            self._pre = None
+
+
+def parse_page(body):
+    """
+    :param body: (str) the page
+    :return page: (PageParser) links and last <pre> block of the page
+    """
+    page = PageParser()
+    page.feed(body)
+    page.close()
+    return page
@@ -0,0 +1,257 @@
+"""
+Batched pcap header decoder.
+
+Collects the record offsets of a block of packets from an MmapPcapReader and
+decodes their header fields at once with NumPy fancy indexing into structured
+arrays. IPv4 addresses stay uint32 until they are written out.
+"""
+import struct
+
+import numpy as np
+
+from pcap_mmap import *
+
+# Number of packets decoded per batch
+BATCH_SIZE = 1 << 20
+# Number of packets gathered at once inside a batch
+DECODE_BLOCK = 1 << 16
+
+PACKET_DTYPE = np.dtype([
+    ('ts_sec', np.uint32),
+    ('ts_frac', np.uint32),
+    ('kind', np.uint8),
+    ('proto', np.uint8),
+    ('tos', np.uint8),
+    ('src', np.uint32),
+    ('dst', np.uint32),
+    ('sport', np.uint16),
+    ('dport', np.uint16),
+    ('flags', np.uint8),
+    ('length', np.uint32),
+    ('id', np.uint16),
+    ('frag', np.uint16),
+    ('eth_type', np.uint16)
+])
+
+
+# Byte layouts gathered for every packet. The record header layout depends on
+# the byte order of the pcap file.
+FRAME_DTYPE = np.dtype([
+    ('mac', 'V12'),
+    ('eth_type', '>u2'),
+    ('v_hl', 'u1'),
+    ('tos', 'u1'),
+    ('len', '>u2'),
+    ('id', '>u2'),
+    ('frag', '>u2'),
+    ('ttl', 'u1'),
+    ('proto', 'u1'),
+    ('sum', '>u2'),
+    ('src', '>u4'),
+    ('dst', '>u4')
+])
+L4_DTYPE = np.dtype([
+    ('sport', '>u2'),
+    ('dport', '>u2'),
+    ('seq_ack', 'V8'),
+    ('off', 'u1'),
+    ('flags', 'u1')
+])
+
+
+def record_dtype(endian):
+    """
+    Layout of a pcap record header.
+    :param endian: (str) struct byte order character of the file
+    :return dtype: (numpy.dtype) record header layout
+    """
+    return np.dtype([(name, endian + 'u4')
+                     for name in ('ts_sec', 'ts_frac', 'caplen', 'length')])
+
+
+def _gather(data, offsets, dtype):
+    """
+    Copy dtype.itemsize bytes starting at each offset into a structured array.
+    Offsets too close to the end of data are clamped, so callers must mask the
+    fields of packets that are shorter than the layout.
+    :param data: (numpy.ndarray) uint8 view of the file
+    :param offsets: (numpy.ndarray) int64 offsets into data
+    :param dtype: (numpy.dtype) layout to read
+    :return values: (numpy.ndarray) array of dtype
+    """
+    index = np.minimum(offsets, len(data) - dtype.itemsize)[:, None] + \
+        np.arange(dtype.itemsize)
+    return data[index].view(dtype)[:, 0]
+
+
+def scan_offsets(reader, start=PCAP_GLOBAL_HDR_LEN, end=None,
+                 count=BATCH_SIZE):
+    """
+    Collect the offsets of up to count record headers. This is the only
+    per-packet Python loop of the batch decoder.
+    :param reader: (MmapPcapReader) open pcap file
+    :param start: (int) offset of the first record header
+    :param end: (int) offset to stop at (default: end of file)
+    :param count: (int) maximum number of records
+    :return (offsets, next_offset): (numpy.ndarray, int) record header
+    offsets and offset of the record following the last one
+    """
+    buf = reader.buf
+    end = reader.size if end is None else end
+    unpack_caplen = struct.Struct(reader.endian + 'I').unpack_from
+    offsets = []
+    append = offsets.append
+    offset = start
+    last = end - PCAP_RECORD_HDR_LEN
+    while count and offset <= last:
+        append(offset)
+        offset += PCAP_RECORD_HDR_LEN + unpack_caplen(buf, offset + 8)[0]
+        count -= 1
+    return np.array(offsets, dtype=np.int64), offset
+
+
+def decode_batch(reader, offsets, end=None):
+    """
+    Decode the records starting at the given offsets. Follows the same rules
+    as decode_packet() so that both produce identical results.
+    :param reader: (MmapPcapReader) open pcap file
+    :param offsets: (numpy.ndarray) record header offsets from scan_offsets()
+    :param end: (int) offset the records are cut at (default: end of file)
+    :return packets: (numpy.ndarray) array of PACKET_DTYPE
+    """
+    end = reader.size if end is None else end
+    data = np.frombuffer(reader.buf, dtype=np.uint8)
+    packets = np.zeros(len(offsets), dtype=PACKET_DTYPE)
+    # Decode in blocks to bound the size of the gather index arrays.
+    for i in range(0, len(offsets), DECODE_BLOCK):
+        _decode_block(data, reader.endian, offsets[i:i + DECODE_BLOCK], end,
+                      packets[i:i + DECODE_BLOCK])
+    return packets
+
+
+def _decode_block(data, endian, offsets, end, packets):
+    """
+    Decode a block of records into packets, see decode_batch().
+    """
+    record = _gather(data, offsets, record_dtype(endian))
+    packets['ts_sec'] = record['ts_sec']
+    packets['ts_frac'] = record['ts_frac']
+    packets['length'] = record['length']
+    frame = offsets + PCAP_RECORD_HDR_LEN
+    caplen = np.minimum(record['caplen'].astype(np.int64), end - frame)
+    headers = _gather(data, frame, FRAME_DTYPE)
+
+    kind = packets['kind']
+    kind[:] = PKT_INVALID
+    has_eth = caplen >= ETH_HDR_LEN
+    is_ip_type = has_eth & (headers['eth_type'] == ETH_TYPE_IP)
+    kind[has_eth & ~is_ip_type] = PKT_NON_IP4
+    packets['eth_type'] = np.where(has_eth, headers['eth_type'], 0)
+    kind[is_ip_type] = PKT_IP_INVALID
+    hl = (headers['v_hl'] & 0xf).astype(np.int64) << 2
+    valid = is_ip_type & (caplen >= ETH_HDR_LEN + IP_HDR_LEN) & \
+        (hl >= IP_HDR_LEN)
+    kind[valid] = PKT_IP
+
+    proto = np.where(valid, headers['proto'], 0)
+    packets['proto'] = proto
+    packets['tos'] = np.where(valid, headers['tos'], 0)
+    packets['src'] = np.where(valid, headers['src'], 0)
+    packets['dst'] = np.where(valid, headers['dst'], 0)
+    packets['id'] = np.where(valid, headers['id'], 0)
+    packets['frag'] = np.where(valid, headers['frag'], 0)
+
+    # Bytes of the IP datagram available, trimmed to the IP total length.
+    available = caplen - ETH_HDR_LEN
+    ip_len = headers['len'].astype(np.int64)
+    available = np.where((ip_len > 0) & (ip_len < available), ip_len,
+                         available)
+    l4_len = available - hl
+    not_fragment = (headers['frag'] & IP_OFFMASK) == 0
+    tcp = valid & (proto == IP_PROTO_TCP)
+    udp = valid & (proto == IP_PROTO_UDP)
+    l4 = _gather(data, frame + ETH_HDR_LEN + hl, L4_DTYPE)
+    tcp_ok = tcp & not_fragment & (l4_len >= TCP_HDR_LEN) & \
+        ((l4['off'] >> 4) >= 5)
+    udp_ok = udp & not_fragment & (l4_len >= UDP_HDR_LEN)
+    kind[tcp] = PKT_TCP_NO_PORTS
+    kind[tcp_ok] = PKT_TCP
+    kind[udp] = PKT_UDP_NO_PORTS
+    kind[udp_ok] = PKT_UDP
+
+    has_ports = tcp_ok | udp_ok
+    packets['sport'] = np.where(has_ports, l4['sport'], 0)
+    packets['dport'] = np.where(has_ports, l4['dport'], 0)
+    packets['flags'] = np.where(tcp_ok, l4['flags'], 0)
+
+
+def resolve_fragments(packets, divisor, fragments):
+    """
+    Give the non-first fragments of a batch the ports of their first
+    fragment, as FragmentTable.resolve() does for decode_packet(). Only the
+    fragments are visited, in file order.
+    :param packets: (numpy.ndarray) array of PACKET_DTYPE, updated in place
+    :param divisor: (float|Decimal) divisor of the fractional part, see
+    MmapPcapReader.divisor
+    :param fragments: (FragmentTable) table carried from batch to batch
+    """
+    kinds = packets['kind']
+    index = np.flatnonzero(((packets['frag'] & (IP_MF | IP_OFFMASK)) != 0) &
+                           (kinds >= PKT_TCP) & (kinds <= PKT_UDP_NO_PORTS))
+    if not len(index):
+        return
+    rows = packets[index]
+    resolved = []
+    ports = []
+    for i, ts, src, dst, ip_id, proto, frag, kind, sport, dport in zip(
+            index.tolist(), timestamps(rows, divisor), rows['src'].tolist(),
+            rows['dst'].tolist(), rows['id'].tolist(), rows['proto'].tolist(),
+            rows['frag'].tolist(), rows['kind'].tolist(),
+            rows['sport'].tolist(), rows['dport'].tolist()):
+        key = (src, dst, ip_id, proto)
+        if frag & IP_OFFMASK:
+            found = fragments.get(key, ts, not frag & IP_MF)
+            if found is not None:
+                resolved.append(i)
+                ports.append(found)
+        elif kind <= PKT_UDP:
+            # First fragment with ports
+            fragments.add(key, sport, dport, ts)
+    if resolved:
+        ports = np.array(ports, dtype=np.uint16)
+        # PKT_TCP_NO_PORTS to PKT_TCP, PKT_UDP_NO_PORTS to PKT_UDP
+        kinds[resolved] -= PKT_TCP_NO_PORTS - PKT_TCP
+        packets['sport'][resolved] = ports[:, 0]
+        packets['dport'][resolved] = ports[:, 1]
+
+
+def read_batches(reader, batch_size=BATCH_SIZE, start=PCAP_GLOBAL_HDR_LEN,
+                 end=None):
+    """
+    Decode a pcap file batch by batch.
+    :param reader: (MmapPcapReader) open pcap file
+    :param batch_size: (int) number of packets per batch
+    :param start: (int) offset of the first record header
+    :param end: (int) offset to stop at (default: end of file)
+    :return: generator of PACKET_DTYPE arrays
+    """
+    end = reader.size if end is None else end
+    offset = start
+    while offset + PCAP_RECORD_HDR_LEN <= end:
+        offsets, offset = scan_offsets(reader, offset, end, batch_size)
+        yield decode_batch(reader, offsets, end)
+
+
+def timestamps(packets, divisor):
+    """
+    Packet timestamps computed like dpkt.pcap.Reader does.
+    :param packets: (numpy.ndarray) array of PACKET_DTYPE
+    :param divisor: (float|Decimal) divisor of the fractional part, see
+    MmapPcapReader.divisor
+    :return ts: (list) timestamps as float, or Decimal for nanosecond pcaps
+    """
+    if isinstance(divisor, float):
+        return (packets['ts_sec'] + packets['ts_frac'] / divisor).tolist()
+    return [sec + frac / divisor
+            for sec, frac in zip(packets['ts_sec'].tolist(),
+                                 packets['ts_frac'].tolist())]
@@ -0,0 +1,339 @@
+"""
+Packet filter for analyze().
+
+A small BPF-like language over protocol, addresses, ports, TOS and time:
+
+    udp and dst port 53
+    tcp and not (port 80 or port 443)
+    src net 10.0.0.0/8 and dscp 46
+    time >= 1104588300 and time < 1104588420
+
+Primitives:
+
+    ip | tcp | udp | icmp | proto N
+    [src|dst] host A.B.C.D
+    [src|dst] net A.B.C.D/LEN
+    [src|dst] port N
+    [src|dst] portrange N-M
+    tos [OP] N | dscp [OP] N
+    time OP T
+
+combined with and/&&, or/||, not/! and parentheses. OP is one of ==, !=, <,
+<=, >, >=, default ==. Without src/dst, either address or port matches. Port
+primitives only match TCP and UDP packets whose header is available. They
+never match non-first fragments, which analyze() writes with the ports of
+their first fragment (see pcap_mmap.FragmentTable), and fragments of
+datagrams whose first fragment was rejected are written without ports.
+
+An expression is compiled once into a Python function of fixed-offset field
+comparisons on the raw Ethernet frame, run before the frame is decoded, and
+into a NumPy expression over decoded pcap_batch arrays.
+"""
+import re
+import socket
+import struct
+
+from pcap_mmap import *
+
+try:
+    import numpy as np
+except ImportError:
+    # Only required for PacketFilter.mask()
+    np = None
+
+IP_PROTO_ICMP = 1
+
+# Offsets of IPv4 fields in an Ethernet frame
+_OFF_ETH_TYPE = 12
+_OFF_V_HL = ETH_HDR_LEN
+_OFF_TOS = ETH_HDR_LEN + 1
+_OFF_PROTO = ETH_HDR_LEN + 9
+_OFF_SRC = ETH_HDR_LEN + 12
+_OFF_DST = ETH_HDR_LEN + 16
+
+_U8 = struct.Struct('!B').unpack_from
+_U16 = struct.Struct('!H').unpack_from
+_U32 = struct.Struct('!I').unpack_from
+# Version/IHL, total length, flags/fragment offset and protocol.
+_IP_FIELDS = struct.Struct('!BxH2xHxB')
+_TCP_PORTS = struct.Struct('!HH8xB')
+_UDP_PORTS = struct.Struct('!HH')
+
+_TOKEN = re.compile(r'\s*(?:(\d+\.\d+\.\d+\.\d+(?:/\d+)?)|'
+                    r'(\d+(?:\.\d+)?(?:-\d+)?)|'
+                    r'(==|!=|<=|>=|<|>|&&|\|\||!|\(|\))|'
+                    r'([a-z]+))')
+_OPS = ('==', '!=', '<', '<=', '>', '>=')
+_PROTOS = {'tcp': IP_PROTO_TCP, 'udp': IP_PROTO_UDP, 'icmp': IP_PROTO_ICMP}
+
+
+def _ports(buf, offset, caplen):
+    """
+    TCP/UDP ports of an IPv4 frame, following the rules of decode_packet().
+    :return ports: (tuple) (sport, dport), None without usable ports
+    """
+    v_hl, ip_len, frag, proto = _IP_FIELDS.unpack_from(buf,
+                                                       offset + ETH_HDR_LEN)
+    if frag & IP_OFFMASK:
+        return None
+    hl = (v_hl & 0xf) << 2
+    available = caplen - ETH_HDR_LEN
+    if ip_len and ip_len < available:
+        available = ip_len
+    l4 = offset + ETH_HDR_LEN + hl
+    if proto == IP_PROTO_TCP and available - hl >= TCP_HDR_LEN:
+        sport, dport, off = _TCP_PORTS.unpack_from(buf, l4)
+        return (sport, dport) if off >> 4 >= 5 else None
+    if proto == IP_PROTO_UDP and available - hl >= UDP_HDR_LEN:
+        return _UDP_PORTS.unpack_from(buf, l4)
+    return None
+
+
+def _port_match(buf, offset, caplen, low, high, direction):
+    ports = _ports(buf, offset, caplen)
+    if ports is None:
+        return False
+    if direction == 'src':
+        return low <= ports[0] <= high
+    if direction == 'dst':
+        return low <= ports[1] <= high
+    return low <= ports[0] <= high or low <= ports[1] <= high
+
+
+class _Parser(object):
+    """
+    Recursive descent parser producing nested tuples:
+    ('or', a, b), ('and', a, b), ('not', a), ('ip',), ('proto', n),
+    ('host', direction, address), ('net', direction, address, mask),
+    ('port', direction, low, high), ('field', name, op, value)
+    """
+    def __init__(self, expression):
+        self.tokens = []
+        position = 0
+        expression = expression.strip().lower()
+        while position < len(expression):
+            m = _TOKEN.match(expression, position)
+            if m is None or m.end() == position:
+                raise ValueError('invalid filter at: %s' %
+                                 expression[position:])
+            self.tokens.append(m.group(m.lastindex))
+            position = m.end()
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError('invalid filter: expected %s, got %s' %
+                             (expected or 'more', token))
+        self.position += 1
+        return token
+
+    def number(self):
+        token = self.next()
+        try:
+            return float(token) if '.' in token else int(token)
+        except ValueError:
+            raise ValueError('invalid filter: expected a number, got %s' %
+                             token)
+
+    def parse(self):
+        node = self.expr()
+        if self.peek() is not None:
+            raise ValueError('invalid filter: unexpected %s' % self.peek())
+        return node
+
+    def expr(self):
+        node = self.term()
+        while self.peek() in ('or', '||'):
+            self.next()
+            node = ('or', node, self.term())
+        return node
+
+    def term(self):
+        node = self.factor()
+        while self.peek() in ('and', '&&'):
+            self.next()
+            node = ('and', node, self.factor())
+        return node
+
+    def factor(self):
+        token = self.peek()
+        if token in ('not', '!'):
+            self.next()
+            return 'not', self.factor()
+        if token == '(':
+            self.next()
+            node = self.expr()
+            self.next(')')
+            return node
+        return self.primitive()
+
+    def primitive(self):
+        token = self.next()
+        if token == 'ip':
+            return 'ip',
+        if token in _PROTOS:
+            return 'proto', _PROTOS[token]
+        if token == 'proto':
+            return 'proto', self.number()
+        if token in ('tos', 'dscp', 'time'):
+            op = self.next() if self.peek() in _OPS else None
+            if op is None and token == 'time':
+                raise ValueError('invalid filter: time requires one of %s' %
+                                 ', '.join(_OPS))
+            return 'field', token, op or '==', self.number()
+        direction = None
+        if token in ('src', 'dst'):
+            direction = token
+            token = self.next()
+        if token == 'host':
+            return 'host', direction, _address(self.next())
+        if token == 'net':
+            address, _, length = self.next().partition('/')
+            length = int(length or 32)
+            mask = (0xffffffff << (32 - length)) & 0xffffffff
+            return 'net', direction, _address(address) & mask, mask
+        if token == 'port':
+            port = self.number()
+            return 'port', direction, port, port
+        if token == 'portrange':
+            low, _, high = self.next().partition('-')
+            return 'port', direction, int(low), int(high or low)
+        raise ValueError('invalid filter: unexpected %s' % token)
+
+
+def _address(text):
+    try:
+        return _U32(socket.inet_aton(text))[0]
+    except (socket.error, struct.error):
+        raise ValueError('invalid filter: bad address %s' % text)
+
+
+def _python(node):
+    """
+    Python expression of a node over the frame at offset o of buffer b with
+    caplen c and timestamp ts. ip is True for frames with an IPv4 header.
+    """
+    kind = node[0]
+    if kind in ('or', 'and'):
+        return '(%s %s %s)' % (_python(node[1]), kind, _python(node[2]))
+    if kind == 'not':
+        return '(not %s)' % _python(node[1])
+    if kind == 'ip':
+        return 'ip'
+    if kind == 'proto':
+        return '(ip and u8(b, o + %d)[0] == %d)' % (_OFF_PROTO, node[1])
+    if kind in ('host', 'net'):
+        direction = node[1]
+        mask = ' & %d' % node[3] if kind == 'net' else ''
+        tests = ['u32(b, o + %d)[0]%s == %d' % (off, mask, node[2])
+                 for name, off in (('src', _OFF_SRC), ('dst', _OFF_DST))
+                 if direction in (None, name)]
+        return '(ip and (%s))' % ' or '.join(tests)
+    if kind == 'port':
+        return '(ip and port_match(b, o, c, %d, %d, %r))' % (node[2], node[3],
+                                                            node[1])
+    _, name, op, value = node
+    if name == 'time':
+        return '(ts %s %r)' % (op, value)
+    field = 'u8(b, o + %d)[0]' % _OFF_TOS
+    if name == 'dscp':
+        field += ' >> 2'
+    return '(ip and %s %s %r)' % (field, op, value)
+
+
+def _numpy(node):
+    """
+    NumPy expression of a node over the PACKET_DTYPE array p with
+    timestamps ts. ip is the mask of packets with an IPv4 header.
+    """
+    kind = node[0]
+    if kind in ('or', 'and'):
+        return '(%s %s %s)' % (_numpy(node[1]), '|' if kind == 'or' else '&',
+                               _numpy(node[2]))
+    if kind == 'not':
+        return '(~%s)' % _numpy(node[1])
+    if kind == 'ip':
+        return 'ip'
+    if kind == 'proto':
+        return "(ip & (p['proto'] == %d))" % node[1]
+    if kind in ('host', 'net'):
+        direction = node[1]
+        mask = ' & %d' % node[3] if kind == 'net' else ''
+        tests = ["((p['%s']%s) == %d)" % (name, mask, node[2])
+                 for name in ('src', 'dst') if direction in (None, name)]
+        return '(ip & (%s))' % ' | '.join(tests)
+    if kind == 'port':
+        _, direction, low, high = node
+        tests = ["((p['%s'] >= %d) & (p['%s'] <= %d))" % (name, low, name,
+                                                           high)
+                 for name, which in (('sport', 'src'), ('dport', 'dst'))
+                 if direction in (None, which)]
+        return '(ports & (%s))' % ' | '.join(tests)
+    _, name, op, value = node
+    if name == 'time':
+        return '(ts %s %r)' % (op, value)
+    field = "p['tos']"
+    if name == 'dscp':
+        field = '(%s >> 2)' % field
+    return '(ip & (%s %s %r))' % (field, op, value)
+
+
+_MATCH_SOURCE = """
+def match(b, o, c, ts):
+    ip = c >= %d and u16(b, o + %d)[0] == %d and u8(b, o + %d)[0] & 15 >= 5
+    return %s
+"""
+
+
+class PacketFilter(object):
+    """
+    Compiled filter expression.
+
+    match(buf, offset, caplen, ts) tests the raw frame at offset in buf (any
+    object supporting the buffer protocol) with caplen captured bytes and
+    timestamp ts, and returns True if it passes the filter.
+    """
+    def __init__(self, expression):
+        """
+        :param expression: (str) filter expression, see the module docstring
+        """
+        self.expression = expression
+        self._tree = _Parser(expression).parse()
+        namespace = {'u8': _U8, 'u16': _U16, 'u32': _U32,
+                     'port_match': _port_match}
+        exec compile(_MATCH_SOURCE % (ETH_HDR_LEN + IP_HDR_LEN, _OFF_ETH_TYPE,
+                                      ETH_TYPE_IP, _OFF_V_HL,
+                                      _python(self._tree)),
+                     '<filter>', 'exec') in namespace
+        self.match = namespace['match']
+        self._mask = None
+
+    def mask(self, packets, ts):
+        """
+        Test a batch of decoded packets.
+        :param packets: (numpy.ndarray) array of pcap_batch.PACKET_DTYPE
+        :param ts: (numpy.ndarray) float timestamps of the packets
+        :return mask: (numpy.ndarray) True for packets passing the filter
+        """
+        if self._mask is None:
+            self._mask = eval(compile(
+                'lambda p, ts, ip, ports: %s' % _numpy(self._tree),
+                '<filter>', 'eval'))
+        kinds = packets['kind']
+        ip = has_ip4(kinds)
+        ports = (kinds == PKT_TCP) | (kinds == PKT_UDP)
+        return self._mask(packets, ts, ip, ports)
+
+
+def compile_filter(expression):
+    """
+    :param expression: (str) filter expression, see the module docstring
+    :return packet_filter: (PacketFilter) compiled filter
+    """
+    return PacketFilter(expression)
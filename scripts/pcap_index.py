@@ -0,0 +1,266 @@
+"""
+Sidecar record index for pcap files.
+
+<file>.idx stores the offset and timestamp of every Nth record of <file>, so
+readers can seek to a time window or split the file into ranges of records
+without walking all record headers first. The index is only valid for the
+size and modification time of the pcap file it was built from.
+
+Seeking by time assumes the records are in capture order, as they are in the
+traces of a single capture.
+"""
+import os
+import time
+import bisect
+import struct
+import calendar
+
+from pcap_mmap import *
+
+# Records between two index entries
+INDEX_INTERVAL = 4096
+INDEX_EXTENSION = '.idx'
+INDEX_MAGIC = b'PCIX'
+INDEX_VERSION = 1
+
+# Magic, version, nanosecond timestamps, interval, pcap size, pcap
+# modification time, number of records and number of entries.
+_HEADER = struct.Struct('<4sBBxxIQdQQ')
+# Bytes copied at a time by slice_pcap()
+COPY_SIZE = 1 << 20
+
+
+class PcapIndex(object):
+    """
+    Offsets and timestamps of every interval-th record of a pcap file.
+    """
+    def __init__(self, offsets, secs, fracs, interval, count, size, mtime,
+                 nano=False):
+        """
+        :param offsets: (list[int]) offsets of the indexed record headers
+        :param secs: (list[int]) timestamp seconds of the indexed records
+        :param fracs: (list[int]) timestamp fractions of the indexed records
+        :param interval: (int) records between two entries
+        :param count: (int) number of records in the file
+        :param size: (int) size of the pcap file
+        :param mtime: (float) modification time of the pcap file
+        :param nano: (bool) timestamp fractions are nanoseconds
+        """
+        self.offsets = offsets
+        self.secs = secs
+        self.fracs = fracs
+        self.interval = interval
+        self.count = count
+        self.size = size
+        self.mtime = mtime
+        self.nano = nano
+        scale = 1E9 if nano else 1E6
+        self.timestamps = [sec + frac / scale
+                           for sec, frac in zip(secs, fracs)]
+
+    def is_current(self, filename):
+        """
+        :param filename: (str) path to the pcap file
+        :return current: (bool) True if the file did not change since the
+        index was built
+        """
+        st = os.stat(filename)
+        return st.st_size == self.size and st.st_mtime == self.mtime
+
+    def find(self, reader, ts):
+        """
+        Offset of the first record captured at or after ts. Walks at most
+        interval records from the closest entry.
+        :param reader: (MmapPcapReader) the indexed pcap file
+        :param ts: (float) timestamp
+        :return offset: (int) offset of the record header, the file size if
+        all records are older
+        """
+        i = bisect.bisect_left(self.timestamps, ts)
+        if i == 0:
+            return PCAP_GLOBAL_HDR_LEN
+        for record_ts, offset, _, _ in reader.records(self.offsets[i - 1]):
+            if record_ts >= ts:
+                return offset - PCAP_RECORD_HDR_LEN
+        return reader.size
+
+    def time_range(self, reader, start, end):
+        """
+        Records captured in a time window.
+        :param reader: (MmapPcapReader) the indexed pcap file
+        :param start: (float) first timestamp of the window
+        :param end: (float) timestamp the window ends before
+        :return (start, end): (int, int) offsets of the first record of the
+        window and of the first record after it, see MmapPcapReader.records()
+        """
+        first = self.find(reader, start)
+        return first, max(first, self.find(reader, end))
+
+    def split(self, n_chunks, start=PCAP_GLOBAL_HDR_LEN, end=None):
+        """
+        Partition records into contiguous ranges of about equal size at
+        indexed records. Same as MmapPcapReader.split() without reading the
+        file.
+        :param n_chunks: (int) number of ranges
+        :param start: (int) offset of the first record header
+        :param end: (int) offset to stop at (default: end of file)
+        :return ranges: (list[tuple]) (start, end) offsets of at most n_chunks
+        ranges in file order
+        """
+        end = self.size if end is None else end
+        step = max(1, (end - start) // max(1, n_chunks))
+        boundaries = [start]
+        for offset in self.offsets:
+            if offset >= end or len(boundaries) >= n_chunks:
+                break
+            if offset >= boundaries[-1] + step:
+                boundaries.append(offset)
+        boundaries.append(end)
+        return zip(boundaries[:-1], boundaries[1:])
+
+    def write(self, index_file):
+        """
+        Write the index, replacing index_file atomically.
+        :param index_file: (str) path to the index file
+        """
+        n = len(self.offsets)
+        tmp_file = index_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.nano,
+                                 self.interval, self.size, self.mtime,
+                                 self.count, n))
+            f.write(struct.pack('<%dQ' % n, *self.offsets))
+            f.write(struct.pack('<%dI' % n, *self.secs))
+            f.write(struct.pack('<%dI' % n, *self.fracs))
+        os.rename(tmp_file, index_file)
+
+    @classmethod
+    def read(cls, index_file):
+        """
+        :param index_file: (str) path to the index file
+        :return index: (PcapIndex) index read from the file
+        """
+        with open(index_file, 'rb') as f:
+            data = f.read()
+        if len(data) < _HEADER.size:
+            raise ValueError('invalid index file=%s' % index_file)
+        (magic, version, nano, interval, size, mtime, count,
+         n) = _HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or \
+                len(data) != _HEADER.size + n * 16:
+            raise ValueError('invalid index file=%s' % index_file)
+        offset = _HEADER.size
+        offsets = list(struct.unpack_from('<%dQ' % n, data, offset))
+        secs = list(struct.unpack_from('<%dI' % n, data, offset + n * 8))
+        fracs = list(struct.unpack_from('<%dI' % n, data, offset + n * 12))
+        return cls(offsets, secs, fracs, interval, count, size, mtime,
+                   bool(nano))
+
+
+def index_path(filename):
+    """
+    :param filename: (str) path to the pcap file
+    :return index_file: (str) path to its sidecar index
+    """
+    return filename + INDEX_EXTENSION
+
+
+def build_index(filename, interval=INDEX_INTERVAL, index_file=None):
+    """
+    Walk the record headers of a pcap file and write its sidecar index.
+    :param filename: (str) path to the pcap file
+    :param interval: (int) records between two index entries
+    :param index_file: (str) path to the index (default: index_path())
+    :return index: (PcapIndex) the index
+    """
+    mtime = os.stat(filename).st_mtime
+    offsets = []
+    secs = []
+    fracs = []
+    count = 0
+    with MmapPcapReader(filename) as reader:
+        buf = reader.buf
+        unpack_record = struct.Struct(reader.endian + 'IIII').unpack_from
+        offset = PCAP_GLOBAL_HDR_LEN
+        while offset + PCAP_RECORD_HDR_LEN <= reader.size:
+            sec, frac, caplen, _ = unpack_record(buf, offset)
+            if not count % interval:
+                offsets.append(offset)
+                secs.append(sec)
+                fracs.append(frac)
+            count += 1
+            offset += PCAP_RECORD_HDR_LEN + caplen
+        index = PcapIndex(offsets, secs, fracs, interval, count, reader.size,
+                          mtime, reader.nano)
+    index.write(index_file or index_path(filename))
+    return index
+
+
+def load_index(filename, index_file=None):
+    """
+    :param filename: (str) path to the pcap file
+    :param index_file: (str) path to the index (default: index_path())
+    :return index: (PcapIndex) the sidecar index, None if it is missing or
+    out of date
+    """
+    index_file = index_file or index_path(filename)
+    if not os.path.exists(index_file):
+        return None
+    try:
+        index = PcapIndex.read(index_file)
+    except ValueError:
+        return None
+    return index if index.is_current(filename) else None
+
+
+def open_index(filename, interval=INDEX_INTERVAL):
+    """
+    :param filename: (str) path to the pcap file
+    :param interval: (int) records between two entries of a new index
+    :return index: (PcapIndex) the sidecar index, built if it is missing or
+    out of date
+    """
+    return load_index(filename) or build_index(filename, interval)
+
+
+def _seconds(clock):
+    parts = [int(p) for p in clock.split(':')]
+    return sum(p * 60 ** (2 - i) for i, p in enumerate(parts))
+
+
+def clock_window(index, start, end):
+    """
+    Timestamps of a time-of-day window on the (UTC) day the capture started.
+    :param index: (PcapIndex) index of the pcap file
+    :param start: (str) start of the window as 'HH:MM' or 'HH:MM:SS'
+    :param end: (str) end of the window as 'HH:MM' or 'HH:MM:SS'. A window
+    ending before it starts ends on the next day.
+    :return (start, end): (int, int) timestamps of the window
+    """
+    first = index.secs[0] if index.secs else 0
+    day = calendar.timegm(time.gmtime(first)[:3] + (0, 0, 0))
+    start, end = day + _seconds(start), day + _seconds(end)
+    if end < start:
+        end += 86400
+    return start, end
+
+
+def slice_pcap(filename, output_file, start, end, index=None):
+    """
+    Write the records of a time window into a new pcap file by copying the
+    global header and the byte range of the records.
+    :param filename: (str) path to the pcap file
+    :param output_file: (str) path to the new pcap file
+    :param start: (float) first timestamp of the window
+    :param end: (float) timestamp the window ends before
+    :param index: (PcapIndex) index of the file (default: open_index())
+    :return count: (int) number of bytes of records copied
+    """
+    index = index or open_index(filename)
+    with MmapPcapReader(filename) as reader:
+        first, last = index.time_range(reader, start, end)
+        with open(output_file, 'wb') as f:
+            f.write(reader.buf[:PCAP_GLOBAL_HDR_LEN])
+            for offset in range(first, last, COPY_SIZE):
+                f.write(reader.buf[offset:min(offset + COPY_SIZE, last)])
+    return last - first
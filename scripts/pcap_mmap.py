@@ -0,0 +1,572 @@
+"""
+Memory-mapped pcap reader.
+
+Walks pcap record headers by offset inside a read-only mmap of the trace and
+decodes the few Ethernet/IPv4/TCP/UDP header fields analyze() needs with
+struct.unpack_from, so no per-packet dpkt objects (or slice copies) are built.
+"""
+import os
+import mmap
+import struct
+from decimal import Decimal
+from collections import deque
+
+# pcap file format
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NANO = 0xa1b23c4d
+PCAP_GLOBAL_HDR_LEN = 24
+PCAP_RECORD_HDR_LEN = 16
+
+ETH_HDR_LEN = 14
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IP6 = 0x86dd
+# 802.1Q, 802.1ad and legacy QinQ tags
+ETH_TYPES_VLAN = (0x8100, 0x88a8, 0x9100)
+VLAN_TAG_LEN = 4
+IP_HDR_LEN = 20
+IP6_HDR_LEN = 40
+IP_OFFMASK = 0x1fff
+IP_MF = 0x2000
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+TCP_HDR_LEN = 20
+UDP_HDR_LEN = 8
+# IPv6 extension headers with a length in 8-byte units after the first 8
+IP6_EXT_HEADERS = (0, 43, 60, 135, 139, 140)
+IP6_PROTO_FRAGMENT = 44
+IP6_PROTO_AH = 51
+IP6_OFFMASK = 0xfff8
+# IPv4 datagrams tracked by a FragmentTable at once, and seconds of capture
+# time a datagram is tracked after its first fragment (the default
+# reassembly timeout of Linux).
+FRAGMENT_TABLE_SIZE = 4096
+FRAGMENT_TIMEOUT = 30
+
+# Packet kinds returned by decode_packet(). They mirror the branches the dpkt
+# path of analyze() ends up in, so both engines count packets the same way.
+PKT_INVALID = 0         # Shorter than an Ethernet header
+PKT_NON_IP4 = 1         # Ethernet type is not IPv4
+PKT_IP_INVALID = 2      # IPv4 Ethernet type but unparseable IPv4 header
+PKT_IP = 3              # IPv4, neither TCP nor UDP
+PKT_TCP = 4
+PKT_UDP = 5
+PKT_TCP_NO_PORTS = 6    # TCP without a usable header (fragment/truncated)
+PKT_UDP_NO_PORTS = 7    # UDP without a usable header (fragment/truncated)
+PKT_FILTERED = 8        # Rejected by a packet filter, not decoded
+# IPv6 kinds, only returned by decode_frame()
+PKT_IP6_INVALID = 9     # IPv6 Ethernet type but truncated IPv6 header
+PKT_IP6 = 10            # IPv6, neither TCP nor UDP
+PKT_TCP6 = 11
+PKT_UDP6 = 12
+PKT_TCP6_NO_PORTS = 13  # TCP without a usable header (fragment/truncated)
+PKT_UDP6_NO_PORTS = 14  # UDP without a usable header (fragment/truncated)
+# IPv4 TCP/UDP fragments, resolved by FragmentTable.resolve() before readers
+# yield them
+PKT_TCP_FRAGMENT = 15
+PKT_UDP_FRAGMENT = 16
+N_KINDS = PKT_UDP_FRAGMENT + 1
+
+# Per kind: counted as TCP, counted as UDP, has a decoded IP header, has ports
+KIND_TCP = [kind in (PKT_TCP, PKT_TCP_NO_PORTS, PKT_TCP6, PKT_TCP6_NO_PORTS)
+            for kind in range(N_KINDS)]
+KIND_UDP = [kind in (PKT_UDP, PKT_UDP_NO_PORTS, PKT_UDP6, PKT_UDP6_NO_PORTS)
+            for kind in range(N_KINDS)]
+KIND_HAS_IP = [kind in (PKT_IP, PKT_IP6) or KIND_TCP[kind] or KIND_UDP[kind]
+               for kind in range(N_KINDS)]
+KIND_HAS_PORTS = [kind in (PKT_TCP, PKT_UDP, PKT_TCP6, PKT_UDP6)
+                  for kind in range(N_KINDS)]
+
+_ETH_TYPE = struct.Struct('!12xH')
+# Ethernet type, version/IHL, TOS, total length, flags/fragment offset,
+# protocol, source and destination address.
+_ETH_IP4 = struct.Struct('!12xHBBH2xHxB2x4s4s')
+# Ports, data offset and flags
+_TCP_PORTS = struct.Struct('!HH8xBB')
+_UDP_PORTS = struct.Struct('!HH')
+_U16 = struct.Struct('!H')
+# IPv4 header without Ethernet header: version/IHL, TOS, total length,
+# flags/fragment offset, protocol, source and destination address.
+_IP4 = struct.Struct('!BBH2xHxB2x4s4s')
+# Version/traffic class/flow label, payload length, next header, source and
+# destination address.
+_IP6 = struct.Struct('!IHBx16s16s')
+_IP6_EXT = struct.Struct('!BB')
+_IP6_FRAGMENT = struct.Struct('!BxH')
+# More fragments flag and fragment offset
+_IP_FRAGMENT = IP_MF | IP_OFFMASK
+
+_NO_ADDR = b'\x00' * 4
+_INVALID = (PKT_INVALID, 0, _NO_ADDR, 0, _NO_ADDR, 0, 0, 0)
+_IP_INVALID = (PKT_IP_INVALID, 0, _NO_ADDR, 0, _NO_ADDR, 0, 0, 0)
+_IP6_INVALID = (PKT_IP6_INVALID, 0, _NO_ADDR, 0, _NO_ADDR, 0, 0, 0)
+# Packet tuple yielded for records rejected by a packet filter
+FILTERED = (None, 0, PKT_FILTERED, 0, _NO_ADDR, 0, _NO_ADDR, 0, 0, 0)
+
+
+def has_ip4(kinds):
+    """
+    :param kinds: (numpy.ndarray) kind column of a pcap_batch block
+    :return mask: (numpy.ndarray) True for the packets with a decoded IPv4
+    header
+    """
+    return (kinds >= PKT_IP) & (kinds <= PKT_UDP_NO_PORTS)
+
+
+def decode_packet(buf, offset, caplen):
+    """
+    Decode the Ethernet/IPv4/TCP/UDP fields of a captured frame in place.
+    :param buf: (buffer) object supporting the buffer protocol (mmap, str)
+    :param offset: (int) offset of the first byte of the frame in buf
+    :param caplen: (int) number of captured bytes of the frame
+    :return packet: (tuple) (kind, proto, src, sport, dst, dport, tos, flags)
+    where kind is one of the PKT_* constants, src/dst are 4-byte packed
+    addresses and flags are the TCP flags, 0 for other packets. proto is
+    the Ethernet type of PKT_NON_IP4 frames.
+    TCP and UDP fragments are returned as PKT_*_FRAGMENT tuples to resolve
+    with FragmentTable.resolve().
+    """
+    if caplen < ETH_HDR_LEN:
+        return _INVALID
+    if caplen < ETH_HDR_LEN + IP_HDR_LEN:
+        eth_type = _ETH_TYPE.unpack_from(buf, offset)[0]
+        if eth_type != ETH_TYPE_IP:
+            return PKT_NON_IP4, eth_type, _NO_ADDR, 0, _NO_ADDR, 0, 0, 0
+        return _IP_INVALID
+    (eth_type, v_hl, tos, ip_len, frag, proto, src,
+     dst) = _ETH_IP4.unpack_from(buf, offset)
+    if eth_type != ETH_TYPE_IP:
+        return PKT_NON_IP4, eth_type, _NO_ADDR, 0, _NO_ADDR, 0, 0, 0
+    hl = (v_hl & 0xf) << 2
+    if hl < IP_HDR_LEN:
+        return _IP_INVALID
+    # Bytes of the IP datagram available, trimmed to the IP total length.
+    available = caplen - ETH_HDR_LEN
+    if ip_len and ip_len < available:
+        available = ip_len
+    l4_len = available - hl
+    l4 = offset + ETH_HDR_LEN + hl
+    if proto == IP_PROTO_TCP:
+        if frag & _IP_FRAGMENT:
+            return _fragment(buf, offset + ETH_HDR_LEN, l4, l4_len, frag,
+                             proto, src, dst, tos)
+        if l4_len < TCP_HDR_LEN:
+            return PKT_TCP_NO_PORTS, proto, src, 0, dst, 0, tos, 0
+        sport, dport, off, flags = _TCP_PORTS.unpack_from(buf, l4)
+        if off >> 4 < 5:
+            return PKT_TCP_NO_PORTS, proto, src, 0, dst, 0, tos, 0
+        return PKT_TCP, proto, src, sport, dst, dport, tos, flags
+    elif proto == IP_PROTO_UDP:
+        if frag & _IP_FRAGMENT:
+            return _fragment(buf, offset + ETH_HDR_LEN, l4, l4_len, frag,
+                             proto, src, dst, tos)
+        if l4_len < UDP_HDR_LEN:
+            return PKT_UDP_NO_PORTS, proto, src, 0, dst, 0, tos, 0
+        sport, dport = _UDP_PORTS.unpack_from(buf, l4)
+        return PKT_UDP, proto, src, sport, dst, dport, tos, 0
+    return PKT_IP, proto, src, 0, dst, 0, tos, 0
+
+
+def _fragment(buf, l3, l4, l4_len, frag, proto, src, dst, tos):
+    """
+    Decode a TCP or UDP fragment of an IPv4 datagram.
+    :param l3: (int) offset of the IPv4 header in buf
+    :param l4: (int) offset of the IPv4 payload in buf
+    :param l4_len: (int) bytes of the payload available
+    :param frag: (int) flags/fragment offset field of the IPv4 header
+    :return packet: (tuple) (kind, proto, src, sport, dst, dport, tos, flags,
+    id, frag) where kind is PKT_TCP_FRAGMENT or PKT_UDP_FRAGMENT and the ports
+    are None unless this is a first fragment with a usable header
+    """
+    ip_id = _U16.unpack_from(buf, l3 + 4)[0]
+    if proto == IP_PROTO_TCP:
+        kind = PKT_TCP_FRAGMENT
+        if not frag & IP_OFFMASK and l4_len >= TCP_HDR_LEN:
+            sport, dport, off, flags = _TCP_PORTS.unpack_from(buf, l4)
+            if off >> 4 >= 5:
+                return (kind, proto, src, sport, dst, dport, tos, flags,
+                        ip_id, frag)
+    else:
+        kind = PKT_UDP_FRAGMENT
+        if not frag & IP_OFFMASK and l4_len >= UDP_HDR_LEN:
+            sport, dport = _UDP_PORTS.unpack_from(buf, l4)
+            return kind, proto, src, sport, dst, dport, tos, 0, ip_id, frag
+    return kind, proto, src, None, dst, None, tos, 0, ip_id, frag
+
+
+def _decode_ip4(buf, l3, end):
+    """
+    Decode an IPv4 packet at any offset, e.g. behind VLAN tags. Same rules as
+    decode_packet(), which stays separate as the fast path for untagged
+    frames.
+    :param l3: (int) offset of the IPv4 header in buf
+    :param end: (int) offset of the end of the captured frame
+    """
+    if end - l3 < IP_HDR_LEN:
+        return _IP_INVALID
+    v_hl, tos, ip_len, frag, proto, src, dst = _IP4.unpack_from(buf, l3)
+    hl = (v_hl & 0xf) << 2
+    if hl < IP_HDR_LEN:
+        return _IP_INVALID
+    available = end - l3
+    if ip_len and ip_len < available:
+        available = ip_len
+    l4_len = available - hl
+    if proto == IP_PROTO_TCP:
+        if frag & _IP_FRAGMENT:
+            return _fragment(buf, l3, l3 + hl, l4_len, frag, proto, src, dst,
+                             tos)
+        if l4_len < TCP_HDR_LEN:
+            return PKT_TCP_NO_PORTS, proto, src, 0, dst, 0, tos, 0
+        sport, dport, off, flags = _TCP_PORTS.unpack_from(buf, l3 + hl)
+        if off >> 4 < 5:
+            return PKT_TCP_NO_PORTS, proto, src, 0, dst, 0, tos, 0
+        return PKT_TCP, proto, src, sport, dst, dport, tos, flags
+    elif proto == IP_PROTO_UDP:
+        if frag & _IP_FRAGMENT:
+            return _fragment(buf, l3, l3 + hl, l4_len, frag, proto, src, dst,
+                             tos)
+        if l4_len < UDP_HDR_LEN:
+            return PKT_UDP_NO_PORTS, proto, src, 0, dst, 0, tos, 0
+        sport, dport = _UDP_PORTS.unpack_from(buf, l3 + hl)
+        return PKT_UDP, proto, src, sport, dst, dport, tos, 0
+    return PKT_IP, proto, src, 0, dst, 0, tos, 0
+
+
+def _decode_ip6(buf, l3, end):
+    """
+    Decode an IPv6 packet, walking the extension headers to the upper-layer
+    header. Non-first fragments have no ports.
+    :param l3: (int) offset of the IPv6 header in buf
+    :param end: (int) offset of the end of the captured frame
+    """
+    if end - l3 < IP6_HDR_LEN:
+        return _IP6_INVALID
+    vtf, payload_len, proto, src, dst = _IP6.unpack_from(buf, l3)
+    tos = (vtf >> 20) & 0xff
+    offset = l3 + IP6_HDR_LEN
+    # Trim to the payload length, 0 for jumbograms
+    if payload_len and offset + payload_len < end:
+        end = offset + payload_len
+    fragment = False
+    while offset + 8 <= end:
+        if proto in IP6_EXT_HEADERS:
+            next_proto, length = _IP6_EXT.unpack_from(buf, offset)
+            offset += (length + 1) << 3
+        elif proto == IP6_PROTO_FRAGMENT:
+            next_proto, frag = _IP6_FRAGMENT.unpack_from(buf, offset)
+            fragment = fragment or bool(frag & IP6_OFFMASK)
+            offset += 8
+        elif proto == IP6_PROTO_AH:
+            next_proto, length = _IP6_EXT.unpack_from(buf, offset)
+            offset += (length + 2) << 2
+        else:
+            break
+        proto = next_proto
+    l4_len = end - offset
+    if proto == IP_PROTO_TCP:
+        if fragment or l4_len < TCP_HDR_LEN:
+            return PKT_TCP6_NO_PORTS, proto, src, 0, dst, 0, tos, 0
+        sport, dport, off, flags = _TCP_PORTS.unpack_from(buf, offset)
+        if off >> 4 < 5:
+            return PKT_TCP6_NO_PORTS, proto, src, 0, dst, 0, tos, 0
+        return PKT_TCP6, proto, src, sport, dst, dport, tos, flags
+    elif proto == IP_PROTO_UDP:
+        if fragment or l4_len < UDP_HDR_LEN:
+            return PKT_UDP6_NO_PORTS, proto, src, 0, dst, 0, tos, 0
+        sport, dport = _UDP_PORTS.unpack_from(buf, offset)
+        return PKT_UDP6, proto, src, sport, dst, dport, tos, 0
+    return PKT_IP6, proto, src, 0, dst, 0, tos, 0
+
+
+def decode_frame(buf, offset, caplen):
+    """
+    Like decode_packet(), but also decodes IPv6 (kinds PKT_*6*, 16-byte
+    addresses, traffic class as tos) and IPv4/IPv6 behind stacked VLAN
+    tags. Untagged IPv4 frames take the decode_packet() path.
+    :param buf: (buffer) object supporting the buffer protocol (mmap, str)
+    :param offset: (int) offset of the first byte of the frame in buf
+    :param caplen: (int) number of captured bytes of the frame
+    :return packet: (tuple) (kind, proto, src, sport, dst, dport, tos, flags)
+    """
+    if caplen < ETH_HDR_LEN:
+        return _INVALID
+    eth_type = _ETH_TYPE.unpack_from(buf, offset)[0]
+    if eth_type == ETH_TYPE_IP:
+        return decode_packet(buf, offset, caplen)
+    l3 = offset + ETH_HDR_LEN
+    end = offset + caplen
+    while eth_type in ETH_TYPES_VLAN and l3 + VLAN_TAG_LEN <= end:
+        eth_type = _U16.unpack_from(buf, l3 + 2)[0]
+        l3 += VLAN_TAG_LEN
+    if eth_type == ETH_TYPE_IP:
+        return _decode_ip4(buf, l3, end)
+    if eth_type == ETH_TYPE_IP6:
+        return _decode_ip6(buf, l3, end)
+    # Ethernet type behind the VLAN tags
+    return PKT_NON_IP4, eth_type, _NO_ADDR, 0, _NO_ADDR, 0, 0, 0
+
+
+class FragmentTable(object):
+    """
+    Ports of fragmented IPv4 datagrams, so that the non-first fragments of a
+    datagram can be written with the ports of its first fragment. Datagrams
+    are keyed on (src, dst, id, proto) and forgotten after their last
+    fragment. The table holds at most size datagrams: the oldest one is
+    evicted when it is full, and datagrams expire timeout seconds of capture
+    time after their first fragment, like the reassembly timer of an IP
+    stack. Fragments seen before the first fragment of their datagram keep
+    no ports.
+    """
+    def __init__(self, size=FRAGMENT_TABLE_SIZE, timeout=FRAGMENT_TIMEOUT):
+        """
+        :param size: (int) maximum number of datagrams tracked, 0 to only
+        keep the ports of first fragments
+        :param timeout: (float) seconds of capture time a datagram is tracked
+        after its first fragment
+        """
+        self.size = size
+        self.timeout = timeout
+        # Key to (sport, dport, ts of the first fragment)
+        self._datagrams = {}
+        # (key, ts) in the order first fragments were seen. Entries of
+        # datagrams completed since are skipped when they come up.
+        self._order = deque()
+        # Non-first fragments given the ports of their first fragment
+        self.resolved = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._datagrams)
+
+    def _evict(self):
+        datagrams = self._datagrams
+        while True:
+            key, seen = self._order.popleft()
+            entry = datagrams.get(key)
+            if entry is not None and entry[2] == seen:
+                del datagrams[key]
+                self.evicted += 1
+                return
+
+    def add(self, key, sport, dport, ts):
+        """
+        Remember the ports of a first fragment.
+        :param key: (tuple) (src, dst, id, proto) of the datagram
+        :param sport: (int) source port
+        :param dport: (int) destination port
+        :param ts: (float) timestamp of the fragment
+        """
+        if not self.size:
+            return
+        datagrams = self._datagrams
+        order = self._order
+        deadline = ts - self.timeout
+        while order and order[0][1] < deadline:
+            oldest, seen = order.popleft()
+            entry = datagrams.get(oldest)
+            if entry is not None and entry[2] == seen:
+                del datagrams[oldest]
+                self.expired += 1
+        if key not in datagrams and len(datagrams) >= self.size:
+            self._evict()
+        datagrams[key] = (sport, dport, ts)
+        order.append((key, ts))
+        # Bound the skipped entries of completed datagrams
+        if len(order) > 2 * self.size:
+            self._order = deque((k, v[2]) for k, v in sorted(
+                datagrams.iteritems(), key=lambda item: item[1][2]))
+
+    def get(self, key, ts, last=False):
+        """
+        Look up the ports of a non-first fragment.
+        :param key: (tuple) (src, dst, id, proto) of the datagram
+        :param ts: (float) timestamp of the fragment
+        :param last: (bool) this is the last fragment, forget the datagram
+        :return ports: (tuple) (sport, dport), None if the first fragment was
+        not seen, evicted or expired
+        """
+        datagrams = self._datagrams
+        entry = datagrams.pop(key, None) if last else datagrams.get(key)
+        if entry is None:
+            return None
+        if ts - entry[2] > self.timeout:
+            datagrams.pop(key, None)
+            self.expired += 1
+            return None
+        self.resolved += 1
+        return entry[0], entry[1]
+
+    def resolve(self, ts, packet):
+        """
+        Resolve a fragment returned by decode_packet() into a packet tuple.
+        :param ts: (float) timestamp of the fragment
+        :param packet: (tuple) PKT_TCP_FRAGMENT or PKT_UDP_FRAGMENT tuple
+        :return packet: (tuple) (kind, proto, src, sport, dst, dport, tos,
+        flags) where kind is PKT_TCP/PKT_UDP with ports, or PKT_*_NO_PORTS
+        """
+        kind, proto, src, sport, dst, dport, tos, flags, ip_id, frag = packet
+        tcp = kind == PKT_TCP_FRAGMENT
+        key = (src, dst, ip_id, proto)
+        if frag & IP_OFFMASK:
+            ports = self.get(key, ts, not frag & IP_MF)
+            if ports is not None:
+                sport, dport = ports
+        elif sport is not None:
+            self.add(key, sport, dport, ts)
+        if sport is None:
+            return (PKT_TCP_NO_PORTS if tcp else PKT_UDP_NO_PORTS, proto, src,
+                    0, dst, 0, tos, 0)
+        return (PKT_TCP if tcp else PKT_UDP, proto, src, sport, dst, dport,
+                tos, flags)
+
+
+def parse_global_header(buf):
+    """
+    Parse the pcap global header.
+    :param buf: (buffer) object supporting the buffer protocol holding at
+    least the PCAP_GLOBAL_HDR_LEN bytes of the global header
+    :return (endian, nano, snaplen, linktype): (str, bool, int, int) struct
+    byte order character of the file, whether timestamps are in nanoseconds,
+    snapshot length and link type
+    """
+    magic = struct.unpack_from('<I', buf, 0)[0]
+    if magic in (PCAP_MAGIC, PCAP_MAGIC_NANO):
+        endian = '<'
+    else:
+        magic = struct.unpack_from('>I', buf, 0)[0]
+        if magic not in (PCAP_MAGIC, PCAP_MAGIC_NANO):
+            raise ValueError('invalid pcap magic=%#x' % magic)
+        endian = '>'
+    snaplen, linktype = struct.unpack_from(endian + 'II', buf, 16)
+    return endian, magic == PCAP_MAGIC_NANO, snaplen, linktype
+
+
+class MmapPcapReader(object):
+    """
+    Read-only memory-mapped view of a pcap file.
+    """
+    def __init__(self, filename):
+        """
+        :param filename: (str) path to the pcap file
+        """
+        self._file = open(filename, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size < PCAP_GLOBAL_HDR_LEN:
+            self._file.close()
+            raise ValueError('invalid pcap file=%s' % filename)
+        self.buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (self.endian, self.nano, self.snaplen,
+             self.linktype) = parse_global_header(self.buf)
+        except ValueError:
+            self.close()
+            raise ValueError('invalid pcap file=%s' % filename)
+        # Same arithmetic as dpkt.pcap.Reader so timestamps print identically.
+        self.divisor = Decimal('1E9') if self.nano else 1E6
+        self._record = struct.Struct(self.endian + 'IIII')
+
+    def records(self, start=PCAP_GLOBAL_HDR_LEN, end=None):
+        """
+        Walk the record headers between two offsets.
+        :param start: (int) offset of the first record header
+        :param end: (int) offset to stop at (default: end of file)
+        :return: generator of (ts, offset, caplen, wirelen) where offset
+        points at the first byte of the captured frame
+        """
+        buf = self.buf
+        end = self.size if end is None else end
+        unpack_record = self._record.unpack_from
+        divisor = self.divisor
+        offset = start
+        while offset + PCAP_RECORD_HDR_LEN <= end:
+            sec, frac, caplen, wirelen = unpack_record(buf, offset)
+            offset += PCAP_RECORD_HDR_LEN
+            if caplen > end - offset:
+                # Truncated last record
+                caplen = end - offset
+            yield sec + frac / divisor, offset, caplen, wirelen
+            offset += caplen
+
+    def packets(self, start=PCAP_GLOBAL_HDR_LEN, end=None, match=None,
+                ipv6=False, fragments=None):
+        """
+        Walk the records and decode their headers.
+        :param start: (int) offset of the first record header
+        :param end: (int) offset to stop at (default: end of file)
+        :param match: (function) pcap_filter.PacketFilter.match. Records it
+        rejects are not decoded and yielded as FILTERED.
+        :param ipv6: (bool) also decode IPv6 and VLAN-tagged frames, see
+        decode_frame()
+        :param fragments: (FragmentTable) table giving non-first fragments
+        the ports of their first fragment (default: a new FragmentTable)
+        :return: generator of (ts, length, kind, proto, src, sport, dst,
+        dport, tos, flags) where length is the original length of the frame
+        """
+        buf = self.buf
+        resolve = (fragments if fragments is not None
+                   else FragmentTable()).resolve
+        if match is None and not ipv6:
+            for ts, offset, caplen, length in self.records(start, end):
+                packet = decode_packet(buf, offset, caplen)
+                if packet[0] >= PKT_TCP_FRAGMENT:
+                    packet = resolve(ts, packet)
+                yield (ts, length) + packet
+            return
+        # Most frames are untagged IPv4, only fall back to decode_frame() for
+        # the others.
+        if match is None:
+            for ts, offset, caplen, length in self.records(start, end):
+                packet = decode_packet(buf, offset, caplen)
+                if packet[0] == PKT_NON_IP4:
+                    packet = decode_frame(buf, offset, caplen)
+                if packet[0] >= PKT_TCP_FRAGMENT:
+                    packet = resolve(ts, packet)
+                yield (ts, length) + packet
+            return
+        for ts, offset, caplen, length in self.records(start, end):
+            if not match(buf, offset, caplen, ts):
+                yield FILTERED
+                continue
+            packet = decode_packet(buf, offset, caplen)
+            if ipv6 and packet[0] == PKT_NON_IP4:
+                packet = decode_frame(buf, offset, caplen)
+            if packet[0] >= PKT_TCP_FRAGMENT:
+                packet = resolve(ts, packet)
+            yield (ts, length) + packet
+
+    def split(self, n_chunks, start=PCAP_GLOBAL_HDR_LEN, end=None):
+        """
+        Partition records into contiguous ranges of about equal size. Only
+        the captured lengths are read from the record headers, see
+        pcap_index.PcapIndex.split() to avoid reading them.
+        :param n_chunks: (int) number of ranges
+        :param start: (int) offset of the first record header
+        :param end: (int) offset to stop at (default: end of file)
+        :return ranges: (list[tuple]) (start, end) offsets of at most n_chunks
+        ranges in file order, covering all records
+        """
+        buf = self.buf
+        end = self.size if end is None else end
+        unpack_caplen = struct.Struct(self.endian + 'I').unpack_from
+        step = max(1, (end - start) // max(1, n_chunks))
+        boundaries = [start]
+        target = start + step
+        offset = start
+        while offset + PCAP_RECORD_HDR_LEN <= end:
+            if offset >= target and len(boundaries) < n_chunks:
+                boundaries.append(offset)
+                target = offset + step
+            offset += PCAP_RECORD_HDR_LEN + unpack_caplen(buf, offset + 8)[0]
+        boundaries.append(end)
+        return zip(boundaries[:-1], boundaries[1:])
+
+    def close(self):
+        self.buf.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,236 @@
+"""
+Streaming pcap input.
+
+GunzipReader decompresses a .gz byte stream (e.g. an HTTP response) on the
+fly and StreamPcapReader walks the pcap records of any readable file object.
+Both only hold a bounded amount of data in memory, so a trace can go from the
+network to analyze() without being written to disk.
+"""
+import zlib
+import struct
+from decimal import Decimal
+
+from pcap_mmap import *
+
+# Bytes read from the underlying file object at a time
+CHUNK_SIZE = 1 << 16
+# Bytes of pcap data buffered by StreamPcapReader at a time
+BLOCK_SIZE = 1 << 20
+
+
+def _read_exactly(fileobj, size):
+    """
+    Read size bytes, fewer only at the end of the stream.
+    :param fileobj: (file) readable file object
+    :param size: (int) number of bytes to read
+    :return data: (str) bytes read
+    """
+    parts = []
+    while size > 0:
+        data = fileobj.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+
+class GunzipReader(object):
+    """
+    Read-only file object decompressing a gzip stream incrementally.
+    """
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        """
+        :param fileobj: (file) readable file object with gzip data, e.g. the
+        response of urllib2.urlopen()
+        :param chunk_size: (int) compressed bytes to read at a time
+        """
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._input = b''
+        # Whether the current gzip member got data and did not end yet
+        self._member = False
+        # Counters
+        self.compressed_bytes = 0
+        self.bytes_read = 0
+
+    def _decompress(self, size):
+        """
+        Decompress at most size bytes.
+        :param size: (int) maximum number of bytes to return
+        :return data: (str) decompressed bytes, empty at the end of the stream
+        """
+        while True:
+            if self._input:
+                data = self._decompressor.decompress(self._input, size)
+                self._input = self._decompressor.unconsumed_tail
+                unused = self._decompressor.unused_data
+                if unused:
+                    # End of a gzip member. Continue with the next member,
+                    # ignore trailing padding.
+                    self._decompressor = zlib.decompressobj(
+                        16 + zlib.MAX_WBITS)
+                    self._input = unused if unused.strip(b'\0') else b''
+                    self._member = bool(self._input)
+                if data:
+                    return data
+                continue
+            chunk = self._fileobj.read(self._chunk_size)
+            if not chunk:
+                # urllib2 responses end quietly when the connection drops, a
+                # member without its trailer is the only sign of truncation.
+                if self._member:
+                    if not self._member_complete():
+                        raise IOError('truncated gzip stream after bytes=%s'
+                                      % self.compressed_bytes)
+                    self._member = False
+                return self._decompressor.flush()
+            self.compressed_bytes += len(chunk)
+            self._input = chunk
+            self._member = True
+
+    def _member_complete(self):
+        """
+        zlib only reports the end of a member through the bytes following its
+        trailer, so feed one more byte to the decompressor. Only called at the
+        end of the stream.
+        :return complete: (bool) True if the current member reached the end
+        of its trailer, i.e. its CRC and size were checked
+        """
+        try:
+            self._decompressor.decompress(b'\0')
+        except zlib.error:
+            return False
+        return bool(self._decompressor.unused_data)
+
+    def read(self, size=-1):
+        """
+        :param size: (int) maximum number of bytes to read, all if negative
+        :return data: (str) decompressed bytes, empty at the end of the stream
+        """
+        parts = []
+        while size:
+            data = self._decompress(size if size > 0 else BLOCK_SIZE)
+            if not data:
+                break
+            parts.append(data)
+            if size > 0:
+                size -= len(data)
+        data = b''.join(parts)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+
+class StreamPcapReader(object):
+    """
+    Sequential pcap reader for file objects that can not be memory-mapped.
+    """
+    def __init__(self, fileobj, block_size=BLOCK_SIZE):
+        """
+        :param fileobj: (file) readable file object positioned at the start of
+        the pcap data
+        :param block_size: (int) bytes of pcap data to buffer at a time
+        """
+        self._fileobj = fileobj
+        self._block_size = block_size
+        header = _read_exactly(fileobj, PCAP_GLOBAL_HDR_LEN)
+        if len(header) < PCAP_GLOBAL_HDR_LEN:
+            raise ValueError('invalid pcap stream')
+        (self.endian, self.nano, self.snaplen,
+         self.linktype) = parse_global_header(header)
+        # Same arithmetic as dpkt.pcap.Reader so timestamps print identically.
+        self.divisor = Decimal('1E9') if self.nano else 1E6
+        self._record = struct.Struct(self.endian + 'IIII')
+
+    def records(self):
+        """
+        Walk the records of the stream. The buffer yielded with a record is
+        only valid until the next record is requested. Raises IOError if the
+        stream ends inside a record.
+        :return: generator of (ts, buf, offset, caplen, wirelen) where offset
+        points at the first byte of the captured frame in buf
+        """
+        read = self._fileobj.read
+        unpack_record = self._record.unpack_from
+        divisor = self.divisor
+        buf = b''
+        offset = 0
+        eof = False
+        while True:
+            end = len(buf)
+            while offset + PCAP_RECORD_HDR_LEN <= end:
+                sec, frac, caplen, wirelen = unpack_record(buf, offset)
+                start = offset + PCAP_RECORD_HDR_LEN
+                if start + caplen > end:
+                    # Record continues in the next block
+                    break
+                yield sec + frac / divisor, buf, start, caplen, wirelen
+                offset = start + caplen
+            if eof:
+                if offset < end:
+                    raise IOError('truncated pcap record, bytes=%s of the '
+                                  'stream left' % (end - offset))
+                return
+            # Keep the incomplete record and append the next block. The block
+            # grows beyond block_size only to fit a single large record.
+            data = read(self._block_size)
+            if not data:
+                eof = True
+            buf = buf[offset:] + data
+            offset = 0
+
+    def packets(self, match=None, ipv6=False, fragments=None):
+        """
+        Walk the records and decode their headers.
+        :param match: (function) pcap_filter.PacketFilter.match. Records it
+        rejects are not decoded and yielded as FILTERED.
+        :param ipv6: (bool) also decode IPv6 and VLAN-tagged frames, see
+        decode_frame()
+        :param fragments: (FragmentTable) table giving non-first fragments
+        the ports of their first fragment (default: a new FragmentTable)
+        :return: generator of (ts, length, kind, proto, src, sport, dst,
+        dport, tos, flags) where length is the original length of the frame
+        """
+        resolve = (fragments if fragments is not None
+                   else FragmentTable()).resolve
+        if match is None and not ipv6:
+            for ts, buf, offset, caplen, length in self.records():
+                packet = decode_packet(buf, offset, caplen)
+                if packet[0] >= PKT_TCP_FRAGMENT:
+                    packet = resolve(ts, packet)
+                yield (ts, length) + packet
+            return
+        # Most frames are untagged IPv4, only fall back to decode_frame() for
+        # the others.
+        if match is None:
+            for ts, buf, offset, caplen, length in self.records():
+                packet = decode_packet(buf, offset, caplen)
+                if packet[0] == PKT_NON_IP4:
+                    packet = decode_frame(buf, offset, caplen)
+                if packet[0] >= PKT_TCP_FRAGMENT:
+                    packet = resolve(ts, packet)
+                yield (ts, length) + packet
+            return
+        for ts, buf, offset, caplen, length in self.records():
+            if not match(buf, offset, caplen, ts):
+                yield FILTERED
+                continue
+            packet = decode_packet(buf, offset, caplen)
+            if ipv6 and packet[0] == PKT_NON_IP4:
+                packet = decode_frame(buf, offset, caplen)
+            if packet[0] >= PKT_TCP_FRAGMENT:
+                packet = resolve(ts, packet)
+            yield (ts, length) + packet
+
+    def close(self):
+        self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,151 @@
+"""
+Persistent multi-stage worker pool.
+
+Every stage has its own workers and a bounded input queue. Items flow from one
+stage to the next as soon as a worker is done with them, so a slow item only
+occupies one worker and the stages (e.g. I/O-bound downloads and CPU-bound
+analysis) overlap. Workers are started once and reused for all items.
+Items can carry a weight, e.g. the disk space they take until they leave the
+pool, and only enter it while their total weight stays within a budget.
+"""
+import logging
+import threading
+import multiprocessing
+import multiprocessing.dummy
+from Queue import Empty
+
+# Sentinel telling a worker to exit
+STOP = None
+# Seconds between checks for workers that died
+POLL_INTERVAL = 1
+
+
+def _worker(func, inbox, outbox, results):
+    """
+    Worker loop of a stage.
+    :param func: (function) stage function called with each item. Returning
+    None drops the item.
+    :param inbox: (Queue) input queue of (index, item) tuples
+    :param outbox: (Queue) input queue of the next stage, None for the last
+    stage
+    :param results: (Queue) queue of (index, result) tuples of items leaving
+    the pool
+    """
+    while True:
+        task = inbox.get()
+        if task is STOP:
+            break
+        index, item = task
+        try:
+            result = func(item)
+        except Exception as el1:
+            logging.error('Error=%s while processing item=%s' % (el1, item))
+            result = None
+        if result is None or outbox is None:
+            results.put((index, result))
+        else:
+            outbox.put((index, result))
+
+
+class Pipeline(object):
+    """
+    Pool of persistent workers organized in stages.
+    """
+    def __init__(self, stages, queue_size=None, processes=True):
+        """
+        :param stages: (list[tuple]) (name, func, n_workers) of every stage in
+        order. func is called with the item in the first stage and with the
+        return value of the previous stage in the others.
+        :param queue_size: (int) maximum number of items waiting in front of
+        each stage (default: number of workers of the stage)
+        :param processes: (bool) use processes, or threads if False
+        """
+        self._mp = multiprocessing if processes else multiprocessing.dummy
+        self._stages = stages
+        self._queues = [self._mp.Queue(queue_size or n_workers)
+                        for _, _, n_workers in stages]
+        self._results = self._mp.Queue()
+        # Weight of the items in the pool, see map()
+        self._in_flight = 0
+        self._budget = threading.Condition()
+        self._workers = []
+        for i, (name, func, n_workers) in enumerate(stages):
+            outbox = self._queues[i + 1] if i + 1 < len(stages) else None
+            workers = []
+            for _ in range(n_workers):
+                worker = self._mp.Process(target=_worker,
+                                          args=(func, self._queues[i],
+                                                outbox, self._results))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+            self._workers.append(workers)
+            logging.info('Started %s workers for stage=%s' % (n_workers, name))
+
+    def _feed(self, items, weights, budget):
+        for index, item in enumerate(items):
+            if weights is not None:
+                with self._budget:
+                    # An item over the budget on its own runs alone
+                    while self._in_flight and \
+                            self._in_flight + weights[index] > budget:
+                        self._budget.wait()
+                    self._in_flight += weights[index]
+            self._queues[0].put((index, item))
+
+    def _release(self, weight):
+        with self._budget:
+            self._in_flight -= weight
+            self._budget.notify()
+
+    def map(self, items, weights=None, budget=None):
+        """
+        Run all items through the stages, in order.
+        :param items: (list) items for the first stage
+        :param weights: (list) weight of each item, e.g. bytes on disk
+        :param budget: (float) maximum total weight of the items in the pool
+        at once, None for no limit
+        :return results: (list) return value of the last stage for each item,
+        None for items that were dropped or failed
+        """
+        results = [None] * len(items)
+        if budget is None:
+            weights = None
+        # Feed from a thread since the first queue is bounded.
+        feeder = threading.Thread(target=self._feed,
+                                  args=(items, weights, budget))
+        feeder.daemon = True
+        feeder.start()
+        pending = len(items)
+        while pending:
+            try:
+                index, result = self._results.get(timeout=POLL_INTERVAL)
+            except Empty:
+                if self._died():
+                    raise RuntimeError('pipeline worker died')
+                continue
+            results[index] = result
+            pending -= 1
+            if weights is not None:
+                self._release(weights[index])
+        feeder.join()
+        return results
+
+    def _died(self):
+        return any(w.exitcode for workers in self._workers for w in workers)
+
+    def close(self):
+        """
+        Stop all workers once they finish their current item.
+        """
+        for queue, workers in zip(self._queues, self._workers):
+            for _ in workers:
+                queue.put(STOP)
+            for w in workers:
+                w.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,96 @@
+"""
+Cost-aware ordering of the traces processed by process_links().
+
+The time to analyze a trace grows with its number of packets, which ranges
+over two orders of magnitude across a year of MAWI traces. Dispatching the
+traces in file order can leave a giant trace for the end, with one worker
+busy on it while the others idle. Ordering them longest processing time
+first (LPT) starts the giant traces first and lets the small ones fill the
+gaps at the end, which keeps the makespan within 4/3 of the optimum.
+
+The cost of a trace is its packet count, scraped by scrap_links() (the total
+column of urls/*.csv), or taken from the trace catalog. Traces of unknown
+size get a count estimated from their file size in the catalog, or the
+average of the known counts. Their disk footprint, the dump and the extracted
+pcap, is estimated the same way, for the disk budget of Pipeline.map().
+"""
+import os
+
+from pcap_mmap import PCAP_RECORD_HDR_LEN
+
+MB = 1 << 20
+# Bytes captured per packet of traces without a captured size in the catalog,
+# the snap length of MAWI traces
+CAPLEN = 96
+# Packets per MB of dump when the catalog has no trace with both
+PACKETS_PER_MB = 20000
+
+
+def _packets_per_mb(traces):
+    """
+    :param traces: (list[dict]) catalog rows
+    :return ratio: (float) packets per MB of dump over the traces with both
+    """
+    packets = 0
+    size = 0.0
+    for trace in traces:
+        if trace['packets'] and trace['filesize']:
+            packets += trace['packets']
+            size += trace['filesize']
+    return packets / size if size else PACKETS_PER_MB
+
+
+def trace_costs(links, traces=None):
+    """
+    Estimate the cost and the disk footprint of every trace.
+    :param links: (list[tuple]) (url, trace_count) of every dump file
+    :param traces: (list[dict]) catalog rows, see TraceCatalog.select()
+    :return costs: (list[tuple]) (packets, disk) of every link: packets to
+    analyze and bytes of its dump and extracted pcap
+    """
+    by_dumpfile = dict((trace['dumpfile'], trace) for trace in traces or ()
+                       if trace['dumpfile'])
+    packets_per_mb = _packets_per_mb(by_dumpfile.values())
+    estimates = []
+    for url, trace_count in links:
+        trace = by_dumpfile.get(os.path.basename(url), {})
+        packets = trace_count or trace.get('packets')
+        filesize = trace.get('filesize')
+        if not packets and filesize:
+            packets = int(filesize * packets_per_mb)
+        estimates.append((packets, filesize, trace.get('cap_size')))
+    known = [packets for packets, _, _ in estimates if packets]
+    default = sum(known) / len(known) if known else 0
+    costs = []
+    for packets, filesize, cap_size in estimates:
+        packets = packets or default
+        if filesize is None:
+            filesize = packets / packets_per_mb
+        if cap_size is not None:
+            extracted = cap_size * MB + packets * PCAP_RECORD_HDR_LEN
+        else:
+            extracted = packets * (CAPLEN + PCAP_RECORD_HDR_LEN)
+        costs.append((packets, int(filesize * MB + extracted)))
+    return costs
+
+
+def lpt_order(costs):
+    """
+    :param costs: (list) cost of every item
+    :return order: (list[int]) indexes of the items, most costly first, ties
+    in their original order
+    """
+    return sorted(range(len(costs)), key=lambda i: -costs[i])
+
+
+def makespan(costs, n_workers):
+    """
+    Makespan of dispatching items in order to the first free worker.
+    :param costs: (list) cost of every item, in dispatch order
+    :param n_workers: (int) number of workers
+    :return makespan: total cost of the busiest worker
+    """
+    loads = [0] * max(1, n_workers)
+    for cost in costs:
+        loads[loads.index(min(loads))] += cost
+    return max(loads)
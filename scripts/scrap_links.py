@@ -2,11 +2,15 @@
 import os
 import time
 import logging
-import gzip
-import shutil
-import threading
+from functools import partial
 from analyzer import *
-from multiprocessing import Process, cpu_count
+from pipeline import Pipeline
+from manifest import *
+from crawler import Crawler
+from page_cache import PageCache, CACHE_DIR
+from catalog import TraceCatalog
+from scheduler import trace_costs, lpt_order, makespan
+from multiprocessing import cpu_count
 
 # Setup folder paths
 
@@ -23,46 +27,197 @@ if not os.path.exists(data_file_dir):
 results_file_dir = os.path.join(os.getcwd(), 'results')
 if not os.path.exists(results_file_dir):
     os.makedirs(results_file_dir)
+page_cache_dir = os.path.join(os.getcwd(), CACHE_DIR)
+# Codec compressing the csv results, see analyze(compression)
+results_compression = 'gzip'
 
 
-def download_extract_analyze(url, trace_count=0):
-    # Download the file
-    try:
-        logging.info("Processing link=%s",  url)
-        t0 = time.time()
+def download_extract(url, manifest=None, filesize=None):
+    """
+    Download a dump file and extract it. With a manifest, a file downloaded
+    or extracted by an earlier run is reused.
+    :param url: (str) URL of the .gz dump file
+    :param manifest: (str) path to the job manifest, None for no manifest
+    :param filesize: (float) FileSize in MB scraped from the trace page. The
+    download fails if its size does not match.
+    :return extracted_fp: (str) path to the extracted pcap file, None on error
+    """
+    job = open_manifest(manifest).get(url) if manifest else None
+    downloaded_fp = None
+    if job is not None and job['path'] and os.path.exists(job['path']):
+        if job['state'] == STATE_EXTRACTED:
+            logging.info("Resuming with extracted file=%s" % job['path'])
+            return job['path']
+        if job['state'] == STATE_DOWNLOADED:
+            logging.info("Resuming with downloaded file=%s" % job['path'])
+            downloaded_fp = job['path']
+    if downloaded_fp is None:
         t1 = time.time()
-        downloaded_fp = download_file(file_link=url, download_dir=data_file_dir)
+        downloaded_fp = download_file(file_link=url,
+                                      download_dir=data_file_dir,
+                                      filesize=filesize)
         if downloaded_fp is None:
-            return
+            record(manifest, url, STATE_FAILED, error='download failed')
+            return None
+        record(manifest, url, STATE_DOWNLOADED, path=downloaded_fp)
         logging.info("Downloaded file=%s in seconds=%s" %
                      (downloaded_fp, str(time.time()-t1)))
-        logging.info("Extracting file=%s" % downloaded_fp)
-        # Extract the file
-        t1 = time.time()
-        extracted_fp = extract_file(file_path=downloaded_fp,
-                                    extracted_dir=extracted_file_dir)
-        if extracted_fp is None:
-            return
-        logging.info("Extracted file=%s in seconds=%s" %
-                     (downloaded_fp, str(time.time()-t1)))
-        logging.info("Analyzing file=%s" % extracted_fp)
-        t1 = time.time()
-        # Analyze the file
-        analysis_res = analyze(filename=extracted_fp,
-                               output_dir=results_file_dir,
-                               trace_count=trace_count)
-        os.remove(extracted_fp)
-
-        # Compress the results file and remove original file.
-        with open(analysis_res["output"], 'rb') as in_file, \
-            gzip.open(analysis_res["output"]+".gz", 'wb') as out_file:
-            shutil.copyfileobj(in_file, out_file)
-        os.remove(analysis_res["output"])
-
-        logging.info("Analyzed file=%s in seconds=%s\n" %
-                     (extracted_fp, str(time.time()-t1)))
-        logging.debug('Extracted pcap file=%s successfully removed' %
-                      extracted_fp)
+    logging.info("Extracting file=%s" % downloaded_fp)
+    # Extract the file
+    t1 = time.time()
+    extracted_fp = extract_file(file_path=downloaded_fp,
+                                extracted_dir=extracted_file_dir)
+    if extracted_fp is None:
+        record(manifest, url, STATE_FAILED, error='extraction failed')
+        return None
+    record(manifest, url, STATE_EXTRACTED, path=extracted_fp)
+    logging.info("Extracted file=%s in seconds=%s" %
+                 (downloaded_fp, str(time.time()-t1)))
+    return extracted_fp
+
+
+def _compression_options(output_format='csv', compression=None,
+                         compression_level=None, columnar_compress=True):
+    """
+    Compression of the results of analyze(). The csv rows are compressed
+    while they are written. Columnar output is compressed chunk by chunk
+    unless it is to be memory-mapped, summaries are small and left as is.
+    :param output_format: (str) analyze() output format
+    :param compression: (str) analyze() compression, None for none
+    :param compression_level: (int) analyze() compression_level
+    :param columnar_compress: (bool) analyze() columnar_compress
+    :return options: (dict) compression arguments of analyze()
+    """
+    if output_format == 'columnar':
+        return {'columnar_compress': columnar_compress}
+    if compression is None or output_format not in COMPRESSED_FORMATS:
+        return {}
+    return {'compression': compression,
+            'compression_level': compression_level}
+
+
+def analyze_extracted(extracted_fp, trace_count=0, engine='dpkt',
+                      output_format='csv', url=None, manifest=None,
+                      file_processes=1, compression=results_compression,
+                      compression_level=None, columnar_compress=True):
+    """
+    Analyze an extracted dump file into compressed results and remove it.
+    :param extracted_fp: (str) path to the extracted pcap file
+    :param trace_count: (int) number of packets in the trace
+    :param engine: (str) analyze() engine
+    :param output_format: (str) analyze() output format
+    :param url: (str) URL of the dump file, for the manifest
+    :param manifest: (str) path to the job manifest, None for no manifest
+    :param file_processes: (int) analyze() n_processes, processes per file
+    :param compression: (str) analyze() compression of csv results, None to
+    leave them uncompressed
+    :param compression_level: (int) analyze() compression_level
+    :param columnar_compress: (bool) analyze() columnar_compress
+    :return analysis_res: (dict) result of analyze()
+    """
+    logging.info("Analyzing file=%s" % extracted_fp)
+    t1 = time.time()
+    # Analyze the file
+    analysis_res = analyze(filename=extracted_fp,
+                           output_dir=results_file_dir,
+                           trace_count=trace_count,
+                           engine=engine,
+                           output_format=output_format,
+                           n_processes=file_processes,
+                           **_compression_options(output_format, compression,
+                                                  compression_level,
+                                                  columnar_compress))
+    os.remove(extracted_fp)
+    logging.debug('Extracted pcap file=%s successfully removed' %
+                  extracted_fp)
+    if analysis_res is None:
+        record(manifest, url, STATE_FAILED, path=None,
+               error='analysis failed')
+        return None
+    record(manifest, url, STATE_ANALYZED, path=None, counters=analysis_res)
+    record(manifest, url, STATE_COMPRESSED, output=analysis_res["output"])
+    logging.info("Analyzed file=%s in seconds=%s\n" %
+                 (extracted_fp, str(time.time()-t1)))
+    return analysis_res
+
+
+def download_extract_analyze(url, trace_count=0, engine='dpkt',
+                             output_format='csv', streaming=False,
+                             manifest=None, compression=results_compression,
+                             compression_level=None, columnar_compress=True,
+                             filesize=None):
+    """
+    Download, extract and analyze a dump file into compressed results.
+    :param url: (str) URL of the .gz dump file
+    :param trace_count: (int) number of packets in the trace
+    :param engine: (str) analyze() engine
+    :param output_format: (str) analyze() output format
+    :param streaming: (bool) decompress and analyze the dump while it is
+    downloaded, without writing the dump to disk. Uses the 'stream' engine
+    unless engine is one of STREAMING_ENGINES.
+    :param manifest: (str) path to the job manifest, None for no manifest
+    :param compression: (str) analyze() compression of csv results, None to
+    leave them uncompressed
+    :param compression_level: (int) analyze() compression_level
+    :param columnar_compress: (bool) analyze() columnar_compress
+    :param filesize: (float) FileSize in MB scraped from the trace page. The
+    job fails if the size of the dump does not match.
+    :return analysis_res: (dict) result of analyze()
+    """
+    try:
+        logging.info("Processing link=%s",  url)
+        t0 = time.time()
+        if streaming:
+            if engine not in STREAMING_ENGINES:
+                engine = 'stream'
+            logging.info("Analyzing stream=%s" % url)
+            stream = open_stream(url)
+            try:
+                analysis_res = analyze(filename=os.path.basename(url),
+                                       output_dir=results_file_dir,
+                                       trace_count=trace_count,
+                                       engine=engine,
+                                       output_format=output_format,
+                                       fileobj=stream,
+                                       **_compression_options(
+                                           output_format, compression,
+                                           compression_level,
+                                           columnar_compress))
+            finally:
+                # Also release the connection when the stream is truncated
+                stream.close()
+            if analysis_res is None:
+                record(manifest, url, STATE_FAILED, error='analysis failed')
+                return None
+            if filesize is not None:
+                expected_size, tolerance = scraped_size(filesize)
+                if abs(stream.compressed_bytes - expected_size) > tolerance:
+                    logging.error('Streamed bytes=%s, expected %s for url=%s'
+                                  % (stream.compressed_bytes, expected_size,
+                                     url))
+                    record(manifest, url, STATE_FAILED,
+                           error='size mismatch')
+                    return None
+            record(manifest, url, STATE_ANALYZED, counters=analysis_res)
+            record(manifest, url, STATE_COMPRESSED,
+                   output=analysis_res["output"])
+        else:
+            # Download the file
+            extracted_fp = download_extract(url, manifest=manifest,
+                                            filesize=filesize)
+            if extracted_fp is None:
+                return None
+            analysis_res = analyze_extracted(extracted_fp,
+                                             trace_count=trace_count,
+                                             engine=engine,
+                                             output_format=output_format,
+                                             url=url,
+                                             manifest=manifest,
+                                             compression=compression,
+                                             compression_level=
+                                             compression_level,
+                                             columnar_compress=
+                                             columnar_compress)
         logging.info("Finished processing link=%s in seconds=%s" %
                      (url, str(time.time()-t0)))
         return analysis_res
@@ -72,23 +227,34 @@ def download_extract_analyze(url, trace_count=0):
         return None
 
 
-def scrap_all_links(url_list):
+def scrap_all_links(url_list, cache_dir=page_cache_dir, offline=False):
     """
     This function takes a list of URLs and scraps links of *.dump.gz all those
     webpages.
     :param url_list: (txt file) list of URLs
+    :param cache_dir: (str) directory of the page cache, None to download
+    every page
+    :param offline: (bool) only use the pages in the cache
     :return:
     """
     try:
         count = 0
+        cache = None
+        if cache_dir is not None:
+            cache = PageCache(cache_dir, offline=offline)
+        crawler = Crawler(cache=cache)
         with open(url_list, 'r') as f:
             lines = f.readlines()
             for url in lines:
                 if not url.startswith('#'):
                     file_link = scrap_links(webpage=url.rstrip(),
-                                            url_directory=url_file_dir)
+                                            url_directory=url_file_dir,
+                                            crawler=crawler)
                     count += 1
             print('Links to dump files extracted from %s webpages.' % count)
+            if cache is not None:
+                print('%s pages served from cache at %s.' % (crawler.cached,
+                                                             cache_dir))
     except Exception as el1:
         print('Unable to scrap links from file=%s. Error=%s' % (url_list, el1))
         return
@@ -138,90 +304,257 @@ def analyze_all_links(scrapped_dumps):
         return
 
 
-def analyze_all_files(url_directory=None, n_threads=6):
+def read_links(url_directory=None):
+    """
+    Read the links to dump files from all files in the urls directory.
+    :param url_directory: path to directory containing files containing urls
+    of trace dumps.
+    :return links: (list[tuple]) (url, trace_count) of every dump file
+    """
+    links = []
+    for fname in sorted(os.listdir(url_directory)):
+        count = len(links)
+        with open(os.path.join(url_directory, fname), 'r') as f:
+            f.readline()     # Skip headers
+            for l in f.readlines():
+                links.append((l.split(',')[0], int(l.split(',')[1])))
+        logging.info('%s links extracted from file=%s' %
+                     (len(links) - count, fname))
+    return links
+
+
+def _download_stage(link, manifest=None, filesizes=None):
+    """
+    Download stage of process_links(). Downloads and extracts a dump file.
+    :param link: (tuple) (url, trace_count)
+    :param manifest: (str) path to the job manifest, None for no manifest
+    :param filesizes: (dict) scraped FileSize in MB by dump file name, see
+    download_extract(filesize)
+    :return task: (tuple) (url, extracted_fp, trace_count), None on error
+    """
+    url, trace_count = link
+    logging.info("Processing link=%s",  url)
+    if manifest:
+        open_manifest(manifest).start(url)
+    try:
+        extracted_fp = download_extract(
+            url, manifest=manifest,
+            filesize=(filesizes or {}).get(os.path.basename(url)))
+    except Exception as el1:
+        record(manifest, url, STATE_FAILED, error=str(el1))
+        raise
+    if extracted_fp is None:
+        return None
+    return url, extracted_fp, trace_count
+
+
+def _analyze_stage(task, engine='dpkt', output_format='csv', manifest=None,
+                   file_processes=1, compression=results_compression,
+                   compression_level=None, columnar_compress=True):
+    """
+    Analysis stage of process_links(). Analyzes an extracted dump file.
+    :param task: (tuple) (url, extracted_fp, trace_count)
+    :param manifest: (str) path to the job manifest, None for no manifest
+    :return analysis_res: (dict) result of analyze()
+    """
+    url, extracted_fp, trace_count = task
+    try:
+        return analyze_extracted(extracted_fp, trace_count=trace_count,
+                                 engine=engine, output_format=output_format,
+                                 url=url, manifest=manifest,
+                                 file_processes=file_processes,
+                                 compression=compression,
+                                 compression_level=compression_level,
+                                 columnar_compress=columnar_compress)
+    except Exception as el1:
+        record(manifest, url, STATE_FAILED, error=str(el1))
+        raise
+
+
+def _stream_stage(link, engine='dpkt', output_format='csv', manifest=None,
+                  compression=results_compression, compression_level=None,
+                  columnar_compress=True, filesizes=None):
+    """
+    Single stage of process_links() in streaming mode.
+    :param link: (tuple) (url, trace_count)
+    :param manifest: (str) path to the job manifest, None for no manifest
+    :param filesizes: (dict) scraped FileSize in MB by dump file name, see
+    download_extract_analyze(filesize)
+    :return analysis_res: (dict) result of analyze()
+    """
+    url, trace_count = link
+    if manifest:
+        open_manifest(manifest).start(url)
+    try:
+        return download_extract_analyze(url, trace_count=trace_count,
+                                        engine=engine,
+                                        output_format=output_format,
+                                        streaming=True, manifest=manifest,
+                                        compression=compression,
+                                        compression_level=compression_level,
+                                        columnar_compress=columnar_compress,
+                                        filesize=(filesizes or {}).get(
+                                            os.path.basename(url)))
+    except Exception as el1:
+        record(manifest, url, STATE_FAILED, error=str(el1))
+        raise
+
+
+def process_links(links, n_downloaders=2, n_analyzers=6, queue_size=None,
+                  processes=True, engine='dpkt', output_format='csv',
+                  streaming=False, manifest=None, max_attempts=MAX_ATTEMPTS,
+                  file_processes=1, largest_first=True, disk_budget=None,
+                  catalog=None, compression=results_compression,
+                  compression_level=None, columnar_compress=True):
+    """
+    Download, extract and analyze dump files with a persistent worker pool.
+    Downloads and analyses run in separate stages connected by a bounded
+    queue, so downloads overlap with parsing and a slow trace only occupies
+    one worker.
+    :param links: (list[tuple]) (url, trace_count) of every dump file
+    :param n_downloaders: (int) number of download/extract workers
+    :param n_analyzers: (int) number of analysis workers
+    :param queue_size: (int) maximum number of extracted files waiting for
+    analysis (default: n_analyzers). Bounds the disk space used.
+    :param processes: (bool) run workers as processes, or threads if False
+    :param engine: (str) analyze() engine
+    :param output_format: (str) analyze() output format
+    :param streaming: (bool) analyze while downloading. Uses a single stage
+    of n_analyzers workers.
+    :param manifest: (str) path to a job manifest (SQLite database) that
+    records the state of every link. Links finished in an earlier run are
+    skipped and failed ones retried.
+    :param max_attempts: (int) with a manifest, give up on links that failed
+    this many times
+    :param file_processes: (int) split each file across this many processes,
+    see analyze(n_processes). Only used with threads (processes=False), e.g.
+    for runs with fewer traces than cores.
+    :param largest_first: (bool) dispatch the links with the most packets
+    first, see scheduler.py, instead of in order
+    :param disk_budget: (int) bytes of dumps and extracted pcaps being
+    processed at once, estimated from their packet counts or file sizes.
+    Links wait for earlier ones to finish rather than exceed it. None for no
+    limit.
+    :param catalog: (str) path to a trace catalog giving the packet counts
+    and file sizes of links without a trace_count. Downloads are checked
+    against the file sizes it has.
+    :param compression: (str) codec compressing the csv results while they
+    are written, see analyze(compression), None to leave them uncompressed
+    :param compression_level: (int) compression level of the codec, None for
+    its default
+    :param columnar_compress: (bool) write columnar results as compressed
+    .npz chunks, or False as .npy columns that downstream jobs can
+    memory-map, see analyze(columnar_compress)
+    :return results: (list[dict]) result of analyze() for each processed
+    link, None for failed links
+    """
+    if manifest:
+        links = open_manifest(manifest).todo(links, max_attempts)
+    traces = None
+    if catalog:
+        trace_catalog = TraceCatalog(catalog)
+        try:
+            traces = trace_catalog.select()
+        finally:
+            trace_catalog.close()
+    # Scraped FileSize of the dump files, checked after download
+    filesizes = dict((trace['dumpfile'], trace['filesize'])
+                     for trace in traces or ()
+                     if trace['dumpfile'] and trace['filesize'])
+    costs = trace_costs(links, traces)
+    order = range(len(links))
+    if largest_first:
+        order = lpt_order([packets for packets, _ in costs])
+    packets = [costs[i][0] for i in order]
+    logging.info('Dispatching links=%s with packets=%s, estimated makespan='
+                 '%s packets on workers=%s' %
+                 (len(links), sum(packets), makespan(packets, n_analyzers),
+                  n_analyzers))
+    if streaming:
+        stages = [('stream', partial(_stream_stage, engine=engine,
+                                     output_format=output_format,
+                                     manifest=manifest,
+                                     compression=compression,
+                                     compression_level=compression_level,
+                                     columnar_compress=columnar_compress,
+                                     filesizes=filesizes),
+                   n_analyzers)]
+    else:
+        stages = [('download', partial(_download_stage, manifest=manifest,
+                                       filesizes=filesizes),
+                   n_downloaders),
+                  ('analyze', partial(_analyze_stage, engine=engine,
+                                      output_format=output_format,
+                                      manifest=manifest,
+                                      file_processes=file_processes,
+                                      compression=compression,
+                                      compression_level=compression_level,
+                                      columnar_compress=columnar_compress),
+                   n_analyzers)]
+    if output_format in SUMMARY_FORMATS:
+        # Loaded once, the forked workers share the tables
+        load_labels()
+    with Pipeline(stages, queue_size=queue_size,
+                  processes=processes) as pipeline:
+        ordered = pipeline.map([links[i] for i in order],
+                               weights=[costs[i][1] for i in order],
+                               # Streamed dumps are not written to disk
+                               budget=None if streaming else disk_budget)
+    results = [None] * len(links)
+    for position, i in enumerate(order):
+        results[i] = ordered[position]
+    logging.info('%s of %s links processed successfully' %
+                 (len([r for r in results if r is not None]), len(links)))
+    return results
+
+
+def analyze_all_files(url_directory=None, n_threads=6, **kwargs):
     """
     This function processes all files in the urls directory, downloads each
     file and processes it.
     :param url_directory: path to directory containing files containing urls
     of trace dumps.
-    :param n_threads: number of threads.
-    :return:
+    :param n_threads: number of analysis threads.
+    :param kwargs: further arguments for process_links()
+    :return results: (list[dict]) result of analyze() for each link
     """
-    # read all files
-    for fname in os.listdir(url_directory):
-        links = []
-        f = open(os.path.join(url_directory, fname), 'r')
-        f.readline()     # Skip headers
-        for l in f.readlines():
-            links.append((l.split(',')[0], l.split(',')[1]))
-        logging.info('%s links extracted from file=%s' % (len(links), fname))
-        # Start n threads simultaneously to perform download, extract, analyze
-        for i in range(0, len(links), n_threads):
-            try:
-                threads = []
-                for j in range(n_threads):
-                    if i+j < len(links):
-                        threads.append(MyThread(target=download_extract_analyze,
-                                                url=links[i+j][0],
-                                                trace_count=int(links[i+j][1])))
-                for t in threads:
-                    t.start()
-                # Wait for the threads to complete
-                for t in threads:
-                    t.join()
-            except ImportError as el3:
-                logging.error('Error=%s during processing url=%s' %
-                              (el3, links[i][0]))
-                pass
-
-
-def analyze_all_files_processes(url_directory=None, n_processes=6):
+    return process_links(read_links(url_directory), n_analyzers=n_threads,
+                         processes=False, **kwargs)
+
+
+def analyze_all_files_processes(url_directory=None, n_processes=6, **kwargs):
     """
     This function processes all files in the urls directory, downloads each
     file and processes it.
     :param url_directory: path to directory containing files containing urls
     of trace dumps.
-    :param n_processes: number of processes to run.
-    :return:
+    :param n_processes: number of analysis processes to run.
+    :param kwargs: further arguments for process_links()
+    :return results: (list[dict]) result of analyze() for each link
     """
-    # read all files
-    for fname in os.listdir(url_directory):
-        links = []
-        f = open(os.path.join(url_directory, fname), 'r')
-        f.readline()     # Skip headers
-        for l in f.readlines():
-            links.append((l.split(',')[0], l.split(',')[1]))
-        logging.info('%s links extracted from file=%s' % (len(links), fname))
-        # Start n threads simultaneously to perform download, extract, analyze
-        for i in range(0, len(links), n_processes):
-            try:
-                processes = []
-                for j in range(n_processes):
-                    if i+j < len(links):
-                        processes.append(Process(
-                            target=download_extract_analyze,
-                            args=(links[i+j][0], int(links[i+j][1]))))
-                for p in processes:
-                    p.start()
-                # Wait for the threads to complete
-                for p in processes:
-                    p.join()
-            except Exception as el3:
-                logging.error('Error=%s during processing url=%s' %
-                              (el3, links[i][0]))
-                break
-                pass
+    return process_links(read_links(url_directory), n_analyzers=n_processes,
+                         processes=True, **kwargs)
 
 
-class MyThread(threading.Thread):
-    def __init__(self, target, *args, **kwargs):
-        self._target = target
-        self._args = args
-        self._kwargs = kwargs
-        threading.Thread.__init__(self)
-
-    def run(self):
-        self._target(*self._args, **self._kwargs)
+def analyze_catalog_traces(catalog, n_processes=6, selection=None, **kwargs):
+    """
+    This function processes the dump files of the traces selected from a
+    trace catalog, see catalog.build_catalog().
+    :param catalog: (str) path to the trace catalog
+    :param n_processes: number of analysis processes to run.
+    :param selection: (dict) TraceCatalog.select() criteria, e.g.
+    {'year': 2007, 'min_filesize': 5000, 'min_ipv6_share': 0.01}
+    :param kwargs: further arguments for process_links()
+    :return results: (list[dict]) result of analyze() for each link
+    """
+    traces = TraceCatalog(catalog)
+    try:
+        links = traces.links(**(selection or {}))
+    finally:
+        traces.close()
+    logging.info('%s traces selected from catalog=%s' % (len(links), catalog))
+    return process_links(links, n_analyzers=n_processes, processes=True,
+                         catalog=catalog, **kwargs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+"""
+Output sinks for the per-packet rows written by analyze().
+"""
+import os
+import socket
+import shutil
+
+from compression import CompressedWriter, file_codec
+
+CSV_HEADER = ('timestamp,source_ip,source_port,destination_ip,'
+              'destination_port,dscp,tos\n')
+# Header with the address family column, see CsvSink(ipv6=True)
+CSV_HEADER_AF = CSV_HEADER[:-1] + ',address_family\n'
+
+
+class CsvSink(object):
+    """
+    Writes one csv text row per packet, optionally compressed on the fly.
+    """
+    extension = '.csv'
+
+    def __init__(self, output_file, ipv6=False, compression=None, level=None,
+                 header=True):
+        """
+        :param output_file: (str) path to the csv file, ending with the
+        extension of the codec if compressed, e.g. '.csv.gz'
+        :param ipv6: (bool) accept 16-byte IPv6 addresses as well and add an
+        address_family column (4 or 6)
+        :param compression: (str) compress the rows in a background thread
+        with this codec of compression.CODECS, None to write plain text
+        :param level: (int) compression level, None for the default level of
+        the codec
+        :param header: (bool) write the header row. Compressed parts after
+        the first one have none, see merge().
+        """
+        self.output = output_file
+        if compression is not None:
+            self._file = CompressedWriter(output_file, compression, level)
+        else:
+            self._file = open(output_file, 'w')
+        if header:
+            self._file.write(CSV_HEADER_AF if ipv6 else CSV_HEADER)
+        if ipv6:
+            self.write = self._write_af
+
+    def write(self, ts, src, sport, dst, dport, tos):
+        """
+        Write one packet.
+        :param ts: (float) packet timestamp
+        :param src: (str) source IP address in packed form
+        :param sport: (int) source port
+        :param dst: (str) destination IP address in packed form
+        :param dport: (int) destination port
+        :param tos: (int) TOS byte from IP header
+        """
+        self._file.write('%s,%s,%s,%s,%s,%s,%s\n' % (
+            ts, socket.inet_ntoa(src), sport, socket.inet_ntoa(dst), dport,
+            tos >> 2, tos))
+
+    def _write_af(self, ts, src, sport, dst, dport, tos):
+        if len(src) == 4:
+            self._file.write('%s,%s,%s,%s,%s,%s,%s,4\n' % (
+                ts, socket.inet_ntoa(src), sport, socket.inet_ntoa(dst),
+                dport, tos >> 2, tos))
+        else:
+            self._file.write('%s,%s,%s,%s,%s,%s,%s,6\n' % (
+                ts, socket.inet_ntop(socket.AF_INET6, src), sport,
+                socket.inet_ntop(socket.AF_INET6, dst), dport, tos >> 2,
+                tos))
+
+    def write_batch(self, packets, ts):
+        """
+        Write a batch of packets decoded by pcap_batch.
+        :param packets: (numpy.ndarray) array of pcap_batch.PACKET_DTYPE
+        :param ts: (list) packet timestamps, see pcap_batch.timestamps()
+        """
+        columns = [ts]
+        for field in ('src', 'sport', 'dst', 'dport'):
+            values = packets[field]
+            if field in ('src', 'dst'):
+                # Dotted quad, most significant octet first
+                columns.extend([((values >> shift) & 0xff).tolist()
+                                for shift in (24, 16, 8, 0)])
+            else:
+                columns.append(values.tolist())
+        tos = packets['tos']
+        columns.extend([(tos >> 2).tolist(), tos.tolist()])
+        row = '%s,%d.%d.%d.%d,%d,%d.%d.%d.%d,%d,%d,%d\n'
+        self._file.writelines(row % r for r in zip(*columns))
+
+    def close(self):
+        self._file.close()
+
+    def abort(self):
+        """
+        Close the sink after a failed analysis. Compressed output is removed,
+        since it is incomplete, plain csv output is kept as written.
+        """
+        if isinstance(self._file, CompressedWriter):
+            self._file.abort()
+        else:
+            self._file.close()
+
+    @classmethod
+    def merge(cls, output_file, parts):
+        """
+        Concatenate csv files written by CsvSink into one and remove them.
+        Compressed files are concatenated as they are, into a multi-stream
+        file, so only the first part may have a header row. Python 2 only
+        reads the first stream of multi-stream bz2 files, bzip2 and Python 3
+        read them all.
+        :param output_file: (str) path to the merged csv file
+        :param parts: (list[str]) paths to the csv files, in order. All must
+        have the same columns.
+        """
+        if file_codec(output_file) is not None:
+            with open(output_file, 'wb') as f:
+                for part in parts:
+                    with open(part, 'rb') as part_file:
+                        shutil.copyfileobj(part_file, f)
+                    os.remove(part)
+            return
+        with open(output_file, 'w') as f:
+            for i, part in enumerate(parts):
+                with open(part, 'r') as part_file:
+                    header = part_file.readline()
+                    if not i:
+                        f.write(header)
+                    shutil.copyfileobj(part_file, f)
+                os.remove(part)
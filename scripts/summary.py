@@ -0,0 +1,301 @@
+"""
+Per-trace summary output for analyze().
+
+Instead of a row per packet, SummarySink aggregates while the trace is read
+and writes one small file per trace with these sections:
+
+    counters            analyze() packet counters
+    protocol_packets    packets per IP protocol number
+    protocol_names      packets per IP protocol keyword, see labels.py
+    protocol_bytes      bytes (original frame length) per IP protocol number
+    ethertypes          non-IP frames per Ethernet type (decimal), e.g.
+                        IPv6 frames unless analyze(ipv6)
+    ethertype_names     non-IP frames per Ethernet type abbreviation
+    tos, dscp           packets per TOS byte and per DSCP value
+    tcp_sport, ...      packets per TCP/UDP source and destination port, the
+                        most frequent ports and 'other'
+    tcp_services, ...   TCP/UDP packets per service of the destination port
+    sizes               packets per original frame length
+    size_buckets        packets per range of frame lengths
+    size_stats          mean, max and percentiles of the frame lengths
+
+SummarySink writes the sections as JSON, SummaryCsvSink as section,key,value
+rows. Summaries of the same trace can be merged, see SummarySink.merge().
+"""
+import os
+import csv
+import json
+
+from pcap_mmap import *
+from labels import load_labels
+
+try:
+    import numpy as np
+except ImportError:
+    # Only required for SummarySink.add_batch()
+    np = None
+
+# Most frequent ports kept per port section, None for all
+TOP_PORTS = 100
+# Upper bounds of the size_buckets, the last bucket is open
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 1519)
+SIZE_PERCENTILES = (50, 90, 99)
+# Frame lengths are counted up to MAX_LENGTH - 1
+MAX_LENGTH = 1 << 16
+
+# Sections computed from the others, recomputed after merging
+_DERIVED = ('dscp', 'size_buckets', 'size_stats', 'protocol_names',
+            'tcp_services', 'udp_services', 'ethertype_names')
+_PORT_SECTIONS = ('tcp_sport', 'tcp_dport', 'udp_sport', 'udp_dport')
+
+
+class SummarySink(object):
+    """
+    Aggregates packets into per-trace histograms and writes them as JSON.
+    """
+    extension = '.summary.json'
+
+    def __init__(self, output_file, ipv6=False, top_ports=TOP_PORTS):
+        """
+        :param output_file: (str) path to the summary file
+        :param ipv6: (bool) packets include IPv6, counted alike
+        :param top_ports: (int) most frequent ports written per port
+        section, None for all
+        """
+        self.output = output_file
+        self.top_ports = top_ports
+        # analyze() counters, set before close()
+        self.counters = {}
+        self.protocol_packets = [0] * 256
+        self.protocol_bytes = [0] * 256
+        self.tos = [0] * 256
+        self.ethertypes = [0] * 65536
+        self.ports = {
+            IP_PROTO_TCP: ([0] * 65536, [0] * 65536),
+            IP_PROTO_UDP: ([0] * 65536, [0] * 65536)
+        }
+        self.sizes = [0] * MAX_LENGTH
+
+    def add_packets(self, packets, progress=None):
+        """
+        Aggregate decoded packets.
+        :param packets: (generator) (ts, length, kind, proto, src, sport, dst,
+        dport, tos, flags) tuples, see MmapPcapReader.packets()
+        :param progress: (function) called with the number of packets read
+        every 65536 packets
+        :return counts: (list[int]) number of packets of each PKT_* kind
+        """
+        counts = [0] * N_KINDS
+        protocol_packets = self.protocol_packets
+        protocol_bytes = self.protocol_bytes
+        tos_packets = self.tos
+        ethertypes = self.ethertypes
+        ports = self.ports
+        sizes = self.sizes
+        has_ip = KIND_HAS_IP
+        has_ports = KIND_HAS_PORTS
+        total = 0
+        for _, length, kind, proto, _, sport, _, dport, tos, _ in packets:
+            total += 1
+            counts[kind] += 1
+            if progress is not None and not total & 0xffff:
+                progress(total)
+            if kind == PKT_FILTERED:
+                continue
+            sizes[length if length < MAX_LENGTH else MAX_LENGTH - 1] += 1
+            if has_ip[kind]:
+                protocol_packets[proto] += 1
+                protocol_bytes[proto] += length
+                tos_packets[tos] += 1
+                if has_ports[kind]:
+                    sports, dports = ports[proto]
+                    sports[sport] += 1
+                    dports[dport] += 1
+            elif kind == PKT_NON_IP4:
+                # proto is the Ethernet type of the frame
+                ethertypes[proto] += 1
+        return counts
+
+    def add_batch(self, packets):
+        """
+        Aggregate a batch of packets decoded by pcap_batch.
+        :param packets: (numpy.ndarray) array of pcap_batch.PACKET_DTYPE,
+        including the packets that are not written by the other sinks
+        """
+        packets = packets[packets['kind'] != PKT_FILTERED]
+        kinds = packets['kind']
+        self._add_counts(self.sizes, np.minimum(packets['length'],
+                                                MAX_LENGTH - 1))
+        ip = packets[has_ip4(kinds)]
+        self._add_counts(self.protocol_packets, ip['proto'])
+        self._add_counts(self.protocol_bytes, ip['proto'],
+                         ip['length'].astype(np.int64))
+        self._add_counts(self.tos, ip['tos'])
+        self._add_counts(self.ethertypes,
+                         packets['eth_type'][kinds == PKT_NON_IP4])
+        for proto, kind in ((IP_PROTO_TCP, PKT_TCP), (IP_PROTO_UDP, PKT_UDP)):
+            rows = packets[kinds == kind]
+            sports, dports = self.ports[proto]
+            self._add_counts(sports, rows['sport'])
+            self._add_counts(dports, rows['dport'])
+
+    @staticmethod
+    def _add_counts(counts, values, weights=None):
+        if not len(values):
+            return
+        added = np.bincount(values, weights=weights)
+        if weights is not None:
+            added = added.astype(np.int64)
+        for value in np.flatnonzero(added).tolist():
+            counts[value] += int(added[value])
+
+    def close(self):
+        summary = {
+            "counters": dict(self.counters),
+            "protocol_packets": _nonzero(self.protocol_packets),
+            "protocol_bytes": _nonzero(self.protocol_bytes),
+            "tos": _nonzero(self.tos),
+            "ethertypes": _nonzero(self.ethertypes),
+            "sizes": _nonzero(self.sizes)
+        }
+        for name, proto in (('tcp', IP_PROTO_TCP), ('udp', IP_PROTO_UDP)):
+            sports, dports = self.ports[proto]
+            summary[name + '_sport'] = _nonzero(sports)
+            summary[name + '_dport'] = _nonzero(dports)
+        self._write(_finish(summary, self.top_ports))
+
+    def _write(self, summary):
+        tmp_file = self.output + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        os.rename(tmp_file, self.output)
+
+    @classmethod
+    def read(cls, summary_file):
+        """
+        :param summary_file: (str) path to a file written by this class
+        :return summary: (dict) section name to dict of key to value
+        """
+        with open(summary_file, 'r') as f:
+            return json.load(f)
+
+    @classmethod
+    def merge(cls, output_file, parts):
+        """
+        Sum the summaries of parts of a trace into one and remove them.
+        :param output_file: (str) path to the merged summary
+        :param parts: (list[str]) summaries written with top_ports=None, so
+        that port counts are complete
+        """
+        merged = {}
+        for part in parts:
+            for section, values in cls.read(part).items():
+                if section in _DERIVED:
+                    continue
+                totals = merged.setdefault(section, {})
+                for key, value in values.items():
+                    totals[key] = totals.get(key, 0) + value
+            os.remove(part)
+        sink = cls(output_file)
+        sink._write(_finish(merged, sink.top_ports))
+
+
+class SummaryCsvSink(SummarySink):
+    """
+    SummarySink writing section,key,value rows instead of JSON.
+    """
+    extension = '.summary.csv'
+
+    def _write(self, summary):
+        tmp_file = self.output + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(('section', 'key', 'value'))
+            for section in sorted(summary):
+                values = summary[section]
+                for key in sorted(values, key=_sort_key):
+                    writer.writerow((section, key, values[key]))
+        os.rename(tmp_file, self.output)
+
+    @classmethod
+    def read(cls, summary_file):
+        summary = {}
+        with open(summary_file, 'rb') as f:
+            reader = csv.reader(f)
+            next(reader)
+            for section, key, value in reader:
+                value = float(value) if '.' in value else int(value)
+                summary.setdefault(section, {})[key] = value
+        return summary
+
+
+def _nonzero(counts):
+    return dict((str(key), count) for key, count in enumerate(counts)
+                if count)
+
+
+def _sort_key(key):
+    return (0, int(key)) if key.isdigit() else (1, key)
+
+
+def _finish(summary, top_ports):
+    """
+    Keep the top_ports most frequent ports of each port section and compute
+    the derived sections.
+    :param summary: (dict) summable sections
+    :param top_ports: (int) ports kept per port section, None for all
+    :return summary: (dict) sections to write
+    """
+    labels = load_labels()
+    if labels is not None:
+        # Before the least frequent ports are folded into 'other'
+        summary['protocol_names'] = labels.label_counts(
+            labels.protocols, summary.get('protocol_packets', {}))
+        summary['tcp_services'] = labels.label_counts(
+            labels.tcp, summary.get('tcp_dport', {}))
+        summary['udp_services'] = labels.label_counts(
+            labels.udp, summary.get('udp_dport', {}))
+        summary['ethertype_names'] = labels.label_counts(
+            labels.ethertypes, summary.get('ethertypes', {}))
+    for section in _PORT_SECTIONS:
+        ports = summary.setdefault(section, {})
+        if top_ports is not None and len(ports) > top_ports:
+            ranked = sorted(ports.items(),
+                            key=lambda item: (-item[1], int(item[0])))
+            kept = dict(ranked[:top_ports])
+            kept['other'] = sum(count for _, count in ranked[top_ports:])
+            summary[section] = kept
+    dscp = {}
+    for tos, count in summary.get('tos', {}).items():
+        key = str(int(tos) >> 2)
+        dscp[key] = dscp.get(key, 0) + count
+    summary['dscp'] = dscp
+
+    sizes = sorted((int(length), count)
+                   for length, count in summary.get('sizes', {}).items())
+    buckets = {}
+    low = 0
+    for high in SIZE_BUCKETS + (None,):
+        label = ('%d-%d' % (low, high - 1) if high is not None
+                 else '%d+' % low)
+        buckets[label] = sum(count for length, count in sizes
+                             if length >= low and (high is None or
+                                                   length < high))
+        low = high
+    summary['size_buckets'] = buckets
+
+    total = sum(count for _, count in sizes)
+    stats = {}
+    if total:
+        stats['mean'] = round(sum(length * count
+                                  for length, count in sizes) /
+                              float(total), 2)
+        stats['max'] = sizes[-1][0]
+        seen = 0
+        percentiles = list(SIZE_PERCENTILES)
+        for length, count in sizes:
+            seen += count
+            while percentiles and seen * 100 >= percentiles[0] * total:
+                stats['p%d' % percentiles.pop(0)] = length
+    summary['size_stats'] = stats
+    return summary
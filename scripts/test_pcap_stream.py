@@ -0,0 +1,133 @@
+"""
+Tests of the streaming pipeline against a local HTTP server.
+
+Run from the scripts directory:
+
+    python -m unittest test_pcap_stream
+"""
+import zlib
+import struct
+import urllib2
+import unittest
+import threading
+import BaseHTTPServer
+
+from pcap_stream import GunzipReader, StreamPcapReader
+
+# Records in the test trace
+RECORDS = 2000
+# Ethernet + IPv4 + UDP headers of every record
+FRAME = (b'\0' * 12 + b'\x08\x00' +
+         b'\x45\x00\x00\x1c' + b'\0' * 4 + b'\x40\x11\0\0' +
+         b'\x0a\0\0\x01' + b'\x0a\0\0\x02' +
+         b'\x04\xd2\x00\x35\x00\x08\0\0')
+
+
+def _pcap(records=RECORDS, cut=0):
+    """
+    :param records: (int) number of records
+    :param cut: (int) bytes to remove from the end of the last record
+    :return data: (str) little-endian microsecond pcap trace
+    """
+    parts = [struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)]
+    for i in range(records):
+        parts.append(struct.pack('<IIII', 1000 + i, i, len(FRAME),
+                                 len(FRAME)))
+        parts.append(FRAME)
+    data = b''.join(parts)
+    return data[:len(data) - cut]
+
+
+def _gzip(data):
+    """
+    :param data: (str) bytes to compress
+    :return data: (str) single gzip member
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the bodies of the server. The Content-Length is always the one of
+    the full body, bodies listed in server.cuts are cut at that many bytes
+    and the connection is closed, like a dropped download.
+    """
+    def do_GET(self):
+        body = self.server.bodies.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:self.server.cuts.get(self.path, len(body))])
+
+    def log_message(self, *args):
+        pass
+
+
+class StreamTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        gz = _gzip(_pcap())
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _Handler)
+        cls.server.bodies = {
+            '/full.dump.gz': gz,
+            # Two members, like concatenated gzip files
+            '/members.dump.gz': _gzip(_pcap()[:1000]) + _gzip(_pcap()[1000:]),
+            '/dropped.dump.gz': gz,
+            '/record.dump.gz': _gzip(_pcap(cut=5))
+        }
+        cls.server.cuts = {'/dropped.dump.gz': len(gz) * 95 // 100}
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def _open(self, path):
+        url = 'http://127.0.0.1:%s%s' % (self.server.server_port, path)
+        return GunzipReader(urllib2.urlopen(url), chunk_size=4096)
+
+    def _records(self, path):
+        stream = self._open(path)
+        try:
+            reader = StreamPcapReader(stream, block_size=4096)
+            return [(ts, caplen, wirelen)
+                    for ts, _, _, caplen, wirelen in reader.records()]
+        finally:
+            stream.close()
+
+    def test_full(self):
+        records = self._records('/full.dump.gz')
+        self.assertEqual(len(records), RECORDS)
+        self.assertEqual(records[-1], (1000 + (RECORDS - 1) +
+                                       (RECORDS - 1) / 1E6,
+                                       len(FRAME), len(FRAME)))
+
+    def test_members(self):
+        self.assertEqual(self._records('/members.dump.gz'),
+                         self._records('/full.dump.gz'))
+
+    def test_counters(self):
+        stream = self._open('/full.dump.gz')
+        self.assertEqual(stream.read(), _pcap())
+        self.assertEqual(stream.read(), b'')
+        self.assertEqual(stream.compressed_bytes,
+                         len(self.server.bodies['/full.dump.gz']))
+        stream.close()
+
+    def test_dropped_connection(self):
+        self.assertRaises(IOError, self._records, '/dropped.dump.gz')
+
+    def test_truncated_record(self):
+        self.assertRaises(IOError, self._records, '/record.dump.gz')
+
+
+if __name__ == '__main__':
+    unittest.main()
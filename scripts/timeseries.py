@@ -0,0 +1,258 @@
+"""
+Per-interval traffic series for analyze().
+
+Counts, per interval of capture time, the packets and bytes (original frame
+lengths) of the trace, its TCP and UDP packets and its IP packets per DSCP
+class (the class selector, DSCP >> 3). Written as csv rows:
+
+    time,packets,bytes,tcp,udp,cs0,cs1,cs2,cs3,cs4,cs5,cs6,cs7
+
+where time is the start of the interval. Buckets are preallocated lists
+covering the trace from its start to its end time, e.g. the StartTime and
+EndTime scraped by scrap_stats.get_trace_info_from_page(), so that adding a
+packet only indexes and increments them. They are extended if the trace runs
+past its end time, up to LATE_SLACK seconds, or MAX_DURATION seconds from
+the start if the end time is unknown. Packets past that, e.g. with a corrupt
+timestamp, are only counted as late instead of growing the buckets without
+bound.
+"""
+import os
+import logging
+
+from pcap_mmap import *
+
+try:
+    import numpy as np
+except ImportError:
+    # Only required for Timeseries.add_batch()
+    np = None
+
+HEADER = ('time,packets,bytes,tcp,udp,cs0,cs1,cs2,cs3,cs4,cs5,cs6,cs7\n')
+# Duration preallocated when the end of the trace is unknown. MAWI traces
+# are 15 minutes long.
+DEFAULT_DURATION = 900
+# Seconds after the end time of the trace still counted into buckets
+LATE_SLACK = 3600
+# Seconds after the start counted into buckets when the end time is unknown
+MAX_DURATION = 86400
+N_CLASSES = 8
+
+
+class Timeseries(object):
+    """
+    Counts packets into buckets of interval seconds and writes them as csv.
+    """
+    extension = '.timeseries.csv'
+
+    def __init__(self, output_file, interval=60, start=None, end=None):
+        """
+        :param output_file: (str) path to the csv file
+        :param interval: (int) seconds per bucket
+        :param start: (int) start time of the trace, rounded down to a
+        multiple of interval. Packets captured before it are only counted
+        as early. Default: time of the first packet.
+        :param end: (int) end time of the trace, used to preallocate the
+        buckets (default: start + DEFAULT_DURATION). Packets captured more
+        than LATE_SLACK seconds after it are only counted as late.
+        """
+        self.output = output_file
+        self.interval = int(interval)
+        self.start = None
+        self.end = end
+        # Packets captured before start, and past the last bucket allowed
+        self.early = 0
+        self.late = 0
+        self._limit = None
+        self._used = 0
+        self.packets = []
+        self.bytes = []
+        self.tcp = []
+        self.udp = []
+        # N_CLASSES counts per bucket
+        self.classes = []
+        if start is not None:
+            self._allocate(start)
+
+    def _allocate(self, start):
+        self.start = int(start) - int(start) % self.interval
+        if self.end is not None:
+            end = int(self.end)
+            limit = end + LATE_SLACK
+        else:
+            end = self.start + DEFAULT_DURATION
+            limit = self.start + MAX_DURATION
+        # Number of buckets the series may grow to
+        self._limit = max(1, (limit - self.start) // self.interval + 1)
+        self._grow(max(1, (end - self.start) // self.interval + 1))
+
+    def _grow(self, size):
+        # Extended in place, so that add_packets() keeps its references.
+        added = size - len(self.packets)
+        for series in (self.packets, self.bytes, self.tcp, self.udp):
+            series.extend([0] * added)
+        self.classes.extend([0] * (added * N_CLASSES))
+
+    def add_packets(self, packets):
+        """
+        Count decoded packets while passing them on.
+        :param packets: (generator) (ts, length, kind, proto, src, sport, dst,
+        dport, tos, flags) tuples, see MmapPcapReader.packets()
+        :return: generator of the same tuples
+        """
+        interval = self.interval
+        counts = self.packets
+        byte_counts = self.bytes
+        tcp = self.tcp
+        udp = self.udp
+        classes = self.classes
+        is_tcp = KIND_TCP
+        is_udp = KIND_UDP
+        has_ip = KIND_HAS_IP
+        start = self.start
+        limit = self._limit
+        size = len(counts)
+        used = self._used
+        try:
+            for packet in packets:
+                ts, length, kind, _, _, _, _, _, tos, _ = packet
+                if kind != PKT_FILTERED:
+                    if start is None:
+                        self._allocate(ts)
+                        start = self.start
+                        limit = self._limit
+                        size = len(counts)
+                    i = (int(ts) - start) // interval
+                    if i < 0:
+                        self.early += 1
+                        yield packet
+                        continue
+                    if i >= size:
+                        if i >= limit:
+                            self.late += 1
+                            yield packet
+                            continue
+                        size = min(limit, max(i + 1, 2 * size))
+                        self._grow(size)
+                    if i >= used:
+                        used = i + 1
+                    counts[i] += 1
+                    byte_counts[i] += length
+                    if is_tcp[kind]:
+                        tcp[i] += 1
+                    elif is_udp[kind]:
+                        udp[i] += 1
+                    if has_ip[kind]:
+                        classes[i * N_CLASSES + (tos >> 5)] += 1
+                yield packet
+        finally:
+            self._used = used
+
+    def add_batch(self, packets):
+        """
+        Count a batch of packets decoded by pcap_batch.
+        :param packets: (numpy.ndarray) array of pcap_batch.PACKET_DTYPE
+        """
+        packets = packets[packets['kind'] != PKT_FILTERED]
+        if not len(packets):
+            return
+        if self.start is None:
+            self._allocate(int(packets['ts_sec'][0]))
+        buckets = (packets['ts_sec'].astype(np.int64) - self.start) // \
+            self.interval
+        early = buckets < 0
+        late = buckets >= self._limit
+        self.early += int(early.sum())
+        self.late += int(late.sum())
+        kept = ~(early | late)
+        packets = packets[kept]
+        buckets = buckets[kept]
+        if not len(packets):
+            return
+        size = int(buckets.max()) + 1
+        if size > len(self.packets):
+            self._grow(min(self._limit, max(size, 2 * len(self.packets))))
+        self._used = max(self._used, size)
+        kinds = packets['kind']
+        ip = has_ip4(kinds)
+        tcp = (kinds == PKT_TCP) | (kinds == PKT_TCP_NO_PORTS)
+        udp = (kinds == PKT_UDP) | (kinds == PKT_UDP_NO_PORTS)
+        for series, values, weights in (
+                (self.packets, buckets, None),
+                (self.bytes, buckets, packets['length'].astype(np.float64)),
+                (self.tcp, buckets[tcp], None),
+                (self.udp, buckets[udp], None),
+                (self.classes, buckets[ip] * N_CLASSES +
+                 (packets['tos'][ip] >> 5), None)):
+            if not len(values):
+                continue
+            added = np.bincount(values, weights=weights).astype(np.int64)
+            for i in np.flatnonzero(added).tolist():
+                series[i] += int(added[i])
+
+    def rows(self):
+        """
+        :return: generator of (time, packets, bytes, tcp, udp, cs0, ...,
+        cs7) tuples of every bucket up to the end time or the last packet
+        """
+        if self.start is None:
+            return
+        size = self._used
+        if self.end is not None:
+            size = max(size, min(len(self.packets),
+                                 (int(self.end) - self.start) //
+                                 self.interval + 1))
+        for i in range(size):
+            yield ((self.start + i * self.interval, self.packets[i],
+                    self.bytes[i], self.tcp[i], self.udp[i]) +
+                   tuple(self.classes[i * N_CLASSES:(i + 1) * N_CLASSES]))
+
+    def close(self):
+        if self.early:
+            logging.info('packets=%s captured before start=%s not in '
+                         'timeseries=%s' % (self.early, self.start,
+                                            self.output))
+        if self.late:
+            logging.info('packets=%s captured after end=%s not in '
+                         'timeseries=%s' % (self.late,
+                                            self.start + self._limit *
+                                            self.interval, self.output))
+        _write(self.output, self.rows())
+
+    def abort(self):
+        """
+        Drop the buckets after a failed analysis. Nothing is written before
+        close().
+        """
+
+    @classmethod
+    def merge(cls, output_file, parts):
+        """
+        Sum csv files written by Timeseries into one and remove them.
+        :param output_file: (str) path to the merged csv file
+        :param parts: (list[str]) paths to the csv files, all with the same
+        interval and start time
+        """
+        buckets = {}
+        for part in parts:
+            with open(part, 'r') as f:
+                f.readline()
+                for line in f:
+                    values = [int(value) for value in line.split(',')]
+                    totals = buckets.get(values[0])
+                    if totals is None:
+                        buckets[values[0]] = values[1:]
+                    else:
+                        for i, value in enumerate(values[1:]):
+                            totals[i] += value
+            os.remove(part)
+        _write(output_file, (tuple([time] + buckets[time])
+                             for time in sorted(buckets)))
+
+
+def _write(output_file, rows):
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(HEADER)
+        f.writelines(','.join(str(value) for value in row) + '\n'
+                     for row in rows)
+    os.rename(tmp_file, output_file)